@@ -0,0 +1,679 @@
+"""
+Benchmarks against sporestack.mock_server.
+
+python bench.py
+"""
+
+from __future__ import print_function
+from collections import namedtuple
+from time import sleep, time
+import json
+import os
+import random
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib2
+
+import yaml
+
+import sporestack
+import sporestack.cache
+import sporestack.cli as cli
+import sporestack.decode
+import sporestack.fleet
+import sporestack.options
+import sporestack.poll
+import sporestack.probe
+import sporestack.quote
+import sporestack.remote
+import sporestack.renew
+import sporestack.store
+from sporestack.mock_server import MockServer
+
+POLLS = 500
+DECODES = 200
+NODES = 20000
+OPTION_CHECKS = 20000
+EXEC_NODES = 32
+
+# `sporestack list` runs, each a new interpreter, over STARTUP_NODES stored
+# nodes. STARTUP_TARGET is the seconds we want it done in.
+STARTUP_RUNS = 20
+STARTUP_NODES = 200
+STARTUP_TARGET = 0.1
+STARTUP_SCRIPT = """
+import sys
+sys.argv = ['sporestack', 'list']
+from sporestack import cli
+cli.main()
+"""
+
+# Stands in for ssh: reads the script, answers after 100ms.
+FAKE_SSH = """#!/bin/sh
+cat > /dev/null
+echo "ran on $3"
+sleep 0.1
+"""
+FLEET_NODES = 200
+FLEET_CONCURRENCY = 32
+
+# Nodes spawned at once by cli.spawn_many, for bench_spawn.
+SPAWN_CONCURRENCY = [1, 16, 64]
+# Seconds the mock endpoint takes per request, about a real round trip.
+SPAWN_LATENCY = 0.02
+READINESS_RUNS = 20
+# cloudinit sizes, in bytes, to spawn with over a TRANSPORT_BANDWIDTH link.
+CLOUDINIT_SIZES = [4096, 32768, 131072]
+# Bytes a second, about a slow Tor circuit.
+TRANSPORT_BANDWIDTH = 64 * 1024
+TRANSPORT_RUNS = 3
+RENEW_NODES = 10000
+QUOTE_DAYS = [1, 7, 14, 28]
+QUOTE_CONCURRENCY = 16
+RENEW_WAKEUPS = 1000
+
+SSHKEY = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC bench@host\n'
+
+NODE = {'end_of_life': 0,
+        'payment_status': False,
+        'creation_status': False,
+        'address': '1BitcoinEaterAddressDontSendf59kuE',
+        'satoshis': 100000,
+        'ip4': '127.0.0.1',
+        'ip6': '::1',
+        'deprecated': False}
+
+
+class TimedClient(sporestack.Client):
+    """
+    A Client that records how long each request took.
+    """
+    def __init__(self, *args, **kwargs):
+        sporestack.Client.__init__(self, *args, **kwargs)
+        self.timings = []
+
+    def request(self, *args, **kwargs):
+        start = time()
+        try:
+            return sporestack.Client.request(self, *args, **kwargs)
+        finally:
+            self.timings.append(time() - start)
+
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def report_latency(name, timings):
+    print('{}: p50 {:.2f} ms, p99 {:.2f} ms'.format(
+        name,
+        percentile(timings, 0.5) * 1000,
+        percentile(timings, 0.99) * 1000))
+
+
+def report(name, seconds, count):
+    print('{}: {:.1f} us/op'.format(name, seconds / count * 1000000))
+
+
+def bench_poll(endpoint, name='poll'):
+    """
+    Per-poll latency of /node: a new connection per poll (what we used to do)
+    against the pooled Client, and sporestack.node() itself.
+    """
+    post_data = json.dumps({'days': 1, 'unique': 'bench'})
+    start = time()
+    for _ in range(POLLS):
+        urllib2.urlopen(endpoint + '/node', data=post_data).read()
+    report('{}, urlopen'.format(name), time() - start, POLLS)
+
+    client = sporestack.Client(endpoint=endpoint)
+    start = time()
+    for _ in range(POLLS):
+        client.request('POST', '/node', body=post_data)
+    report('{}, Client'.format(name), time() - start, POLLS)
+    client.close()
+
+    client = TimedClient(endpoint=endpoint)
+    for _ in range(POLLS):
+        client.node(days=1, unique='bench')
+    report_latency('{}, sporestack.node()'.format(name), client.timings)
+    client.close()
+
+
+def self_signed(directory):
+    """
+    Returns a PEM file with a new key and a certificate for 127.0.0.1.
+    """
+    certfile = os.path.join(directory, 'mock.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-nodes',
+                           '-newkey', 'rsa:2048', '-days', '1',
+                           '-subj', '/CN=127.0.0.1',
+                           '-addext', 'subjectAltName=IP:127.0.0.1',
+                           '-keyout', certfile, '-out', certfile],
+                          stdout=open(os.devnull, 'w'),
+                          stderr=subprocess.STDOUT)
+    return certfile
+
+
+def bench_poll_https():
+    """
+    bench_poll() over HTTPS, where every new connection costs a TLS
+    handshake too. The mock's self-signed certificate is trusted for the
+    duration, so certificates are still checked.
+    """
+    directory = tempfile.mkdtemp()
+    default_context = ssl._create_default_https_context
+    try:
+        certfile = self_signed(directory)
+        ssl._create_default_https_context = \
+            lambda: ssl.create_default_context(cafile=certfile)
+        server = MockServer(certfile=certfile).start()
+        try:
+            bench_poll(server.endpoint, name='poll over HTTPS')
+        finally:
+            server.stop()
+    finally:
+        ssl._create_default_https_context = default_context
+        shutil.rmtree(directory)
+
+
+def cli_home(endpoint=None):
+    """
+    Points cli at a new, empty DOT_FILE_PATH and catalog cache, and at
+    endpoint. Returns a function that puts everything back.
+    """
+    directory = tempfile.mkdtemp()
+    saved = (cli.DOT_FILE_PATH, sporestack.cache.CACHE_PATH,
+             sporestack.ENDPOINT, dict(sporestack.poll.PHASES))
+    cli.DOT_FILE_PATH = os.path.join(directory, '.sporestack')
+    cli._node_store = None
+    sporestack.cache.CACHE_PATH = os.path.join(directory, 'cache')
+    if endpoint is not None:
+        sporestack.ENDPOINT = endpoint
+
+    def restore():
+        if cli._node_store is not None:
+            cli._node_store.close()
+            cli._node_store = None
+        (cli.DOT_FILE_PATH, sporestack.cache.CACHE_PATH,
+         sporestack.ENDPOINT, phases) = saved
+        sporestack.poll.PHASES.clear()
+        sporestack.poll.PHASES.update(phases)
+        # The options came over the default client's connections.
+        sporestack.default_client().close()
+        shutil.rmtree(directory)
+    return restore
+
+
+def quietly(function, *args, **kwargs):
+    """
+    Calls function with stdout and stderr thrown away. Returns what it
+    returned and how long it took.
+    """
+    stdout, stderr = sys.stdout, sys.stderr
+    devnull = open(os.devnull, 'w')
+    sys.stdout = sys.stderr = devnull
+    try:
+        start = time()
+        result = function(*args, **kwargs)
+        return result, time() - start
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        devnull.close()
+
+
+def bench_spawn():
+    """
+    cli.spawn() once, then cli.spawn_many() at each of SPAWN_CONCURRENCY,
+    against an endpoint with SPAWN_LATENCY per request. Nodes are paid on
+    their second poll and created on their third.
+    """
+    server = MockServer(latency=SPAWN_LATENCY).start()
+    restore = cli_home(server.endpoint)
+    sporestack.poll.PHASES.update({'payment': (0.05, 0.5),
+                                   'building': (0.05, 0.5)})
+    sshkey = os.path.join(os.path.dirname(cli.DOT_FILE_PATH), 'id_rsa.pub')
+    with open(sshkey, 'w') as sshkey_file:
+        sshkey_file.write(SSHKEY)
+    settings = {'days': 1, 'sshkey': sshkey, 'osid': 230, 'dcid': 3,
+                'flavor': 29}
+    try:
+        # Fetches and caches the node options, like a first spawn does.
+        _, elapsed = quietly(cli.spawn,
+                             uuid='spawn-first',
+                             connectafter=False,
+                             **settings)
+        print('cli.spawn, options not cached: {:.2f} ms'.format(
+            elapsed * 1000))
+        requests = server.request_count('/node')
+        _, elapsed = quietly(cli.spawn,
+                             uuid='spawn',
+                             connectafter=False,
+                             **settings)
+        print('cli.spawn: {} requests, {:.2f} ms'.format(
+            server.request_count('/node') - requests, elapsed * 1000))
+        for concurrency in SPAWN_CONCURRENCY:
+            requests = server.request_count('/node')
+            uuids, elapsed = quietly(cli.spawn_many,
+                                     count=concurrency,
+                                     concurrency=concurrency,
+                                     **settings)
+            assert len(uuids) == concurrency
+            print('cli.spawn_many, {} at once: {:.1f} requests/spawn, '
+                  '{:.1f} spawns/s'.format(
+                      concurrency,
+                      (server.request_count('/node') - requests) /
+                      float(concurrency),
+                      concurrency / elapsed))
+    finally:
+        restore()
+        server.stop()
+
+
+def bench_list():
+    """
+    cli.list() over NODES stored nodes, in each output format.
+    """
+    restore = cli_home()
+    store = cli.node_store()
+    now = int(time())
+    for number in range(NODES):
+        store.put({'uuid': 'list-{}'.format(number),
+                   'ip4': '127.0.0.1',
+                   'ip6': '::1',
+                   'end_of_life': now + 86400 + number})
+    try:
+        for output_format in ('text', 'json', 'csv'):
+            _, elapsed = quietly(cli.list, output_format=output_format)
+            report('cli.list, {}, per node'.format(output_format),
+                   elapsed,
+                   NODES)
+    finally:
+        restore()
+
+
+def bench_list_startup():
+    """
+    `sporestack list` from a new interpreter, startup included, against
+    STARTUP_TARGET.
+    """
+    home = tempfile.mkdtemp()
+    try:
+        store = sporestack.store.NodeStore(os.path.join(home, '.sporestack'))
+        for number in range(STARTUP_NODES):
+            store.put({'uuid': 'startup-{}'.format(number),
+                       'ip4': '127.0.0.1',
+                       'ip6': '::1',
+                       'end_of_life': int(time()) + 86400})
+        store.close()
+        environment = dict(os.environ)
+        environment['HOME'] = home
+        environment['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+        timings = []
+        with open(os.devnull, 'w') as devnull:
+            for _ in range(STARTUP_RUNS):
+                start = time()
+                subprocess.check_call([sys.executable, '-c', STARTUP_SCRIPT],
+                                      stdout=devnull,
+                                      env=environment)
+                timings.append(time() - start)
+        report_latency('sporestack list, startup', timings)
+        print('sporestack list, startup: p50 {} the {:.0f} ms target'.format(
+            'within' if percentile(timings, 0.5) < STARTUP_TARGET
+            else 'over',
+            STARTUP_TARGET * 1000))
+    finally:
+        shutil.rmtree(home)
+
+
+def realistic_cloudinit(size):
+    """
+    A cloud-config of about size bytes: packages and a provisioning script
+    out of a small vocabulary, so it compresses like real ones do.
+    """
+    words = ['apt-get', 'install', 'systemctl', 'enable', 'restart', 'echo',
+             'mkdir', '-p', '/etc/nginx', '/var/www', 'chown', 'www-data',
+             'curl', '-fsSL', 'https://example.com/release.tar.gz', 'tar',
+             'xzf', 'ln', '-s', 'sed', '-i', 's/listen 80/listen 8080/',
+             'nginx.conf', 'tor', 'torrc', 'ORPort', '9001', 'ExitPolicy']
+    rng = random.Random(size)
+    lines = ['#cloud-config',
+             'packages: [nginx, tor, curl, unattended-upgrades]',
+             'write_files:',
+             '  - path: /root/provision.sh',
+             '    permissions: "0700"',
+             '    content: |',
+             '      #!/bin/sh',
+             '      set -e']
+    length = sum([len(line) + 1 for line in lines])
+    while length < size:
+        line = '      ' + ' '.join([rng.choice(words)
+                                    for _ in range(rng.randint(2, 10))])
+        lines.append(line)
+        length += len(line) + 1
+    lines.append('runcmd: [/root/provision.sh]')
+    return '\n'.join(lines) + '\n'
+
+
+def bench_transport():
+    """
+    Bytes on the wire and latency for the catalog and first /node request
+    of a spawn, with and without compression, over a TRANSPORT_BANDWIDTH
+    link.
+    """
+    options = json.loads(catalog_payloads()[0])
+    for compress in (False, True):
+        label = 'gzip' if compress else 'plain'
+        server = MockServer(options=options,
+                            compress=compress,
+                            bandwidth=TRANSPORT_BANDWIDTH).start()
+        client = sporestack.Client(endpoint=server.endpoint)
+        start = time()
+        client.node_options()
+        client.node_get_launch_profile('index')
+        print('transport, {}, catalog: {} bytes down, {:.2f} ms'.format(
+            label, server.bytes_sent, (time() - start) * 1000))
+        for size in CLOUDINIT_SIZES:
+            cloudinit = realistic_cloudinit(size)
+            received = server.bytes_received
+            sent = server.bytes_sent
+            timings = []
+            for run in range(TRANSPORT_RUNS):
+                start = time()
+                client.node(days=1,
+                            unique='transport-{}-{}'.format(size, run),
+                            cloudinit=cloudinit)
+                timings.append(time() - start)
+            print('transport, {}, {} KB cloudinit: {} bytes up, {} bytes '
+                  'down, p50 {:.2f} ms'.format(
+                      label,
+                      size // 1024,
+                      (server.bytes_received - received) // TRANSPORT_RUNS,
+                      (server.bytes_sent - sent) // TRANSPORT_RUNS,
+                      percentile(timings, 0.5) * 1000))
+        client.close()
+        server.stop()
+
+
+def bench_quote():
+    """
+    Pricing every flavor in every dcid for QUOTE_DAYS against an endpoint
+    with SPAWN_LATENCY per request: sweeping a quote at a time, sweeping
+    fanned out, the default of one quote per flavor and dcid, and from
+    cache.
+    """
+    directory = tempfile.mkdtemp()
+    cache_path = sporestack.cache.CACHE_PATH
+    endpoint = sporestack.ENDPOINT
+    server = MockServer(latency=SPAWN_LATENCY).start()
+    sporestack.cache.CACHE_PATH = directory
+    sporestack.ENDPOINT = server.endpoint
+    runs = (('sweep, serial', 1, True, True),
+            ('sweep, fanned out', QUOTE_CONCURRENCY, True, True),
+            ('linear', QUOTE_CONCURRENCY, False, True),
+            ('cached', QUOTE_CONCURRENCY, True, False))
+    try:
+        for label, concurrency, sweep, refresh in runs:
+            requests = server.request_count()
+            start = time()
+            rows = sporestack.quote.matrix(QUOTE_DAYS,
+                                           concurrency=concurrency,
+                                           rate=None,
+                                           refresh=refresh,
+                                           sweep=sweep)
+            print('quote, {}: {} prices, {} requests, {:.2f} ms'.format(
+                label,
+                len(rows),
+                server.request_count() - requests,
+                (time() - start) * 1000))
+    finally:
+        sporestack.cache.CACHE_PATH = cache_path
+        sporestack.ENDPOINT = endpoint
+        # The options came over the default client's connections.
+        sporestack.default_client().close()
+        server.stop()
+        shutil.rmtree(directory)
+
+
+def bench_readiness():
+    """
+    How long after a node's port opens wait_for_port(), which cli.ssh()
+    waits with, notices.
+    """
+    lags = []
+    for run in range(READINESS_RUNS):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        opened = []
+
+        def come_online():
+            sleep(0.05 * run)
+            opened.append(time())
+            listener.listen(1)
+        thread = threading.Thread(target=come_online)
+        thread.start()
+        sporestack.probe.wait_for_port({'ip4': '127.0.0.1'},
+                                       listener.getsockname()[1])
+        lags.append(time() - opened[0])
+        thread.join()
+        listener.close()
+    report_latency('ssh readiness lag', lags)
+
+
+def bench_fleet(endpoint):
+    """
+    Launches FLEET_NODES nodes at once and polls them until created.
+    """
+    fleet = sporestack.fleet.Fleet(concurrency=FLEET_CONCURRENCY,
+                                   client=sporestack.Client(
+                                       endpoint=endpoint,
+                                       pool_size=FLEET_CONCURRENCY))
+    requests = [{'days': 1, 'unique': 'fleet-{}'.format(number)}
+                for number in range(FLEET_NODES)]
+    start = time()
+    poller = sporestack.poll.Poller(phases={'payment': (0.1, 0.1),
+                                            'building': (0.1, 0.1)})
+    created = fleet.wait_until_created(requests, poller=poller)
+    elapsed = time() - start
+    fleet.close()
+    assert len(created) == FLEET_NODES
+    print('fleet: {} nodes in {:.2f}s, {:.0f} requests/s'.format(
+        FLEET_NODES, elapsed, FLEET_NODES * 3 / elapsed))
+
+
+def catalog_payloads():
+    """
+    Options and launch profile payloads about the size of the real ones.
+    """
+    options = {'osid': {}, 'dcid': {}, 'flavor': {}}
+    for osid in range(150, 250, 5):
+        options['osid'][str(osid)] = {'name': 'Operating System {}'.format(
+            osid), 'family': 'linux', 'arch': 'x64'}
+    for dcid in range(1, 16):
+        options['dcid'][str(dcid)] = {'name': 'Datacenter {}'.format(dcid),
+                                      'country': 'US'}
+    for flavor in range(1, 31):
+        options['flavor'][str(flavor)] = {'ram': 512 * flavor,
+                                          'disk': 20 * flavor,
+                                          'vcpu_count': flavor,
+                                          'bandwidth': 1.0 * flavor}
+    cloudinit = '#cloud-config\n' + 'runcmd:\n' + \
+        '  - echo "provisioning step"\n' * 2000
+    profile = {'name': 'tor_relay',
+               'human_name': 'Tor relay',
+               'description': 'Tor relay.',
+               'osid': 230,
+               'flavor': 29,
+               'dcid': None,
+               'days': 28,
+               'cloudinit': cloudinit,
+               'startupscript': None,
+               'postlaunch': 'cat /etc/tor/torrc\n'}
+    return json.dumps(options), json.dumps(profile)
+
+
+def bench_decode():
+    """
+    yaml.safe_load, which we used to parse JSON with, against decode.loads.
+    """
+    for name, payload in zip(['options', 'launch profile'],
+                             catalog_payloads()):
+        start = time()
+        for _ in range(DECODES):
+            yaml.safe_load(payload)
+        report('decode {}, yaml.safe_load'.format(name),
+               time() - start,
+               DECODES)
+        start = time()
+        for _ in range(DECODES):
+            sporestack.decode.loads(payload, 'application/json')
+        report('decode {}, {}'.format(name, sporestack.decode.BACKEND),
+               time() - start,
+               DECODES)
+
+
+def bench_options():
+    """
+    Checking settings and picking a flavor against the options index.
+    """
+    options = json.loads(catalog_payloads()[0])
+    start = time()
+    for _ in range(DECODES):
+        index = sporestack.options.OptionsIndex(options)
+    report('options index, build', time() - start, DECODES)
+    start = time()
+    for _ in range(OPTION_CHECKS):
+        index.validate(230, 3, 29)
+    report('options index, validate', time() - start, OPTION_CHECKS)
+    start = time()
+    for _ in range(OPTION_CHECKS):
+        index.flavor(min_ram=4096, min_vcpu=8)
+    report('options index, pick flavor', time() - start, OPTION_CHECKS)
+
+
+def namedtuple_node(data):
+    """
+    How sporestack.node() used to build its result: a new class per call.
+    """
+    node = namedtuple('node', data.keys())
+    node.end_of_life = data['end_of_life']
+    node.payment_status = data['payment_status']
+    node.creation_status = data['creation_status']
+    node.address = data['address']
+    node.satoshis = data['satoshis']
+    node.ip4 = data['ip4']
+    node.ip6 = data['ip6']
+    return node
+
+
+def bench_node():
+    """
+    Per-poll time and retained size of the /node result.
+    """
+    for name, build in [('namedtuple class', namedtuple_node),
+                        ('Node', sporestack.Node.from_response)]:
+        start = time()
+        for _ in range(NODES):
+            node = build(NODE)
+        report('node result, {}'.format(name), time() - start, NODES)
+        size = sys.getsizeof(node)
+        if hasattr(node, '__dict__'):
+            size += sys.getsizeof(node.__dict__)
+        print('node result, {}: {} bytes'.format(name, size))
+
+
+def bench_exec():
+    """
+    remote.execute() fan-out throughput against a fake ssh binary.
+    """
+    fake_bin = tempfile.mkdtemp()
+    fake_ssh = os.path.join(fake_bin, 'ssh')
+    with open(fake_ssh, 'w') as fake_ssh_file:
+        fake_ssh_file.write(FAKE_SSH)
+    os.chmod(fake_ssh, 0o755)
+    path = os.environ['PATH']
+    os.environ['PATH'] = fake_bin + os.pathsep + path
+    # Something for the port probe to connect to.
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    nodes = [{'uuid': str(number), 'ip4': '127.0.0.1', 'ip6': None}
+             for number in range(EXEC_NODES)]
+    try:
+        for concurrency in [1, 16]:
+            start = time()
+            results = sporestack.remote.execute(
+                nodes,
+                'uptime\n',
+                concurrency=concurrency,
+                port=listener.getsockname()[1],
+                control_path=fake_bin)
+            elapsed = time() - start
+            assert [code for _, code in results] == [0] * EXEC_NODES
+            print('exec, concurrency {}: {:.1f} nodes/s'.format(
+                concurrency, EXEC_NODES / elapsed))
+    finally:
+        os.environ['PATH'] = path
+        listener.close()
+        shutil.rmtree(fake_bin)
+
+
+def bench_renew():
+    """
+    Per-wakeup cost of the renewal daemon with RENEW_NODES nodes, against
+    rereading the store every time.
+    """
+    directory = tempfile.mkdtemp()
+    store = sporestack.store.NodeStore(directory)
+    now = int(time())
+    for number in range(RENEW_NODES):
+        store.put({'uuid': str(number),
+                   'ip4': '127.0.0.1',
+                   'ip6': None,
+                   'end_of_life': now + 86400 + number * 60})
+    try:
+        scans = RENEW_WAKEUPS // 100
+        start = time()
+        for _ in range(scans):
+            [node for node in store.active()
+             if node['end_of_life'] - sporestack.renew.WINDOW <= now]
+        report('renew wakeup, store scan', time() - start, scans)
+        queue = sporestack.renew.RenewalQueue()
+        queue.load(store.active())
+        start = time()
+        for _ in range(RENEW_WAKEUPS):
+            store.data_version()
+            queue.pop_due(now, batch_window=0)
+        report('renew wakeup, heap', time() - start, RENEW_WAKEUPS)
+    finally:
+        store.close()
+        shutil.rmtree(directory)
+
+
+def main():
+    server = MockServer().start()
+    bench_poll(server.endpoint)
+    bench_fleet(server.endpoint)
+    server.stop()
+    bench_poll_https()
+    bench_spawn()
+    bench_list()
+    bench_list_startup()
+    bench_readiness()
+    bench_transport()
+    bench_quote()
+    bench_renew()
+    bench_decode()
+    bench_options()
+    bench_node()
+    bench_exec()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,73 +4,625 @@ sporestack.com Python API interface
 Released into the public domain.
 """
 
-from collections import namedtuple
 from warnings import warn
 from base64 import b64encode
+from hashlib import sha1
+from time import sleep, time
 import json
-import urllib2
+import os
+import threading
 
-import yaml
+from sporestack import decode
+from sporestack import metrics
+from sporestack.endpoints import EndpointSet
+from sporestack.ratelimit import TokenBucket
 
 
 ENDPOINT = 'https://sporestack.com'
+# Where nodes, jobs, caches and launch profiles are kept.
+DOT_FILE_PATH = '{}/.sporestack'.format(os.getenv('HOME'))
 
 TIMEOUT = 60
 OPTIONS_TIMEOUT = 10
 
+POOL_SIZE = 4
+RETRIES = 2
+# Seconds, doubled after each retry.
+BACKOFF = 0.5
+# Longest Retry-After we wait out before retrying. Longer ones are raised.
+MAX_RETRY_AFTER = 300
+# Requests a second to each endpoint, None for no limit.
+RATE = None
 
-def node_options():
+# Largest /node request body we'll send, in bytes.
+MAX_BODY_SIZE = 1024 * 1024
+
+# Calls made at once by fleets, probes, quotes, remote commands, renewals
+# and the worker.
+CONCURRENCY = 16
+
+
+class Node(object):
     """
-    Returns a dict of options for osid, dcid, and flavor.
+    A node, as returned by /node.
+
+    Keys we don't have attributes for are kept in extras, which is None
+    if there weren't any.
     """
-    http_return = urllib2.urlopen(ENDPOINT + '/node/options',
-                                  timeout=OPTIONS_TIMEOUT)
-    if http_return.getcode() != 200:
-        raise Exception('SporeStack /node/options did not return HTTP 200.')
-    return yaml.safe_load(http_return.read())
+    __slots__ = ('end_of_life',
+                 'payment_status',
+                 'creation_status',
+                 'address',
+                 'satoshis',
+                 'ip4',
+                 'ip6',
+                 'deprecated',
+                 'extras')
+
+    FIELDS = __slots__[:-1]
+
+    def __init__(self,
+                 end_of_life=None,
+                 payment_status=None,
+                 creation_status=None,
+                 address=None,
+                 satoshis=None,
+                 ip4=None,
+                 ip6=None,
+                 deprecated=False,
+                 extras=None):
+        self.end_of_life = end_of_life
+        self.payment_status = payment_status
+        self.creation_status = creation_status
+        self.address = address
+        self.satoshis = satoshis
+        self.ip4 = ip4
+        self.ip6 = ip6
+        self.deprecated = deprecated
+        self.extras = extras
+
+    @classmethod
+    def from_response(cls, data):
+        """
+        Returns a Node from a decoded /node response.
+        """
+        fields = {}
+        extras = None
+        for key, value in data.items():
+            if key in cls.FIELDS:
+                fields[key] = value
+            else:
+                if extras is None:
+                    extras = {}
+                extras[key] = value
+        return cls(extras=extras, **fields)
+
+    def to_dict(self):
+        data = dict([(field, getattr(self, field)) for field in self.FIELDS])
+        if self.extras is not None:
+            data.update(self.extras)
+        return data
 
+    def __eq__(self, other):
+        if not isinstance(other, Node):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
 
-def node_get_launch_profile(profile):
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return 'Node({})'.format(', '.join(
+            ['{}={!r}'.format(field, getattr(self, field))
+             for field in self.__slots__]))
+
+
+class SporeStackError(Exception):
     """
-    Returns dict of launch instance.
-    Use 'index' if you want a list of all available.
-    https://sporestack.com/launch
+    The endpoint answered with an error. status is the HTTP status, body
+    what it said. retryable errors may work if tried again, after
+    retry_after seconds if that isn't None.
     """
-    url = '{}/launch/{}.json'.format(ENDPOINT, profile)
-    http_return = urllib2.urlopen(url,
-                                  timeout=OPTIONS_TIMEOUT)
-    if http_return.getcode() != 200:
-        raise Exception('{} did not return HTTP 200.'.format(url))
-    return yaml.safe_load(http_return.read())
+    retryable = False
 
+    def __init__(self, message, status=None, body=None, retry_after=None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.body = body
+        self.retry_after = retry_after
 
-def node(days,
-         unique,
-         sshkey=None,
-         cloudinit=None,
-         startupscript=None,
-         osid=None,
-         dcid=None,
-         flavor=None,
-         paycode=None,
-         endpoint=ENDPOINT):
+
+class ServerError(SporeStackError):
     """
-    Returns a node
+    HTTP 5xx.
+    """
+    retryable = True
 
-    Returns:
-    node.payment_status
-    node.end_of_life
-    node.ip6
-    node.ip4
+
+class RateLimited(SporeStackError):
+    """
+    HTTP 429.
     """
+    retryable = True
+
+
+def retry_after(response):
+    """
+    Returns a response's Retry-After in seconds, or None.
+    """
+    value = response.headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_tz, mktime_tz
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time())
+
+
+def error_for(response, message=None):
+    """
+    Returns the SporeStackError for a response. message defaults to the
+    response body.
+    """
+    if message is None:
+        message = response.body
+    if response.status == 429:
+        error_class = RateLimited
+    elif response.status >= 500:
+        error_class = ServerError
+    else:
+        error_class = SporeStackError
+    return error_class(message,
+                       status=response.status,
+                       body=response.body,
+                       retry_after=retry_after(response))
+
+
+class _Call(object):
+    """
+    A request in flight, for other threads making the same one to wait on.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Client(object):
+    """
+    SporeStack API client.
+
+    Keeps a pool of keep-alive connections per endpoint, so polling doesn't
+    cost a TCP and TLS handshake each time. Failed requests, 429 and 5xx
+    responses are retried with exponential backoff, or after Retry-After if
+    the endpoint sent one. With rate, requests to each endpoint are limited
+    to rate a second. Identical /node requests made at once from several
+    threads share one request. Safe to share between threads.
+
+    endpoint defaults to sporestack.ENDPOINT at request time. Either can be
+    a sporestack.endpoints.EndpointSet, to spread requests over several
+    endpoints by latency and fail over between them.
+    """
+    def __init__(self,
+                 endpoint=None,
+                 pool_size=POOL_SIZE,
+                 timeout=TIMEOUT,
+                 options_timeout=OPTIONS_TIMEOUT,
+                 retries=RETRIES,
+                 backoff=BACKOFF,
+                 rate=RATE,
+                 burst=None):
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.options_timeout = options_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rate = rate
+        self.burst = burst
+        self._pools = {}
+        self._buckets = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def pool(self, endpoint=None):
+        """
+        Returns the ConnectionPool for endpoint.
+        """
+        from sporestack.pool import ConnectionPool
+        if endpoint is None:
+            endpoint = self.endpoint or ENDPOINT
+        if isinstance(endpoint, EndpointSet):
+            endpoint = endpoint.choose()
+        with self._lock:
+            if endpoint not in self._pools:
+                self._pools[endpoint] = ConnectionPool(endpoint,
+                                                       size=self.pool_size,
+                                                       timeout=self.timeout)
+            return self._pools[endpoint]
+
+    def bucket(self, endpoint=None):
+        """
+        Returns the TokenBucket for endpoint, or None without a rate.
+        """
+        if self.rate is None:
+            return None
+        if endpoint is None:
+            endpoint = self.endpoint or ENDPOINT
+        if isinstance(endpoint, EndpointSet):
+            endpoint = endpoint.choose()
+        with self._lock:
+            if endpoint not in self._buckets:
+                self._buckets[endpoint] = TokenBucket(self.rate, self.burst)
+            return self._buckets[endpoint]
+
+    def single_flight(self, key, func):
+        """
+        Returns func(). If another thread is already calling func for key,
+        waits for and returns (or raises) its result instead.
+        """
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader is True:
+                call = _Call()
+                self._in_flight[key] = call
+        if leader is False:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+        return call.result
+
+    def request(self,
+                method,
+                path,
+                body=None,
+                headers=None,
+                timeout=None,
+                endpoint=None,
+                key=None):
+        """
+        Returns a sporestack.pool.Response, retrying as configured. The last
+        response is returned if retries run out, or if it asks us to wait
+        longer than MAX_RETRY_AFTER.
+
+        endpoint may be an EndpointSet, in which case a failed attempt is
+        made again at the next best endpoint right away, until every
+        endpoint has been tried. key, like a node's UUID, keeps requests
+        for the same thing at the same endpoint.
+        """
+        # Imported here so importing sporestack (for the CLI, say) doesn't
+        # pull in httplib and ssl.
+        import httplib
+        import socket
+        if endpoint is None:
+            endpoint = self.endpoint or ENDPOINT
+        endpoints = None
+        if isinstance(endpoint, EndpointSet):
+            endpoints = endpoint
+        attempt = 0
+        failovers = 0
+        while True:
+            if endpoints is not None:
+                endpoint = endpoints.choose(key)
+            pool = self.pool(endpoint)
+            bucket = self.bucket(endpoint)
+            delay = self.backoff * 2 ** attempt
+            if bucket is not None:
+                bucket.acquire()
+            metrics.emit('request_start',
+                         method=method,
+                         path=path,
+                         endpoint=pool.endpoint,
+                         attempt=attempt)
+            start = time()
+            try:
+                response = pool.request(method,
+                                        path,
+                                        body=body,
+                                        headers=headers,
+                                        timeout=timeout)
+            except (socket.error, httplib.HTTPException) as error:
+                metrics.emit('request_end',
+                             method=method,
+                             path=path,
+                             endpoint=pool.endpoint,
+                             attempt=attempt,
+                             status=None,
+                             seconds=time() - start,
+                             error=str(error))
+                response = None
+                failure = error
+                if endpoints is None and attempt >= self.retries:
+                    raise
+            else:
+                seconds = time() - start
+                metrics.emit('request_end',
+                             method=method,
+                             path=path,
+                             endpoint=pool.endpoint,
+                             attempt=attempt,
+                             status=response.status,
+                             seconds=seconds,
+                             error=None)
+                retryable = response.status == 429 or response.status >= 500
+                if not retryable:
+                    if endpoints is not None:
+                        endpoints.record(endpoint, seconds, key)
+                    return response
+            if endpoints is not None:
+                endpoints.fail(endpoint)
+                if failovers < len(endpoints) - 1:
+                    failovers += 1
+                    continue
+                if attempt >= self.retries:
+                    if response is None:
+                        raise failure
+                    return response
+            elif attempt >= self.retries:
+                return response
+            if response is not None:
+                wait = retry_after(response)
+                if wait is not None:
+                    if wait > MAX_RETRY_AFTER:
+                        return response
+                    delay = wait
+            sleep(delay)
+            attempt += 1
+
+    def close(self):
+        """
+        Closes idle connections to all endpoints.
+        """
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+
+    def node_options(self, endpoint=None):
+        """
+        Returns a dict of options for osid, dcid, and flavor.
+        """
+        response = self.request('GET',
+                                '/node/options',
+                                timeout=self.options_timeout,
+                                endpoint=endpoint)
+        if response.status != 200:
+            raise error_for(response, 'SporeStack /node/options did not '
+                            'return HTTP 200.')
+        return decode.loads(response.body,
+                            response.headers.get('content-type'))
+
+    def node_get_launch_profile(self, profile, endpoint=None):
+        """
+        Returns dict of launch instance.
+        Use 'index' if you want a list of all available.
+        https://sporestack.com/launch
+        """
+        path = '/launch/{}.json'.format(profile)
+        response = self.request('GET',
+                                path,
+                                timeout=self.options_timeout,
+                                endpoint=endpoint)
+        if response.status != 200:
+            raise error_for(response,
+                            '{} did not return HTTP 200.'.format(path))
+        return decode.loads(response.body,
+                            response.headers.get('content-type'))
+
+    def node_quote(self,
+                   days,
+                   osid=None,
+                   dcid=None,
+                   flavor=None,
+                   endpoint=None):
+        """
+        Returns the satoshis days of a node would cost: what /node asks for
+        a node with a new, throwaway unique. Nothing is spawned unless that
+        is paid for, but the unique is registered with the endpoint.
+        """
+        from uuid import uuid4
+        return self.node(days=days,
+                         unique=str(uuid4()),
+                         osid=osid,
+                         dcid=dcid,
+                         flavor=flavor,
+                         endpoint=endpoint).satoshis
+
+    def prepare_node(self,
+                     days,
+                     unique,
+                     sshkey=None,
+                     cloudinit=None,
+                     startupscript=None,
+                     osid=None,
+                     dcid=None,
+                     flavor=None,
+                     paycode=None,
+                     endpoint=None,
+                     status_only=True,
+                     encoded_cloudinit=None):
+        """
+        Returns a PreparedNode, for polling a node without encoding its
+        request each time.
+        """
+        body = node_body(days=days,
+                         unique=unique,
+                         sshkey=sshkey,
+                         cloudinit=cloudinit,
+                         startupscript=startupscript,
+                         osid=osid,
+                         dcid=dcid,
+                         flavor=flavor,
+                         paycode=paycode,
+                         encoded_cloudinit=encoded_cloudinit)
+        status_body = None
+        if status_only is True:
+            status_body = node_body(days=days, unique=unique)
+        return PreparedNode(self,
+                            body,
+                            status_body,
+                            endpoint=endpoint,
+                            unique=unique)
+
+    def node(self,
+             days,
+             unique,
+             sshkey=None,
+             cloudinit=None,
+             startupscript=None,
+             osid=None,
+             dcid=None,
+             flavor=None,
+             paycode=None,
+             endpoint=None):
+        """
+        Returns a Node
+
+        Returns:
+        node.payment_status
+        node.end_of_life
+        node.ip6
+        node.ip4
+        """
+        return self.prepare_node(days=days,
+                                 unique=unique,
+                                 sshkey=sshkey,
+                                 cloudinit=cloudinit,
+                                 startupscript=startupscript,
+                                 osid=osid,
+                                 dcid=dcid,
+                                 flavor=flavor,
+                                 paycode=paycode,
+                                 endpoint=endpoint).poll()
 
+    def post_node(self, body, endpoint=None, key=None):
+        """
+        POSTs an encoded /node body and returns a Node. Threads posting the
+        same body to the same endpoint at once share one request, and get
+        the same Node. key, the node's unique, keeps it at one endpoint of
+        an EndpointSet. Raises SporeStackError if the endpoint says no.
+        """
+        if endpoint is None:
+            endpoint = self.endpoint or ENDPOINT
+        # The body has the node's unique in it, so this is per node and
+        # payload.
+        return self.single_flight(
+            ('/node', endpoint, sha1(body).hexdigest()),
+            lambda: self._post_node(body, endpoint, key))
+
+    def _post_node(self, body, endpoint, key):
+        response = self.request('POST',
+                                '/node',
+                                body=body,
+                                headers={'Content-Type': 'application/json'},
+                                endpoint=endpoint,
+                                key=key)
+        if response.status != 200:
+            # Throw exception with output from endpoint..
+            raise error_for(response)
+        node = Node.from_response(decode.loads(
+            response.body,
+            response.headers.get('content-type')))
+        if node.deprecated is not False and node.deprecated is not None:
+            warn(str(node.deprecated), DeprecationWarning)
+        return node
+
+
+class PreparedNode(object):
+    """
+    A /node request, encoded once.
+
+    The full body goes out until the endpoint has answered once. After that
+    the node is registered under its unique, so polls only send days and
+    unique, unless status_body is None.
+
+    A node_status event is emitted whenever the node's payment or creation
+    status changes.
+    """
+    def __init__(self,
+                 client,
+                 body,
+                 status_body=None,
+                 endpoint=None,
+                 unique=None):
+        self.client = client
+        self.body = body
+        self.status_body = status_body
+        self.endpoint = endpoint
+        self.unique = unique
+        self.registered = False
+        self.status = None
+
+    def poll(self):
+        """
+        Returns the node's current Node.
+        """
+        body = self.body
+        if self.registered is True and self.status_body is not None:
+            body = self.status_body
+        node = self.client.post_node(body,
+                                     endpoint=self.endpoint,
+                                     key=self.unique)
+        self.registered = True
+        status = (node.payment_status, node.creation_status)
+        if status != self.status:
+            self.status = status
+            metrics.emit('node_status',
+                         unique=self.unique,
+                         payment_status=node.payment_status,
+                         creation_status=node.creation_status)
+        return node
+
+
+def encode_cloudinit(cloudinit):
+    """
+    Returns cloudinit as /node wants it: base64 of its UTF-8.
+    """
+    if isinstance(cloudinit, unicode):
+        cloudinit = cloudinit.encode('utf-8')
+    return b64encode(cloudinit)
+
+
+def node_body(days,
+              unique,
+              sshkey=None,
+              cloudinit=None,
+              startupscript=None,
+              osid=None,
+              dcid=None,
+              flavor=None,
+              paycode=None,
+              encoded_cloudinit=None):
+    """
+    Returns the encoded /node request body. encoded_cloudinit, from
+    encode_cloudinit(), is used in place of cloudinit if given.
+    Raises ValueError if it's over MAX_BODY_SIZE.
+    """
     pre_data = {'days': days,
                 'unique': unique}
 
-    # There must be a better way to do this...
-    if cloudinit is not None:
-        b64_cloudinit = b64encode(cloudinit)
-        pre_data['cloudinit'] = b64_cloudinit
+    if encoded_cloudinit is not None:
+        pre_data['cloudinit'] = encoded_cloudinit
+    elif cloudinit is not None:
+        pre_data['cloudinit'] = encode_cloudinit(cloudinit)
     if sshkey is not None:
         # Strip comment field off of SSH key before we send it to SporeStack,
         # in case it has any.
@@ -89,34 +641,84 @@ def node(days,
         pre_data['flavor'] = flavor
     if paycode is not None:
         pre_data['paycode'] = paycode
-    if endpoint is None:
-        endpoint = ENDPOINT
 
-    post_data = json.dumps(pre_data)
-    try:
-        http_return = urllib2.urlopen(endpoint + '/node',
-                                      data=post_data,
-                                      timeout=TIMEOUT)
-    except urllib2.HTTPError as http_error:
-        if http_error.code != 200:
-            # Throw exception with output from endpoint..
-            raise Exception(http_error.read())
-        else:
-            raise
-    if http_return.getcode() == 200:
-        data = yaml.safe_load(http_return.read())
-        if 'deprecated' in data:
-            if data['deprecated'] is not False:
-                warn(str(data['deprecated']), DeprecationWarning)
-        node = namedtuple('node',
-                          data.keys())
-        node.end_of_life = data['end_of_life']
-        node.payment_status = data['payment_status']
-        node.creation_status = data['creation_status']
-        node.address = data['address']
-        node.satoshis = data['satoshis']
-        node.ip4 = data['ip4']
-        node.ip6 = data['ip6']
-        return node
-    else:
-        raise Exception('Fatal issue with sporestack.')
+    body = json.dumps(pre_data)
+    if len(body) > MAX_BODY_SIZE:
+        message = '/node request is {} bytes, more than the {} allowed.'
+        raise ValueError(message.format(len(body), MAX_BODY_SIZE))
+    return body
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client():
+    """
+    Returns the Client behind the module level functions.
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = Client()
+        return _default_client
+
+
+def node_options(endpoint=None):
+    """
+    Returns a dict of options for osid, dcid, and flavor.
+    """
+    return default_client().node_options(endpoint=endpoint)
+
+
+def node_get_launch_profile(profile, endpoint=None):
+    """
+    Returns dict of launch instance.
+    Use 'index' if you want a list of all available.
+    https://sporestack.com/launch
+    """
+    return default_client().node_get_launch_profile(profile,
+                                                    endpoint=endpoint)
+
+
+def node_quote(days, osid=None, dcid=None, flavor=None, endpoint=None):
+    """
+    Returns the satoshis days of a node would cost, from an unpaid /node
+    answer for a throwaway unique. See Client.node_quote().
+    """
+    return default_client().node_quote(days,
+                                       osid=osid,
+                                       dcid=dcid,
+                                       flavor=flavor,
+                                       endpoint=endpoint)
+
+
+def node(days,
+         unique,
+         sshkey=None,
+         cloudinit=None,
+         startupscript=None,
+         osid=None,
+         dcid=None,
+         flavor=None,
+         paycode=None,
+         endpoint=None):
+    """
+    Returns a node
+
+    Returns:
+    node.payment_status
+    node.end_of_life
+    node.ip6
+    node.ip4
+    """
+    return default_client().node(days=days,
+                                 unique=unique,
+                                 sshkey=sshkey,
+                                 cloudinit=cloudinit,
+                                 startupscript=startupscript,
+                                 osid=osid,
+                                 dcid=dcid,
+                                 flavor=flavor,
+                                 paycode=paycode,
+                                 endpoint=endpoint)
@@ -0,0 +1,173 @@
+"""
+On-disk cache for the SporeStack catalog (node options and launch profiles).
+
+Entries are served without touching the network while fresh, served and
+revalidated in the background while stale, and revalidated with
+If-None-Match/If-Modified-Since otherwise. If the endpoint can't be reached,
+whatever we have is served. Background revalidation is one short attempt
+on a daemon thread, so it never holds up exiting.
+"""
+
+import json
+import os
+import threading
+from time import time
+
+import sporestack
+from sporestack import decode
+from sporestack.endpoints import EndpointSet
+
+CACHE_PATH = os.path.join(sporestack.DOT_FILE_PATH, 'cache')
+
+# Seconds an entry is served without asking the endpoint.
+TTL = 3600
+# Seconds past TTL an entry is still served while we revalidate it in the
+# background.
+STALE_TTL = 7 * 86400
+# Seconds a background revalidation gets, in one attempt.
+BACKGROUND_TIMEOUT = 3
+
+
+def _entry_path(name):
+    return os.path.join(CACHE_PATH, '{}.json'.format(name))
+
+
+def load(name):
+    """
+    Returns the cache entry for name, or None.
+    """
+    try:
+        with open(_entry_path(name)) as entry_file:
+            return json.load(entry_file)
+    except (IOError, ValueError):
+        return None
+
+
+def save(name, entry):
+    """
+    Atomically writes a cache entry.
+    """
+    if not os.path.isdir(CACHE_PATH):
+        os.makedirs(CACHE_PATH, 0o700)
+    path = _entry_path(name)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as entry_file:
+        json.dump(entry, entry_file)
+    os.rename(temp_path, path)
+
+
+def _urls(path, endpoint):
+    """
+    Returns the URLs path may have been fetched from at endpoint, which may
+    be an EndpointSet.
+    """
+    if isinstance(endpoint, EndpointSet):
+        return ['{}{}'.format(each, path) for each in endpoint.endpoints]
+    return ['{}{}'.format(endpoint, path)]
+
+
+def revalidate(name, path, entry=None, client=None, endpoint=None):
+    """
+    Fetches path from endpoint, conditionally if we have an entry, and
+    saves the result under the URL of the endpoint that answered. endpoint
+    defaults to sporestack.ENDPOINT and client to
+    sporestack.default_client().
+    """
+    if endpoint is None:
+        endpoint = sporestack.ENDPOINT
+    headers = {}
+    if entry is not None:
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+    if client is None:
+        client = sporestack.default_client()
+    response = client.request('GET',
+                              path,
+                              headers=headers,
+                              timeout=client.options_timeout,
+                              endpoint=endpoint,
+                              key=path)
+    url = '{}{}'.format(response.endpoint, path)
+    if response.status == 304 and entry is not None:
+        entry['url'] = url
+        entry['fetched'] = time()
+    elif response.status == 200:
+        entry = {'url': url,
+                 'fetched': time(),
+                 'etag': response.headers.get('etag'),
+                 'last_modified': response.headers.get('last-modified'),
+                 'body': response.body}
+    else:
+        raise Exception('{} did not return HTTP 200.'.format(url))
+    save(name, entry)
+    return entry
+
+
+def _background_revalidate(name, path, entry, endpoint):
+    client = sporestack.Client(retries=0,
+                               timeout=BACKGROUND_TIMEOUT,
+                               options_timeout=BACKGROUND_TIMEOUT)
+    try:
+        revalidate(name, path, entry, client, endpoint)
+    except Exception:
+        # We already served the stale copy, try again next time.
+        pass
+    finally:
+        client.close()
+
+
+def get(name,
+        path,
+        ttl=TTL,
+        stale_ttl=STALE_TTL,
+        refresh=False,
+        endpoint=None):
+    """
+    Returns the body of path on endpoint, from cache if possible. endpoint
+    defaults to sporestack.ENDPOINT, and may be an EndpointSet. refresh
+    forces revalidation before returning.
+    """
+    if endpoint is None:
+        endpoint = sporestack.ENDPOINT
+    entry = load(name)
+    if entry is not None and entry['url'] not in _urls(path, endpoint):
+        entry = None
+    if entry is not None and refresh is False:
+        age = time() - entry['fetched']
+        if age < ttl:
+            return entry['body']
+        if age < ttl + stale_ttl:
+            thread = threading.Thread(target=_background_revalidate,
+                                      args=(name, path, entry, endpoint))
+            thread.daemon = True
+            thread.start()
+            return entry['body']
+    try:
+        entry = revalidate(name, path, entry, endpoint=endpoint)
+    except Exception:
+        if entry is None:
+            raise
+    return entry['body']
+
+
+def node_options(refresh=False, endpoint=None):
+    """
+    Cached sporestack.node_options()
+    """
+    return decode.loads(get('options',
+                            '/node/options',
+                            refresh=refresh,
+                            endpoint=endpoint))
+
+
+def node_get_launch_profile(profile, refresh=False, endpoint=None):
+    """
+    Cached sporestack.node_get_launch_profile()
+    """
+    path = '/launch/{}.json'.format(profile)
+    return decode.loads(get('launch_{}'.format(profile),
+                            path,
+                            refresh=refresh,
+                            endpoint=endpoint))
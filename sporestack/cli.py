@@ -4,22 +4,24 @@ sporestack CLI client
 
 from __future__ import print_function
 import argparse
-from uuid import uuid4 as random_uuid
-from time import sleep, time
+from time import time
 import os
-from socket import create_connection
-import json
 import sys
-from subprocess import Popen, PIPE
 
-import pyqrcode
-import sporestack
-import yaml
+# Anything else is imported where it's used, so each subcommand only pays
+# for what it needs. This gets run from shell loops and cron.
 
-DOT_FILE_PATH = '{}/.sporestack'.format(os.getenv('HOME'))
+# Shared by the modules, and defined once in sporestack, which is imported
+# along with this module anyway. Anything else a subcommand's module owns is
+# looked up there when the subcommand runs.
+from sporestack import CONCURRENCY, DOT_FILE_PATH
 
 default_ssh_key_path = '{}/.ssh/id_rsa.pub'.format(os.getenv('HOME'))
 
+QUOTE_DAYS = [1, 7, 28]
+# Requests a second for list --refresh.
+REFRESH_RATE = 10
+
 BANNER = '''
 UUID: {}
 IPv6: {}
@@ -31,8 +33,13 @@ End of Life: {} ({})
 def stderr(*args, **kwargs):
     """
     http://stackoverflow.com/a/14981125
+
+    Writes the whole line at once, so lines from threads don't interleave.
     """
-    print(*args, file=sys.stderr, **kwargs)
+    sep = kwargs.pop('sep', ' ')
+    end = kwargs.pop('end', '\n')
+    sys.stderr.write(sep.join([arg if isinstance(arg, basestring) else str(arg)
+                              for arg in args]) + end)
 
 
 def ttl(end_of_life):
@@ -50,20 +57,68 @@ def ttl(end_of_life):
     return output
 
 
-def list(_):
+_node_store = None
+
+
+def node_store():
     """
-    List SporeStack instances that you've launched.
-    This is ugly. Needs to be cleaned up and made less fragile.
+    Returns the NodeStore in DOT_FILE_PATH, opening it on first use.
     """
-    if not os.path.isdir(DOT_FILE_PATH):
-        print('Run spawn, first.')
-        exit(1)
-    current_time = int(time())
-    we_said_something = False
-    for node_file in os.listdir(DOT_FILE_PATH):
-        node = node_info(node_file.split('.')[0])
-        if current_time < node['end_of_life']:
-            we_said_something = True
+    import sporestack.store
+    global _node_store
+    if _node_store is None:
+        _node_store = sporestack.store.NodeStore(DOT_FILE_PATH)
+    return _node_store
+
+
+_job_queue = None
+
+
+def job_queue():
+    """
+    Returns the JobQueue in DOT_FILE_PATH, opening it on first use.
+    """
+    import sporestack.jobs
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = sporestack.jobs.JobQueue(DOT_FILE_PATH)
+    return _job_queue
+
+
+def list_wrapper(args):
+    """
+    argparse wrapper for list()
+    """
+    list(refresh=args.refresh,
+         output_format=args.format,
+         concurrency=args.concurrency,
+         rate=args.rate)
+
+
+def node_writer(output_format='text'):
+    """
+    Returns a function that prints a node dict in output_format (text,
+    json or csv) as soon as it's given one. json is one object a line.
+    """
+    if output_format == 'json':
+        import json
+
+        def write(node):
+            sys.stdout.write(json.dumps(node) + '\n')
+            sys.stdout.flush()
+    elif output_format == 'csv':
+        import csv
+        import sporestack.store
+        writer = csv.DictWriter(sys.stdout,
+                                sporestack.store.FIELDS,
+                                extrasaction='ignore')
+        writer.writeheader()
+
+        def write(node):
+            writer.writerow(node)
+            sys.stdout.flush()
+    else:
+        def write(node):
             banner = BANNER.format(node['uuid'],
                                    node['ip6'],
                                    node['ip4'],
@@ -72,11 +127,94 @@ def list(_):
             print(banner, end='')
             if node['group'] is not None:
                 print('Group: {}'.format(node['group']))
-            if 'launch_profile' in node:
-                if node['launch_profile'] is not None:
-                    print('Launch profile: {}'.format(node['launch_profile']))
-    if we_said_something is False:
-        print('No active nodes, but you have expired nodes.')
+            if node['launch_profile'] is not None:
+                print('Launch profile: {}'.format(node['launch_profile']))
+            sys.stdout.flush()
+    return write
+
+
+def refresh_nodes(store, concurrency=CONCURRENCY, rate=REFRESH_RATE):
+    """
+    Asks the endpoint about every node in store, concurrency at a time and
+    at most rate a second, and yields each node as its answer arrives.
+    Nodes are read from the store a batch at a time.
+
+    Read-only as far as the endpoint goes: each ask is the status body of a
+    poll, a day and the node's UUID, and nothing is ever paid. A node's
+    record is only updated from an answer saying it's paid for and created.
+    """
+    from itertools import islice
+    import sporestack
+    import sporestack.fleet
+    client = sporestack.Client(pool_size=concurrency, rate=rate)
+    fleet = sporestack.fleet.Fleet(concurrency=concurrency, client=client)
+
+    def refresh(node):
+        try:
+            current = client.node(days=1, unique=node['uuid'])
+        except Exception as error:
+            stderr('{}: {}'.format(node['uuid'], error))
+            return node
+        if current.payment_status is not True or \
+                current.creation_status is not True:
+            stderr('{}: not paid for and created, left as it was.'.format(
+                node['uuid']))
+            return node
+        node = dict(node,
+                    ip4=current.ip4,
+                    ip6=current.ip6,
+                    end_of_life=current.end_of_life)
+        store.put(node)
+        return node
+    nodes = store.iterate()
+    try:
+        while True:
+            batch = [node for node in islice(nodes, concurrency * 4)]
+            if len(batch) == 0:
+                return
+            for node in fleet.imap(refresh, batch):
+                yield node
+    finally:
+        fleet.close()
+
+
+def list(refresh=False,
+         output_format='text',
+         concurrency=CONCURRENCY,
+         rate=REFRESH_RATE):
+    """
+    List SporeStack instances that you've launched, from the store. With
+    refresh, every node is looked up again (see refresh_nodes()) and
+    printed as its answer arrives.
+    """
+    if not os.path.isdir(DOT_FILE_PATH):
+        print('Run spawn, first.')
+        exit(1)
+    store = node_store()
+    write = node_writer(output_format)
+    if refresh is True:
+        nodes = refresh_nodes(store, concurrency=concurrency, rate=rate)
+    elif output_format == 'text':
+        nodes = store.active()
+    else:
+        nodes = store.iterate(alive_at=int(time()))
+    we_said_something = False
+    for node in nodes:
+        we_said_something = True
+        write(node)
+    if we_said_something is False and output_format == 'text':
+        if store.count() == 0:
+            print('Run spawn, first.')
+        else:
+            print('No active nodes, but you have expired nodes.')
+
+
+def prune(_):
+    """
+    Forget nodes that are past their end of life.
+    """
+    removed = node_store().prune()
+    print('Removed {} expired nodes.'.format(removed))
 
 
 def json_extractor_wrapper(args):
@@ -92,9 +230,9 @@ def json_extractor(json_file, json_key):
     Helps with writing SporeStack files, especially
     extracting scripts.
     """
-    with open(json_file) as json:
-        data = yaml.safe_load(json)
-        return data[json_key]
+    import sporestack.decode
+    data = sporestack.decode.load_file(json_file)
+    return data[json_key]
 
 
 def sporestackfile_helper_wrapper(args):
@@ -126,6 +264,7 @@ def sporestackfile_helper(days,
     """
     Helps you write sporestack.json files.
     """
+    import json
     if ' ' in name:
         stderr('Name cannot contain spaces.')
         raise
@@ -153,30 +292,42 @@ def sporestackfile_helper(days,
 
 
 def node_info(uuid):
-    node_file = '{}.json'.format(uuid)
-    node_file_path = os.path.join(DOT_FILE_PATH, node_file)
-    with open(node_file_path) as node_file:
-        node = yaml.safe_load(node_file)
-        return node
+    node = node_store().get(uuid)
+    if node is None:
+        raise Exception('No node with UUID {}.'.format(uuid))
+    return node
 
 
 def ssh_wrapper(args):
     """
     argparse wrapper for ssh()
     """
-    possible_output = ssh(uuid=args.uuid,
-                          stdin=args.stdin)
-    if possible_output is not None:
-        print(possible_output, end='')
+    stdin = args.stdin
+    if stdin == '-':
+        stdin = sys.stdin
+    ssh(uuid=args.uuid,
+        stdin=stdin,
+        timeout=args.timeout,
+        idle_timeout=args.idle_timeout)
 
 
-def ssh(uuid, stdin=None):
+def ssh(uuid,
+        stdin=None,
+        port=22,
+        on_line=None,
+        timeout=None,
+        idle_timeout=None):
     """
     Connects to node via SSH. Meant for terminals.
-    Probably want to split this into connectable and ssh?
-    Much to do.
+    With stdin, a string or file, feeds it to ssh instead, passing output to
+    on_line(stream, line) as it arrives (printing it by default), and
+    returns a sporestack.remote.Result. Exits if that fails, or runs over
+    timeout seconds or idle_timeout seconds without output.
     Should support specifying a keyfile, maybe?
     """
+    import sporestack.metrics
+    import sporestack.poll
+    import sporestack.probe
     # There must be a better way to do this. So ugly!
     # hug? Another argument parser? Something?
     if not isinstance(uuid, basestring):
@@ -184,34 +335,103 @@ def ssh(uuid, stdin=None):
     else:
         node_uuid = uuid
     node = node_info(node_uuid)
-    ipaddress = None
-    while True:
-        for ip in [node['ip6'], node['ip4']]:
-            try:
-                socket = create_connection((ip, 22), timeout=2)
-                socket.close()
-                ipaddress = ip
-                break
-            except:
-                stderr('Waiting for node to come online.')
-            sleep(2)
-        if ipaddress is not None:
-            break
-    command = ('ssh root@{} -p 22 -oStrictHostKeyChecking=no'
-               ' -oUserKnownHostsFile=/dev/null'.format(ipaddress))
+
+    def waiting(phase, attempt, delay):
+        stderr('Waiting for node to come online.')
+    poller = sporestack.poll.Poller(callback=waiting)
+    with sporestack.metrics.timer('connecting'):
+        ipaddress = sporestack.probe.wait_for_port(node, port, poller=poller)
     if stdin is None:
+        command = ('ssh root@{} -p {} -oStrictHostKeyChecking=no'
+                   ' -oUserKnownHostsFile=/dev/null'.format(ipaddress, port))
         os.system(command)
-    else:
-        command = ['ssh', '-l', 'root', ipaddress,
-                   '-oStrictHostKeyChecking=no',
-                   '-oUserKnownHostsFile=/dev/null']
-        process = Popen(command, stdin=PIPE, stderr=PIPE, stdout=PIPE)
-        _stdout, _stderr = process.communicate(stdin)
-        return_code = process.wait()
+        return None
+    import sporestack.remote
+    if on_line is None:
+        def on_line(stream, line):
+            output = sys.stdout
+            if stream == 'stderr':
+                output = sys.stderr
+            output.write(line)
+            output.flush()
+    result = sporestack.remote.run(ipaddress,
+                                   stdin=stdin,
+                                   on_line=on_line,
+                                   control_path=None,
+                                   timeout=timeout,
+                                   idle_timeout=idle_timeout,
+                                   port=port)
+    if result.timed_out is not None:
+        stderr('ssh to {} killed after {:.1f}s ({}).'.format(
+            node_uuid, result.seconds, result.timed_out))
+        exit(1)
+    if result.exit_code != 0:
+        stderr('ssh to {} exited with {}.'.format(node_uuid,
+                                                  result.exit_code))
+        exit(max(1, result.exit_code))
+    return result
+
+
+def execute_wrapper(args):
+    """
+    argparse wrapper for execute()
+    """
+    with open(args.script) as script:
+        stdin = script.read()
+    nodes = node_store().find(group=args.group, alive_at=int(time()))
+    results = execute(nodes,
+                      stdin,
+                      concurrency=args.concurrency,
+                      port=args.port)
+    if len(results) == 0:
+        stderr('No active nodes in group {}.'.format(args.group))
+        exit(1)
+    if exit_codes(results) is False:
+        exit(1)
+
+
+def exit_codes(results):
+    """
+    Prints each node's exit code from a list of (uuid, exit code).
+    Returns True if they're all 0.
+    """
+    succeeded = True
+    for uuid, return_code in results:
+        stderr('{}: exit code {}'.format(uuid, return_code))
         if return_code != 0:
-            stderr(_stderr)
-            raise
-        return _stdout
+            succeeded = False
+    return succeeded
+
+
+def execute(nodes,
+            stdin,
+            concurrency=CONCURRENCY,
+            port=22,
+            reachable_timeout=None):
+    """
+    Runs stdin on nodes (node_info() dicts) at once over ssh on port,
+    printing output lines prefixed with the node's UUID as they arrive.
+    With reachable_timeout, waits up to that many seconds for each node's
+    port to open. Returns a list of (uuid, exit code).
+    """
+    import threading
+    import sporestack.remote
+    output_lock = threading.Lock()
+
+    def on_line(node, stream, line):
+        output = sys.stdout
+        if stream == 'stderr':
+            output = sys.stderr
+        with output_lock:
+            output.write('{} {}'.format(node['uuid'], line))
+            output.flush()
+    results = sporestack.remote.execute(nodes,
+                                        stdin,
+                                        on_line=on_line,
+                                        concurrency=concurrency,
+                                        port=port,
+                                        reachable_timeout=reachable_timeout)
+    return [(node['uuid'], return_code) for node, return_code in results]
 
 
 def spawn_wrapper(args):
@@ -219,18 +439,152 @@ def spawn_wrapper(args):
     Wraps spawn(), invoked by argparse.
     Needs to be cleaned up.
     """
-    spawn(uuid=args.uuid,
-          days=args.days,
-          sshkey=args.ssh_key,
-          launch=args.launch,
-          sporestackfile=args.sporestackfile,
-          cloudinit=args.cloudinit,
-          group=args.group,
-          osid=args.osid,
-          dcid=args.dcid,
-          flavor=args.flavor,
-          paycode=args.paycode,
-          endpoint=args.endpoint)
+    uuid = args.uuid
+    if uuid is None:
+        from uuid import uuid4 as random_uuid
+        uuid = str(random_uuid())
+    instrumented(spawn,
+                 args,
+                 uuid=uuid,
+                 days=args.days,
+                 sshkey=args.ssh_key,
+                 launch=args.launch,
+                 sporestackfile=args.sporestackfile,
+                 cloudinit=args.cloudinit,
+                 group=args.group,
+                 osid=args.osid,
+                 dcid=args.dcid,
+                 flavor=args.flavor,
+                 paycode=args.paycode,
+                 endpoint=endpoint_option(args.endpoint),
+                 flavor_min_ram=args.flavor_min_ram,
+                 flavor_min_vcpu=args.flavor_min_vcpu,
+                 queue=args.queue,
+                 refresh=args.refresh_options)
+
+
+def endpoint_option(endpoints):
+    """
+    Returns the endpoint for --endpoint, which can be given more than once
+    to fail over between endpoints. None means sporestack.ENDPOINT.
+    """
+    import sporestack.endpoints
+    return sporestack.endpoints.endpoint_set(endpoints)
+
+
+def instrumented(func, args, **kwargs):
+    """
+    Calls func(**kwargs), exporting metrics to --metrics and printing a
+    phase by phase breakdown at the end with --timings.
+    """
+    import sporestack.metrics
+    timings = sporestack.metrics.Timings()
+    if args.timings is True:
+        sporestack.metrics.add_hook(timings)
+    try:
+        if args.metrics is None:
+            return func(**kwargs)
+        with sporestack.metrics.exporting(args.metrics, args.metrics_format):
+            return func(**kwargs)
+    finally:
+        if args.timings is True:
+            sporestack.metrics.remove_hook(timings)
+            stderr(timings.report())
+
+
+def read_sshkey(sshkey_path):
+    """
+    Returns the contents of an SSH public key file, or exits.
+    """
+    try:
+        with open(sshkey_path) as ssh_key_file:
+            return ssh_key_file.read()
+    except:
+        pre_message = 'Unable to open {}. Did you run ssh-keygen?'
+        message = pre_message.format(sshkey_path)
+        stderr(message)
+        exit(1)
+
+
+def launch_settings(launch=None,
+                    sporestackfile=None,
+                    refresh=False,
+                    endpoint=None):
+    """
+    Returns a sporestack.profiles.Profile for a launch profile name (or
+    name@hash) from endpoint, or a SporeStack file.
+    """
+    import sporestack.profiles
+    if sporestackfile is not None:
+        return sporestack.profiles.from_file(sporestackfile)
+    profile = sporestack.profiles.get(launch,
+                                      refresh=refresh,
+                                      endpoint=endpoint)
+    stderr('Launch profile: {}'.format(profile.pinned))
+    return profile
+
+
+def check_node_settings(osid,
+                        dcid,
+                        flavor,
+                        flavor_min_ram=None,
+                        flavor_min_vcpu=None,
+                        refresh=False,
+                        endpoint=None):
+    """
+    Returns flavor, or the smallest with flavor_min_ram and flavor_min_vcpu
+    if either is given, after checking the settings against the (cached)
+    node options at endpoint. Exits if they aren't offered.
+    """
+    import sporestack.options
+    picking = flavor_min_ram is not None or flavor_min_vcpu is not None
+    try:
+        index = sporestack.options.index(refresh=refresh, endpoint=endpoint)
+    except Exception as error:
+        if picking is False:
+            # Let the endpoint judge.
+            return flavor
+        stderr('Unable to fetch node options: {}'.format(error))
+        exit(1)
+    try:
+        if picking is True:
+            flavor = index.flavor(min_ram=flavor_min_ram,
+                                  min_vcpu=flavor_min_vcpu)
+        index.validate(osid, dcid, flavor)
+    except ValueError as error:
+        stderr(str(error))
+        exit(1)
+    return flavor
+
+
+def profiles(_):
+    """
+    List launch profile versions we've launched, newest first.
+    """
+    import sporestack.profiles
+    for added, pinned in sporestack.profiles.versions():
+        print('{} (first seen {})'.format(pinned, int(added)))
+
+
+def bitcoin_uri(node):
+    """
+    BIP21 URI to pay for node.
+    """
+    amount = "{0:.8f}".format(node.satoshis *
+                              0.00000001)
+    return 'bitcoin:{}?amount={}'.format(node.address, amount)
+
+
+def save_node(uuid, node, launch_profile=None, group=None, days=None):
+    """
+    Records what we know about a created node in the node store.
+    """
+    from sporestack.store import node_record
+    node_store().put(node_record(uuid,
+                                 node,
+                                 launch_profile=launch_profile,
+                                 group=group,
+                                 days=days))
 
 
 def spawn(uuid,
@@ -248,92 +602,526 @@ def spawn(uuid,
           launch_profile=None,
           cloudinit=None,
           paycode=None,
-          endpoint=None):
+          endpoint=None,
+          flavor_min_ram=None,
+          flavor_min_vcpu=None,
+          queue=False,
+          refresh=False):
+    import sporestack
+    import sporestack.metrics
+    import sporestack.poll
     if sshkey is not None:
-        try:
-            with open(sshkey) as ssh_key_file:
-                sshkey = ssh_key_file.read()
-        except:
-            pre_message = 'Unable to open {}. Did you run ssh-keygen?'
-            message = pre_message.format(sshkey)
-            stderr(message)
-            exit(1)
+        sshkey = read_sshkey(sshkey)
     # Yuck.
     if sporestackfile is not None or launch is not None:
         connectafter = False
-        if sporestackfile is not None:
-            with open(sporestackfile) as sporestack_json:
-                settings = yaml.safe_load(sporestack_json)
-                launch_profile = sporestackfile
-        else:
-            settings = sporestack.node_get_launch_profile(launch)
-            launch_profile = settings['name']
+        with sporestack.metrics.timer('launch profile'):
+            profile = launch_settings(launch,
+                                      sporestackfile,
+                                      refresh,
+                                      endpoint)
+        launch_profile = profile.name
+        settings = profile.settings
         # Iffy on this. Let's let the user pick the days.
         # days = settings['days']
         osid = settings['osid']
         flavor = settings['flavor']
         startupscript = settings['startupscript']
         postlaunch = settings['postlaunch']
-        cloudinit = settings['cloudinit']
+        cloudinit = None
+        encoded_cloudinit = profile.encoded_cloudinit
+    else:
+        encoded_cloudinit = None
+    flavor = check_node_settings(osid,
+                                 dcid,
+                                 flavor,
+                                 flavor_min_ram,
+                                 flavor_min_vcpu,
+                                 refresh,
+                                 endpoint)
+    if queue is True:
+        enqueue([{'days': days,
+                  'sshkey': sshkey,
+                  'unique': uuid,
+                  'osid': osid,
+                  'dcid': dcid,
+                  'flavor': flavor,
+                  'startupscript': startupscript,
+                  'cloudinit': cloudinit,
+                  'encoded_cloudinit': encoded_cloudinit,
+                  'paycode': paycode}],
+                endpoint=endpoint,
+                launch_profile=launch_profile,
+                group=group,
+                postlaunch=postlaunch)
+        return
     already_showed_qr = False
+    poller = sporestack.poll.Poller()
+    client = sporestack.default_client()
+    prepared_node = client.prepare_node(days=days,
+                                        sshkey=sshkey,
+                                        unique=uuid,
+                                        osid=osid,
+                                        dcid=dcid,
+                                        flavor=flavor,
+                                        startupscript=startupscript,
+                                        cloudinit=cloudinit,
+                                        encoded_cloudinit=encoded_cloudinit,
+                                        paycode=paycode,
+                                        endpoint=endpoint)
+    started = time()
+    paid_at = None
     while True:
-        node = sporestack.node(days=days,
-                               sshkey=sshkey,
-                               unique=uuid,
-                               osid=osid,
-                               dcid=dcid,
-                               flavor=flavor,
-                               startupscript=startupscript,
-                               cloudinit=cloudinit,
-                               paycode=paycode,
-                               endpoint=endpoint)
+        node = prepared_node.poll()
         if node.payment_status is False:
-            amount = "{0:.8f}".format(node.satoshis *
-                                      0.00000001)
-            uri = 'bitcoin:{}?amount={}'.format(node.address, amount)
+            uri = bitcoin_uri(node)
             premessage = '''UUID: {}
 Bitcoin URI: {}
 Pay with Bitcoin. Resize your terminal and try again if QR code is not visible.
 Press ctrl+c to abort.'''
             message = premessage.format(uuid,
                                         uri)
-            qr = pyqrcode.create(uri)
             if already_showed_qr is False:
+                import pyqrcode
+                qr = pyqrcode.create(uri)
                 stderr(qr.terminal(module_color='black',
                                    background='white',
                                    quiet_zone=1))
                 stderr(message)
                 already_showed_qr = True
         else:
+            if paid_at is None:
+                paid_at = time()
+                sporestack.metrics.record('payment', paid_at - started)
             stderr('Node being built...')
         if node.creation_status is True:
             break
-        sleep(2)
+        poller.sleep(sporestack.poll.node_phase(node))
+    sporestack.metrics.record('building', time() - paid_at)
 
     banner = BANNER.format(uuid,
                            node.ip6,
                            node.ip4,
                            node.end_of_life,
                            ttl(node.end_of_life))
-    if not os.path.isdir(DOT_FILE_PATH):
-        os.mkdir(DOT_FILE_PATH, 0700)
-    node_file_path = '{}/{}.json'.format(DOT_FILE_PATH, uuid)
-    node_dump = {'ip4': node.ip4,
-                 'ip6': node.ip6,
-                 'end_of_life': node.end_of_life,
-                 'uuid': uuid,
-                 'launch_profile': launch_profile,
-                 'group': group}
-    with open(node_file_path, 'w') as node_file:
-        json.dump(node_dump, node_file)
+    save_node(uuid,
+              node,
+              launch_profile=launch_profile,
+              group=group,
+              days=days)
     if postlaunch is not None:
-        print(ssh(uuid, stdin=postlaunch), end='')
+        ssh(uuid, stdin=postlaunch)
     if connectafter is True:
         stderr(banner)
         ssh(uuid)
         stderr(banner)
 
 
+def spawn_many_wrapper(args):
+    """
+    Wraps spawn_many(), invoked by argparse.
+    """
+    if args.count < 1:
+        stderr('--count must be at least 1.')
+        exit(1)
+    instrumented(spawn_many,
+                 args,
+                 count=args.count,
+                 days=args.days,
+                 sshkey=args.ssh_key,
+                 launch=args.launch,
+                 sporestackfile=args.sporestackfile,
+                 cloudinit=args.cloudinit,
+                 group=args.group,
+                 osid=args.osid,
+                 dcid=args.dcid,
+                 flavor=args.flavor,
+                 paycode=args.paycode,
+                 endpoint=endpoint_option(args.endpoint),
+                 flavor_min_ram=args.flavor_min_ram,
+                 flavor_min_vcpu=args.flavor_min_vcpu,
+                 queue=args.queue,
+                 concurrency=args.concurrency,
+                 rate=args.rate,
+                 refresh=args.refresh_options)
+
+
+def payment_summary(unpaid):
+    """
+    One payment summary for a list of (uuid, node) awaiting payment.
+    """
+    total = sum([node.satoshis for _, node in unpaid])
+    summary = 'Pay for {} nodes: {} satoshis ({:.8f} BTC) total.\n'.format(
+        len(unpaid),
+        total,
+        total * 0.00000001)
+    for uuid, node in unpaid:
+        summary += '{} {}\n'.format(uuid, bitcoin_uri(node))
+    return summary
+
+
+def spawn_many(count,
+               days=None,
+               sshkey=None,
+               launch=None,
+               sporestackfile=None,
+               group=None,
+               osid=None,
+               dcid=None,
+               flavor=None,
+               startupscript=None,
+               postlaunch=None,
+               launch_profile=None,
+               cloudinit=None,
+               paycode=None,
+               endpoint=None,
+               concurrency=CONCURRENCY,
+               rate=None,
+               flavor_min_ram=None,
+               flavor_min_vcpu=None,
+               queue=False,
+               refresh=False,
+               port=22):
+    """
+    Spawns count nodes at once, with one payment summary for all of them.
+    Node files are written as each node is created. With queue, they're
+    left to "sporestack worker" instead. postlaunch runs over ssh on port
+    once each node answers on it; exits if it fails on any node.
+    Returns the list of UUIDs.
+    """
+    from uuid import uuid4 as random_uuid
+    import sporestack
+    import sporestack.fleet
+    import sporestack.metrics
+    if sshkey is not None:
+        sshkey = read_sshkey(sshkey)
+    if sporestackfile is not None or launch is not None:
+        with sporestack.metrics.timer('launch profile'):
+            profile = launch_settings(launch,
+                                      sporestackfile,
+                                      refresh,
+                                      endpoint)
+        launch_profile = profile.name
+        settings = profile.settings
+        osid = settings['osid']
+        flavor = settings['flavor']
+        startupscript = settings['startupscript']
+        postlaunch = settings['postlaunch']
+        cloudinit = None
+        encoded_cloudinit = profile.encoded_cloudinit
+    else:
+        encoded_cloudinit = None
+    flavor = check_node_settings(osid,
+                                 dcid,
+                                 flavor,
+                                 flavor_min_ram,
+                                 flavor_min_vcpu,
+                                 refresh,
+                                 endpoint)
+    requests = []
+    for _ in range(count):
+        requests.append({'days': days,
+                         'sshkey': sshkey,
+                         'unique': str(random_uuid()),
+                         'osid': osid,
+                         'dcid': dcid,
+                         'flavor': flavor,
+                         'startupscript': startupscript,
+                         'cloudinit': cloudinit,
+                         'encoded_cloudinit': encoded_cloudinit,
+                         'paycode': paycode})
+    if queue is True:
+        return enqueue(requests,
+                       endpoint=endpoint,
+                       launch_profile=launch_profile,
+                       group=group,
+                       postlaunch=postlaunch)
+    client = sporestack.Client(endpoint=endpoint,
+                               pool_size=concurrency,
+                               rate=rate)
+    fleet = sporestack.fleet.Fleet(concurrency=concurrency, client=client)
+    unpaid = []
+    polled = set()
+    paid = set()
+    uuids = []
+    started = time()
+    paid_at = None
+    try:
+        for request, node in fleet.poll(requests):
+            uuid = request['unique']
+            if node.payment_status is not False and uuid not in paid:
+                paid.add(uuid)
+                if len(paid) == count:
+                    paid_at = time()
+                    sporestack.metrics.record('payment', paid_at - started)
+            if uuid not in polled:
+                # First round: summarize payment once every node has
+                # answered.
+                polled.add(uuid)
+                if node.payment_status is False:
+                    unpaid.append((uuid, node))
+                if len(polled) == count and len(unpaid) != 0:
+                    stderr(payment_summary(unpaid))
+                    stderr('Press ctrl+c to abort.')
+            if node.creation_status is True:
+                save_node(uuid,
+                          node,
+                          launch_profile=launch_profile,
+                          group=group,
+                          days=days)
+                uuids.append(uuid)
+                stderr('Created {} ({}/{})'.format(uuid, len(uuids), count))
+    finally:
+        fleet.close()
+    if paid_at is not None:
+        sporestack.metrics.record('building', time() - paid_at)
+    if postlaunch is not None and len(uuids) != 0:
+        import sporestack.jobs
+        with sporestack.metrics.timer('postlaunch'):
+            results = execute(
+                [node_info(created) for created in uuids],
+                postlaunch,
+                concurrency=concurrency,
+                port=port,
+                reachable_timeout=sporestack.jobs.REACHABLE_TIMEOUT)
+        if exit_codes(results) is False:
+            exit(1)
+    return uuids
+
+
+def enqueue(requests,
+            endpoint=None,
+            launch_profile=None,
+            group=None,
+            postlaunch=None):
+    """
+    Adds a spawn job to the journal for each dict of node() arguments in
+    requests. Returns their UUIDs.
+    """
+    if endpoint is None:
+        endpoints = None
+    elif isinstance(endpoint, basestring):
+        endpoints = [endpoint]
+    else:
+        endpoints = endpoint.endpoints
+    queue = job_queue()
+    uuids = []
+    for request in requests:
+        queue.put(request['unique'],
+                  dict(request,
+                       endpoint=endpoints,
+                       launch_profile=launch_profile,
+                       group=group,
+                       postlaunch=postlaunch))
+        uuids.append(request['unique'])
+        print(request['unique'])
+    stderr('Queued {} nodes. Run "sporestack worker" to spawn them.'.format(
+        len(uuids)))
+    return uuids
+
+
+def worker_wrapper(args):
+    """
+    argparse wrapper for worker()
+    """
+    worker(concurrency=args.concurrency,
+           once=args.once,
+           payment_timeout=args.payment_timeout)
+
+
+def worker(concurrency=CONCURRENCY, once=False, payment_timeout=None):
+    """
+    Spawns queued nodes, picking up jobs left unfinished by workers that
+    died where they left off. Jobs whose nodes aren't paid for and built
+    within payment_timeout seconds, sporestack.jobs.PAYMENT_TIMEOUT by
+    default, are failed.
+    """
+    import sporestack.jobs
+    if payment_timeout is None:
+        payment_timeout = sporestack.jobs.PAYMENT_TIMEOUT
+
+    def on_state(job, state, node):
+        if state == sporestack.jobs.PENDING_PAYMENT:
+            stderr('{} {} Pay {}'.format(job['uuid'],
+                                         state,
+                                         bitcoin_uri(node)))
+        elif state == sporestack.jobs.FAILED:
+            stderr('{} {}: {}'.format(job['uuid'],
+                                      state,
+                                      job_queue().get(job['uuid'])['error']))
+        else:
+            stderr('{} {}'.format(job['uuid'], state))
+
+    def on_error(job, error):
+        stderr('{} will be retried: {}'.format(job['uuid'], error))
+    sporestack.jobs.run(job_queue(),
+                        node_store(),
+                        concurrency=concurrency,
+                        on_state=on_state,
+                        on_error=on_error,
+                        once=once,
+                        payment_timeout=payment_timeout)
+
+
+def jobs(_):
+    """
+    Lists queued spawns and where they're at.
+    """
+    for job in job_queue().find():
+        line = '{} {}'.format(job['uuid'], job['state'])
+        if job['error'] is not None:
+            line += ': {}'.format(job['error'])
+        if job['retry_at'] is not None and job['retry_at'] > time():
+            line += ' (attempt {}, retrying in {:.0f}s)'.format(
+                job['attempts'] + 1, job['retry_at'] - time())
+        print(line)
+
+
+def quote_wrapper(args):
+    """
+    argparse wrapper for quote()
+    """
+    quote(days=args.days or QUOTE_DAYS,
+          osid=args.osid,
+          dcids=args.dcid,
+          flavors=args.flavor,
+          sort=args.sort,
+          output_format=args.format,
+          concurrency=args.concurrency,
+          rate=args.rate,
+          refresh=args.refresh,
+          sweep=args.sweep,
+          endpoint=endpoint_option(args.endpoint),
+          refresh_options=args.refresh_options)
+
+
+def _price(value):
+    if value is None:
+        return '-'
+    return '{:.0f}'.format(value)
+
+
+def quote(days=QUOTE_DAYS,
+          osid=None,
+          dcids=None,
+          flavors=None,
+          sort='per_day',
+          output_format='text',
+          concurrency=CONCURRENCY,
+          rate=None,
+          refresh=False,
+          sweep=False,
+          endpoint=None,
+          refresh_options=False):
+    """
+    Prints the price of every flavor in every dcid for each of days,
+    cheapest first by sort, in satoshis. Each price is what /node asks for
+    an unpaid node with a throwaway unique, so nothing is spawned. Prices
+    are assumed to be proportional to days unless sweep quotes each of
+    them, see sporestack.quote. rate defaults to sporestack.quote.RATE.
+    refresh_options refetches the node options.
+    """
+    import sporestack.quote
+    if sort not in sporestack.quote.SORT_KEYS:
+        stderr('--sort must be one of: {}'.format(
+            ', '.join(sporestack.quote.SORT_KEYS)))
+        exit(1)
+    if rate is None:
+        rate = sporestack.quote.RATE
+    try:
+        rows = sporestack.quote.matrix(days,
+                                       osid=osid,
+                                       dcids=dcids,
+                                       flavors=flavors,
+                                       concurrency=concurrency,
+                                       rate=rate,
+                                       refresh=refresh,
+                                       sweep=sweep,
+                                       endpoint=endpoint,
+                                       refresh_options=refresh_options)
+    except Exception as error:
+        stderr('Unable to quote: {}'.format(error))
+        exit(1)
+    rows = sporestack.quote.sort(rows, by=sort)
+    if output_format == 'json':
+        import json
+        for row in rows:
+            print(json.dumps(row))
+    elif output_format == 'csv':
+        import csv
+        writer = csv.DictWriter(sys.stdout, sporestack.quote.FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        line = '{:>6} {:>4} {:>4} {:>12} {:>10} {:>12} {:>14} {}'
+        print(line.format('flavor', 'dcid', 'days', 'satoshis', 'per day',
+                          'per VCPU/day', 'per GB RAM/day', 'source'))
+        for row in rows:
+            print(line.format(row['flavor'],
+                              row['dcid'],
+                              row['days'],
+                              row['satoshis'],
+                              _price(row['per_day']),
+                              _price(row['per_vcpu_day']),
+                              _price(row['per_gb_ram_day']),
+                              row['source']))
+
+
+def renew_daemon_wrapper(args):
+    """
+    argparse wrapper for renew_daemon()
+    """
+    renew_daemon(days=args.days,
+                 window=args.window,
+                 group=args.group,
+                 concurrency=args.concurrency,
+                 rate=args.rate,
+                 once=args.once)
+
+
+def renew_daemon(days=None,
+                 window=None,
+                 group=None,
+                 concurrency=CONCURRENCY,
+                 rate=None,
+                 once=False):
+    """
+    Renews nodes for days as they come within window seconds of their end
+    of life, with one payment summary per batch. days and window default
+    to sporestack.renew.DAYS and WINDOW.
+    """
+    import sporestack
+    import sporestack.renew
+    if days is None:
+        days = sporestack.renew.DAYS
+    if window is None:
+        window = sporestack.renew.WINDOW
+
+    def on_unpaid(unpaid):
+        stderr(payment_summary([(node['uuid'], renewal)
+                                for node, renewal in unpaid]))
+
+    def on_renewed(node):
+        stderr('Renewed {} until {} ({})'.format(node['uuid'],
+                                                 node['end_of_life'],
+                                                 ttl(node['end_of_life'])))
+
+    def on_failed(nodes, error):
+        stderr('{} nodes not renewed, trying again later: {}'.format(
+            len(nodes), error))
+    sporestack.renew.run(node_store(),
+                         days=days,
+                         window=window,
+                         group=group,
+                         concurrency=concurrency,
+                         client=sporestack.Client(pool_size=concurrency,
+                                                  rate=rate),
+                         on_unpaid=on_unpaid,
+                         on_renewed=on_renewed,
+                         on_failed=on_failed,
+                         once=once)
+
+
 def nodemeup():
     """
     Ugly deprecation notice.
@@ -342,24 +1130,21 @@ def nodemeup():
     exit(1)
 
 
-def main():
-    options = sporestack.node_options()
-    launch_profiles = sporestack.node_get_launch_profile('index')
-
-    class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
-                          argparse.RawTextHelpFormatter):
-        """
-        This makes help honor newlines and shows defaults.
-        https://bugs.python.org/issue21633
-        http://stackoverflow.com/questions/18462610/
-        """
-        pass
-    parser = argparse.ArgumentParser(description='SporeStack.com CLI.')
+def spawn_help(refresh=False):
+    """
+    Returns help strings for spawn's --launch, --osid, --dcid and --flavor,
+    built from the (cached) node options and launch profile index.
+    """
+    import sporestack.cache
+    options = sporestack.cache.node_options(refresh=refresh)
+    launch_profiles = sporestack.cache.node_get_launch_profile('index',
+                                                               refresh=refresh)
     launch_help = ''
     for profile in launch_profiles:
         launch_help += '{}: {}: {}\n'.format(profile['name'],
                                              profile['human_name'],
                                              profile['description'])
+    launch_help += 'name@hash launches a version from "sporestack profiles".\n'
     osid_help = ''
     for osid in sorted(options['osid'], key=int):
         name = options['osid'][osid]['name']
@@ -375,19 +1160,322 @@ def main():
         disk = options['flavor'][flavor]['disk']
         vcpus = options['flavor'][flavor]['vcpu_count']
         flavor_help += help_line.format(flavor, ram, vcpus, disk)
+    return {'launch': launch_help,
+            'osid': osid_help,
+            'dcid': dcid_help,
+            'flavor': flavor_help}
+
+
+class SpawnHelpAction(argparse.Action):
+    """
+    --help for spawn. Only spawn's help needs the options catalog, so
+    it is only fetched here and not on every invocation.
+    """
+    def __init__(self,
+                 option_strings,
+                 dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS,
+                 help=None):
+        super(SpawnHelpAction, self).__init__(option_strings=option_strings,
+                                              dest=dest,
+                                              default=default,
+                                              nargs=0,
+                                              help=help)
+        self.refresh = False
+        self.catalog_actions = {}
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        try:
+            helps = spawn_help(refresh=self.refresh)
+        except Exception as error:
+            stderr('Unable to fetch node options: {}'.format(error))
+            helps = {}
+        for dest, action in self.catalog_actions.items():
+            if dest in helps:
+                action.help = helps[dest]
+        parser.print_help()
+        parser.exit()
+
+
+def add_node_arguments(subparser):
+    """
+    Adds the node settings shared by spawn and spawn-many.
+    Returns the actions whose help comes from the options catalog.
+    """
+    # Also taken before the subcommand. SUPPRESS keeps that value.
+    subparser.add_argument('--refresh-options',
+                           help='Refetch node options and launch profiles.',
+                           action='store_true',
+                           default=argparse.SUPPRESS)
+    osid_action = subparser.add_argument('--osid',
+                                         help='OSID',
+                                         type=int,
+                                         default=230)
+    dcid_action = subparser.add_argument('--dcid',
+                                         help='DCID',
+                                         type=int,
+                                         default=3)
+    flavor_action = subparser.add_argument('--flavor',
+                                           help='Flavor',
+                                           type=int,
+                                           default=29)
+    subparser.add_argument('--flavor-min-ram',
+                           help='Use the smallest flavor with this much RAM '
+                           '(MB), instead of --flavor.',
+                           type=int,
+                           default=None)
+    subparser.add_argument('--flavor-min-vcpu',
+                           help='Use the smallest flavor with this many '
+                           'VCPUs, instead of --flavor.',
+                           type=int,
+                           default=None)
+    subparser.add_argument('--days',
+                           help='Days to live: 1-28.',
+                           type=int, default=1)
+    subparser.add_argument('--endpoint',
+                           help=argparse.SUPPRESS,
+                           action='append',
+                           default=None)
+    subparser.add_argument('--paycode',
+                           help=argparse.SUPPRESS,
+                           default=None)
+    subparser.add_argument('--ssh_key',
+                           help='SSH public key.',
+                           default=default_ssh_key_path)
+    launch_action = subparser.add_argument('--launch',
+                                           help='Launch profile.',
+                                           default=None)
+    subparser.add_argument('--sporestackfile',
+                           help='SporeStack JSON file.',
+                           default=None)
+    subparser.add_argument('--cloudinit',
+                           help='cloudinit file.',
+                           default=None)
+    subparser.add_argument('--group',
+                           help='Arbitrary group to associate node with',
+                           default=None)
+    subparser.add_argument('--queue',
+                           help='Queue for "sporestack worker" instead of '
+                           'spawning now.',
+                           action='store_true')
+    subparser.add_argument('--timings',
+                           help='Print how long each phase took.',
+                           action='store_true')
+    subparser.add_argument('--metrics',
+                           help='File to write metrics to.',
+                           default=None)
+    subparser.add_argument('--metrics-format',
+                           help='prometheus is written at the end, jsonl '
+                           'as events happen.',
+                           choices=('prometheus', 'jsonl'),
+                           default='prometheus')
+    return {'launch': launch_action,
+            'osid': osid_action,
+            'dcid': dcid_action,
+            'flavor': flavor_action}
+
+
+def main():
+    # Parsed up front so spawn's help can honor it. Only spawn, spawn-many
+    # and quote use the catalog, each refreshing it once as it's needed.
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument('--refresh-options',
+                            help='Refetch node options and launch profiles.',
+                            action='store_true')
+    pre_args, _ = pre_parser.parse_known_args()
+
+    class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
+                          argparse.RawTextHelpFormatter):
+        """
+        This makes help honor newlines and shows defaults.
+        https://bugs.python.org/issue21633
+        http://stackoverflow.com/questions/18462610/
+        """
+        pass
+    parser = argparse.ArgumentParser(description='SporeStack.com CLI.',
+                                     parents=[pre_parser])
+    parser.add_argument('--profile',
+                        help='Profile the command, writing pstats to this '
+                        'file and printing a summary.',
+                        metavar='PSTATS',
+                        default=None)
+    parser.add_argument('--trace-alloc',
+                        help='Trace memory allocations and print where they '
+                        'grew most.',
+                        action='store_true')
     subparser = parser.add_subparsers()
     spawn_subparser = subparser.add_parser('spawn',
                                            help='Spawns a node.',
-                                           formatter_class=CustomFormatter)
+                                           formatter_class=CustomFormatter,
+                                           add_help=False)
+    spawn_help_action = spawn_subparser.add_argument(
+        '-h', '--help',
+        help='show this help message and exit',
+        action=SpawnHelpAction)
+    spawn_help_action.refresh = pre_args.refresh_options
     spawn_subparser.set_defaults(func=spawn_wrapper)
     list_subparser = subparser.add_parser('list', help='Lists nodes.')
-    list_subparser.set_defaults(func=list)
+    list_subparser.set_defaults(func=list_wrapper)
+    list_subparser.add_argument('--refresh',
+                                help='Look every node up again, updating '
+                                'what we have. Never renews or pays.',
+                                action='store_true')
+    list_subparser.add_argument('--format',
+                                help='json is one object a line.',
+                                choices=('text', 'json', 'csv'),
+                                default='text')
+    list_subparser.add_argument('--concurrency',
+                                help='Requests to make at once with '
+                                '--refresh.',
+                                type=int,
+                                default=CONCURRENCY)
+    list_subparser.add_argument('--rate',
+                                help='Requests a second with --refresh.',
+                                type=float,
+                                default=REFRESH_RATE)
+    prune_subparser = subparser.add_parser('prune',
+                                           help='Forgets expired nodes.')
+    prune_subparser.set_defaults(func=prune)
+    profiles_subparser = subparser.add_parser(
+        'profiles',
+        help='Lists launch profile versions, for pinning with '
+        '--launch name@hash.')
+    profiles_subparser.set_defaults(func=profiles)
+    exec_subparser = subparser.add_parser(
+        'exec',
+        help='Runs a script on every node in a group.')
+    exec_subparser.set_defaults(func=execute_wrapper)
+    exec_subparser.add_argument('--group',
+                                help='Group to run the script on.',
+                                required=True)
+    exec_subparser.add_argument('--script',
+                                help='Script file, fed to ssh as stdin.',
+                                required=True)
+    exec_subparser.add_argument('--concurrency',
+                                help='Nodes to run on at once.',
+                                type=int,
+                                default=CONCURRENCY)
+    exec_subparser.add_argument('--port',
+                                help='Port ssh listens on.',
+                                type=int,
+                                default=22)
+    worker_subparser = subparser.add_parser(
+        'worker',
+        help='Spawns nodes queued with --queue, resuming unfinished ones.')
+    worker_subparser.set_defaults(func=worker_wrapper)
+    worker_subparser.add_argument('--concurrency',
+                                  help='Nodes to work on at once.',
+                                  type=int,
+                                  default=CONCURRENCY)
+    worker_subparser.add_argument('--once',
+                                  help='Exit when no jobs are left instead '
+                                  'of waiting for more.',
+                                  action='store_true')
+    worker_subparser.add_argument('--payment-timeout',
+                                  help='Seconds a node gets to be paid for '
+                                  'and built before its job is failed.',
+                                  type=float,
+                                  default=None)
+    jobs_subparser = subparser.add_parser(
+        'jobs',
+        help='Lists queued spawns and their states.')
+    jobs_subparser.set_defaults(func=jobs)
+    quote_subparser = subparser.add_parser(
+        'quote',
+        help='Prices flavors in each dcid from unpaid /node answers for '
+        'throwaway UUIDs, without spawning anything.')
+    quote_subparser.set_defaults(func=quote_wrapper)
+    quote_subparser.add_argument('--days',
+                                 help='Days to price, can be given more '
+                                 'than once. Default: {}.'.format(
+                                     ', '.join([str(days) for days
+                                                in QUOTE_DAYS])),
+                                 type=int,
+                                 action='append',
+                                 default=None)
+    quote_subparser.add_argument('--osid', type=int, default=None)
+    quote_subparser.add_argument('--dcid',
+                                 help='Only this dcid, can be given more '
+                                 'than once.',
+                                 type=int,
+                                 action='append',
+                                 default=None)
+    quote_subparser.add_argument('--flavor',
+                                 help='Only this flavor, can be given more '
+                                 'than once.',
+                                 type=int,
+                                 action='append',
+                                 default=None)
+    quote_subparser.add_argument('--sort',
+                                 help='Cheapest first by this: satoshis, '
+                                 'per_day, per_vcpu_day or per_gb_ram_day.',
+                                 default='per_day')
+    quote_subparser.add_argument('--format',
+                                 help='json is one object a line.',
+                                 choices=('text', 'json', 'csv'),
+                                 default='text')
+    quote_subparser.add_argument('--concurrency',
+                                 help='Requests to make at once.',
+                                 type=int,
+                                 default=CONCURRENCY)
+    quote_subparser.add_argument('--rate',
+                                 help='Requests a second, at most.',
+                                 type=float,
+                                 default=None)
+    quote_subparser.add_argument('--refresh',
+                                 help='Ignore cached quotes.',
+                                 action='store_true')
+    quote_subparser.add_argument('--sweep',
+                                 help='Quote each of --days instead of '
+                                 'assuming prices are proportional to days. '
+                                 'Registers a throwaway node for each '
+                                 'flavor, dcid and days.',
+                                 action='store_true')
+    quote_subparser.add_argument('--endpoint',
+                                 help=argparse.SUPPRESS,
+                                 action='append',
+                                 default=None)
+    renew_subparser = subparser.add_parser(
+        'renew-daemon',
+        help='Renews nodes as they near their end of life.')
+    renew_subparser.set_defaults(func=renew_daemon_wrapper)
+    renew_subparser.add_argument('--days',
+                                 help='Days to renew each node for.',
+                                 type=int,
+                                 default=None)
+    renew_subparser.add_argument('--window',
+                                 help='Seconds before end of life to renew.',
+                                 type=int,
+                                 default=None)
+    renew_subparser.add_argument('--group',
+                                 help='Only renew nodes in this group.',
+                                 default=None)
+    renew_subparser.add_argument('--concurrency',
+                                 help='Requests to make at once.',
+                                 type=int,
+                                 default=CONCURRENCY)
+    renew_subparser.add_argument('--rate',
+                                 help='Requests a second, at most.',
+                                 type=float,
+                                 default=None)
+    renew_subparser.add_argument('--once',
+                                 help='Renew what is due and exit, for cron.',
+                                 action='store_true')
     ssh_subparser = subparser.add_parser('ssh',
                                          help='Connect to node.')
     ssh_subparser.set_defaults(func=ssh_wrapper)
     ssh_subparser.add_argument('uuid', help='UUID of node to connect to.')
     ssh_subparser.add_argument('--stdin',
-                               help='Send to stdin and return stdout',
+                               help='Send to stdin and print output as it '
+                               'arrives. - sends our stdin.',
+                               default=None)
+    ssh_subparser.add_argument('--timeout',
+                               help='Seconds --stdin may run for.',
+                               type=float,
+                               default=None)
+    ssh_subparser.add_argument('--idle-timeout',
+                               help='Seconds --stdin may go without output.',
+                               type=float,
                                default=None)
 
     json_extractor_help = 'Helps you extract fields from json files.'
@@ -434,47 +1522,57 @@ def main():
                                 type=int,
                                 default=29)
 
-    spawn_subparser.add_argument('--osid',
-                                 help=osid_help,
-                                 type=int,
-                                 default=230)
-    spawn_subparser.add_argument('--dcid', help=dcid_help, type=int, default=3)
-    spawn_subparser.add_argument('--flavor',
-                                 help=flavor_help,
-                                 type=int,
-                                 default=29)
-    spawn_subparser.add_argument('--days',
-                                 help='Days to live: 1-28.',
-                                 type=int, default=1)
+    spawn_help_action.catalog_actions = add_node_arguments(spawn_subparser)
     spawn_subparser.add_argument('--uuid',
-                                 help=argparse.SUPPRESS,
-                                 default=str(random_uuid()))
-    spawn_subparser.add_argument('--endpoint',
                                  help=argparse.SUPPRESS,
                                  default=None)
-    spawn_subparser.add_argument('--paycode',
-                                 help=argparse.SUPPRESS,
-                                 default=None)
-    default_ssh_key_path = '{}/.ssh/id_rsa.pub'.format(os.getenv('HOME'))
-    spawn_subparser.add_argument('--ssh_key',
-                                 help='SSH public key.',
-                                 default=default_ssh_key_path)
-    spawn_subparser.add_argument('--launch',
-                                 help=launch_help,
-                                 default=None)
-    spawn_subparser.add_argument('--sporestackfile',
-                                 help='SporeStack JSON file.',
-                                 default=None)
-    spawn_subparser.add_argument('--cloudinit',
-                                 help='cloudinit file.',
-                                 default=None)
-    spawn_subparser.add_argument('--group',
-                                 help='Arbitrary group to associate node with',
-                                 default=None)
+
+    spawn_many_subparser = subparser.add_parser(
+        'spawn-many',
+        help='Spawns many nodes at once.',
+        formatter_class=CustomFormatter,
+        add_help=False)
+    spawn_many_help_action = spawn_many_subparser.add_argument(
+        '-h', '--help',
+        help='show this help message and exit',
+        action=SpawnHelpAction)
+    spawn_many_help_action.refresh = pre_args.refresh_options
+    spawn_many_subparser.set_defaults(func=spawn_many_wrapper)
+    spawn_many_help_action.catalog_actions = add_node_arguments(
+        spawn_many_subparser)
+    spawn_many_subparser.add_argument('--count',
+                                      help='Number of nodes to spawn.',
+                                      type=int,
+                                      required=True)
+    spawn_many_subparser.add_argument('--concurrency',
+                                      help='Requests to make at once.',
+                                      type=int,
+                                      default=CONCURRENCY)
+    spawn_many_subparser.add_argument('--rate',
+                                      help='Requests a second, at most. '
+                                      'None is no limit.',
+                                      type=float,
+                                      default=None)
     args = parser.parse_args()
-    # This calls the function or wrapper function, depending on what we set
-    # above.
-    args.func(args)
+    if args.profile is None and args.trace_alloc is False:
+        # This calls the function or wrapper function, depending on what we
+        # set above.
+        args.func(args)
+        return
+    import sporestack.profiling
+    profiling = sporestack.profiling.profiling(
+        path=args.profile,
+        trace_alloc=args.trace_alloc,
+        profile=args.profile is not None)
+    session = None
+    try:
+        with profiling as session:
+            args.func(args)
+    finally:
+        # Even on ctrl+c or exit(), when it's often most wanted. Not if
+        # profiling didn't start.
+        if session is not None:
+            stderr(session.report())
 
 if __name__ == '__main__':
     main()
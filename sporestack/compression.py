@@ -0,0 +1,122 @@
+"""
+HTTP content codings.
+
+Responses are asked for with Accept-Encoding: gzip and decompressed as
+they're read. Request bodies of MIN_SIZE bytes or more are compressed once
+the endpoint has said, with Accept-Encoding on a response, that it takes a
+coding we have: zstd if the zstandard package is installed, or gzip.
+"""
+
+import httplib
+import zlib
+
+ACCEPT_ENCODING = 'gzip'
+# Smaller request bodies aren't worth compressing.
+MIN_SIZE = 1024
+CHUNK_SIZE = 16384
+GZIP_LEVEL = 6
+# The zstandard module, None without it, or False until we've looked.
+_zstandard_module = False
+
+
+def _zstandard():
+    global _zstandard_module
+    if _zstandard_module is False:
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = None
+        _zstandard_module = zstandard
+    return _zstandard_module
+
+
+def request_codings():
+    """
+    Returns the codings we can compress request bodies with, best first.
+    """
+    if _zstandard() is None:
+        return ['gzip']
+    return ['zstd', 'gzip']
+
+
+def parse_accept_encoding(header):
+    """
+    Returns the set of codings in an Accept-Encoding header, leaving out
+    those with q=0.
+    """
+    codings = set()
+    for item in header.split(','):
+        parameters = item.split(';')
+        coding = parameters[0].strip().lower()
+        quality = 1.0
+        for parameter in parameters[1:]:
+            name, _, value = parameter.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if coding != '' and quality > 0:
+            codings.add(coding)
+    return codings
+
+
+def choose(accepted):
+    """
+    Returns the best coding in accepted we can compress with, or None.
+    """
+    for coding in request_codings():
+        if coding in accepted:
+            return coding
+    return None
+
+
+def compress(data, coding):
+    if coding == 'gzip':
+        compressor = zlib.compressobj(GZIP_LEVEL,
+                                      zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif coding == 'zstd':
+        return _zstandard().ZstdCompressor().compress(data)
+    raise ValueError('Unsupported coding: {}'.format(coding))
+
+
+def decompress(data, coding):
+    if coding in (None, 'identity'):
+        return data
+    elif coding == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif coding == 'zstd':
+        return _zstandard().ZstdDecompressor().decompress(data)
+    raise ValueError('Unsupported coding: {}'.format(coding))
+
+
+def read(response):
+    """
+    Reads an httplib response's body, decompressing it chunk by chunk as
+    it arrives. Raises httplib.HTTPException if it can't be decompressed.
+    """
+    coding = response.getheader('content-encoding', 'identity').lower()
+    if coding == 'identity':
+        return response.read()
+    if coding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif coding == 'deflate':
+        decompressor = zlib.decompressobj()
+    else:
+        response.read()
+        raise httplib.HTTPException(
+            'Unsupported Content-Encoding: {}'.format(coding))
+    chunks = []
+    try:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if chunk == '':
+                break
+            chunks.append(decompressor.decompress(chunk))
+        chunks.append(decompressor.flush())
+    except zlib.error as error:
+        raise httplib.HTTPException(
+            'Bad {} response body: {}'.format(coding, error))
+    return ''.join(chunks)
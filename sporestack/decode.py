@@ -0,0 +1,52 @@
+"""
+Decoding for API responses and SporeStack files.
+
+JSON is parsed with the fastest JSON library installed (ujson, then
+simplejson, then json). YAML is only used for YAML, and imported only
+when needed: without libyaml it's pure Python and many times slower.
+"""
+
+try:
+    import ujson as json_backend
+except ImportError:
+    try:
+        import simplejson as json_backend
+    except ImportError:
+        import json as json_backend
+
+BACKEND = json_backend.__name__
+
+YAML_TYPES = ('application/x-yaml', 'application/yaml', 'text/yaml')
+
+
+def yaml_loads(data):
+    import yaml
+    return yaml.safe_load(data)
+
+
+def loads(data, content_type=None):
+    """
+    Parses data as JSON, or as YAML if content_type says so.
+    Without a JSON content_type, data that isn't JSON is tried as YAML.
+    """
+    if content_type is not None:
+        content_type = content_type.split(';')[0].strip().lower()
+        if content_type in YAML_TYPES:
+            return yaml_loads(data)
+    try:
+        return json_backend.loads(data)
+    except ValueError:
+        if content_type == 'application/json':
+            raise
+        return yaml_loads(data)
+
+
+def load_file(path):
+    """
+    Parses a JSON or YAML file. .json files are only parsed as JSON.
+    """
+    with open(path) as data_file:
+        data = data_file.read()
+    if path.endswith('.json'):
+        return json_backend.loads(data)
+    return loads(data)
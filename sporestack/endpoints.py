@@ -0,0 +1,99 @@
+"""
+Choosing between several SporeStack endpoints, like mirrors and onion
+gateways.
+
+Requests go to the healthy endpoint with the lowest EWMA latency, endpoints
+not yet measured going first so each gets measured. An endpoint that times
+out or answers 5xx or 429 is skipped for COOLDOWN seconds. Once a node has
+been asked about at an endpoint, it keeps being asked there while that
+endpoint is healthy.
+"""
+
+from time import time
+import threading
+
+# Weight of the newest latency sample.
+ALPHA = 0.3
+# Seconds a failed endpoint is skipped for.
+COOLDOWN = 30
+
+
+class EndpointSet(object):
+    """
+    A set of endpoints with their health. Safe to share between threads.
+    """
+    def __init__(self, endpoints, alpha=ALPHA, cooldown=COOLDOWN):
+        if len(endpoints) == 0:
+            raise ValueError('EndpointSet needs at least one endpoint.')
+        self.endpoints = [endpoint.rstrip('/') for endpoint in endpoints]
+        self.alpha = alpha
+        self.cooldown = cooldown
+        # endpoint: EWMA latency in seconds
+        self.latency = {}
+        # endpoint: time it's healthy again
+        self.down_until = {}
+        # key, like a node's UUID: endpoint
+        self._sticky = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def __str__(self):
+        return ' '.join(self.endpoints)
+
+    def healthy(self, endpoint, now=None):
+        if now is None:
+            now = time()
+        return self.down_until.get(endpoint, 0) <= now
+
+    def choose(self, key=None):
+        """
+        Returns the endpoint to use, for key if given.
+        """
+        now = time()
+        with self._lock:
+            sticky = self._sticky.get(key)
+            if sticky is not None and self.healthy(sticky, now):
+                return sticky
+            healthy = [endpoint for endpoint in self.endpoints
+                       if self.healthy(endpoint, now)]
+            if len(healthy) == 0:
+                # All down: try whichever comes back first.
+                return min(self.endpoints,
+                           key=lambda endpoint: self.down_until[endpoint])
+            return min(healthy,
+                       key=lambda endpoint: self.latency.get(endpoint, 0))
+
+    def record(self, endpoint, seconds, key=None):
+        """
+        Records a successful request to endpoint that took seconds, and
+        makes endpoint key's endpoint.
+        """
+        with self._lock:
+            if endpoint in self.latency:
+                seconds = self.alpha * seconds + \
+                    (1 - self.alpha) * self.latency[endpoint]
+            self.latency[endpoint] = seconds
+            self.down_until.pop(endpoint, None)
+            if key is not None:
+                self._sticky[key] = endpoint
+
+    def fail(self, endpoint):
+        """
+        Marks endpoint as down for cooldown seconds.
+        """
+        with self._lock:
+            self.down_until[endpoint] = time() + self.cooldown
+
+
+def endpoint_set(endpoints):
+    """
+    Returns None, the endpoint, or an EndpointSet, for a list of endpoints
+    that may be empty or None.
+    """
+    if endpoints is None or len(endpoints) == 0:
+        return None
+    if len(endpoints) == 1:
+        return endpoints[0]
+    return EndpointSet(endpoints)
@@ -0,0 +1,135 @@
+"""
+Concurrent SporeStack API calls, for launching and watching many nodes.
+
+There's no asyncio on Python 2, so calls run on a bounded thread pool that
+shares one Client (and so one connection pool). Single calls return
+multiprocessing AsyncResults. Polling many nodes is done in rounds over the
+pool rather than with a sleeping thread per node.
+"""
+
+from multiprocessing.pool import ThreadPool
+
+import sporestack
+from sporestack import CONCURRENCY
+from sporestack.poll import Poller, node_phase
+
+
+class Fleet(object):
+    """
+    Runs at most concurrency API calls at once.
+    """
+    def __init__(self, concurrency=CONCURRENCY, client=None):
+        if client is None:
+            client = sporestack.Client(pool_size=concurrency)
+        self.client = client
+        self.concurrency = concurrency
+        self._pool = ThreadPool(concurrency)
+
+    def node(self, **kwargs):
+        """
+        AsyncResult of Client.node(**kwargs)
+        """
+        return self._pool.apply_async(self.client.node, kwds=kwargs)
+
+    def node_options(self):
+        """
+        AsyncResult of Client.node_options()
+        """
+        return self._pool.apply_async(self.client.node_options)
+
+    def node_get_launch_profile(self, profile):
+        """
+        AsyncResult of Client.node_get_launch_profile(profile)
+        """
+        return self._pool.apply_async(self.client.node_get_launch_profile,
+                                      (profile,))
+
+    def imap(self, func, iterable):
+        """
+        Applies func to each item on the pool, yielding results as they
+        finish.
+        """
+        return self._pool.imap_unordered(func, iterable)
+
+    def nodes(self, requests):
+        """
+        Calls node() once for each dict of node() arguments in requests.
+        Yields (request, node) as each returns.
+        """
+        def call(request):
+            return request, self.client.node(**request)
+        return self.imap(call, requests)
+
+    def poll(self, requests, poller=None, until=None):
+        """
+        Polls node() for each dict of node() arguments in requests until
+        every node is done: until(request, node) is True, by default once
+        the node is created. Yields (request, node) for every poll.
+        Each request is encoded once, see Client.prepare_node().
+
+        Rounds are spaced by poller, a sporestack.poll.Poller, in the
+        payment phase while any node is unpaid.
+        """
+        if poller is None:
+            poller = Poller()
+        if until is None:
+            def until(request, node):
+                return node.creation_status is True
+
+        def call(prepared):
+            return prepared, prepared[1].poll()
+        pending = [(request, self.client.prepare_node(**request))
+                   for request in requests]
+        while len(pending) != 0:
+            still_pending = []
+            phase = 'building'
+            for prepared, node in self.imap(call, pending):
+                request = prepared[0]
+                if until(request, node) is not True:
+                    still_pending.append(prepared)
+                    if node_phase(node) == 'payment':
+                        phase = 'payment'
+                yield request, node
+            pending = still_pending
+            if len(pending) != 0:
+                poller.sleep(phase)
+
+    def wait_until_created(self, requests, poller=None, callback=None):
+        """
+        Polls like poll() and returns a list of (request, node) for created
+        nodes. callback(request, node), if given, is called for every poll.
+        """
+        created = []
+        for request, node in self.poll(requests, poller=poller):
+            if callback is not None:
+                callback(request, node)
+            if node.creation_status is True:
+                created.append((request, node))
+        return created
+
+    def close(self):
+        """
+        Waits for outstanding calls and closes the pool.
+        """
+        self._pool.close()
+        self._pool.join()
+        self.client.close()
+
+
+def wait_until_created(poller=None, callback=None, client=None, **kwargs):
+    """
+    Polls node(**kwargs) until the node is created and returns it.
+    callback(node), if given, is called for every poll.
+    """
+    if client is None:
+        client = sporestack.default_client()
+    if poller is None:
+        poller = Poller()
+    prepared_node = client.prepare_node(**kwargs)
+    while True:
+        node = prepared_node.poll()
+        if callback is not None:
+            callback(node)
+        if node.creation_status is True:
+            return node
+        poller.sleep(node_phase(node))
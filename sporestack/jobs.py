@@ -0,0 +1,443 @@
+"""
+Spawn job journal and workers.
+
+Spawns queued with spawn --queue are kept in a SQLite journal with their
+settings, and run by sporestack worker processes. A job goes through
+
+queued -> pending_payment -> building -> reachable -> done
+
+and is checkpointed at each step, reachable only when it has a postlaunch
+script to run. failed jobs keep their error. A job is claimed by the
+process working on it; jobs claimed by processes that have gone away are
+claimed again and resumed from their last checkpoint. Asking for a node
+again by its UUID is safe, so resuming polls picks up where the last
+worker left off. A postlaunch script interrupted midway is run again.
+
+A job that runs into a network error, or a 429 or 5xx answer, is put back
+to be retried after a backoff that doubles with each attempt, and failed
+after max_attempts. Any other error fails it straight away, as does a node
+that isn't paid for and built within PAYMENT_TIMEOUT, so unpaid jobs don't
+hold a worker thread forever.
+"""
+
+from time import time
+import errno
+import httplib
+import json
+import os
+import socket
+import sqlite3
+import threading
+
+import sporestack
+from sporestack import CONCURRENCY, DOT_FILE_PATH
+from sporestack import endpoints
+from sporestack import probe
+from sporestack import remote
+from sporestack.poll import Poller, PollTimeout, node_phase
+from sporestack.store import node_record
+
+DATABASE = 'jobs.sqlite'
+
+QUEUED = 'queued'
+PENDING_PAYMENT = 'pending_payment'
+BUILDING = 'building'
+REACHABLE = 'reachable'
+DONE = 'done'
+FAILED = 'failed'
+FINISHED = (DONE, FAILED)
+
+# Seconds a worker waits before looking for new jobs.
+IDLE = 5
+# Attempts at a job that keeps running into network errors before it's
+# failed, and seconds before the first retry, doubled after each.
+MAX_ATTEMPTS = 5
+BACKOFF = 5
+# Seconds a job's node gets to be paid for and built, and a created node
+# to open its port, before the job is failed.
+PAYMENT_TIMEOUT = 6 * 3600
+REACHABLE_TIMEOUT = 900
+
+# Keys of a job's request passed to Client.prepare_node(). The rest
+# (endpoint, launch_profile, group, postlaunch) are for the job.
+NODE_ARGUMENTS = ('days', 'unique', 'sshkey', 'cloudinit', 'startupscript',
+                  'osid', 'dcid', 'flavor', 'paycode', 'encoded_cloudinit')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    uuid TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    request TEXT NOT NULL,
+    node TEXT,
+    worker INTEGER,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    retry_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+'''
+
+# Columns added since the first journals, with their definitions.
+ADDED_COLUMNS = (('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+                 ('retry_at', 'REAL'))
+
+COLUMNS = ('uuid, state, request, node, worker, error, created, updated, '
+           'attempts, retry_at')
+
+
+def _row_to_job(row):
+    job = dict(zip(('uuid', 'state', 'request', 'node', 'worker', 'error',
+                    'created', 'updated', 'attempts', 'retry_at'), row))
+    job['request'] = json.loads(job['request'])
+    if job['node'] is not None:
+        job['node'] = json.loads(job['node'])
+    return job
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def _retryable(error):
+    """
+    Network errors and 429 and 5xx answers are worth retrying. Others, like
+    ssh not being installed, aren't.
+    """
+    if isinstance(error, (socket.error, httplib.HTTPException)):
+        return True
+    return getattr(error, 'retryable', False) is True
+
+
+class JobQueue(object):
+    """
+    The journal, shared by every worker process. Jobs are dicts of uuid,
+    state, request (node() arguments and the job's settings), node (the
+    last /node answer), worker (the pid working on it), error, created,
+    updated, attempts (retries since the job last made progress) and
+    retry_at (when it can be retried). Safe to share between threads.
+    """
+    def __init__(self,
+                 directory=DOT_FILE_PATH,
+                 max_attempts=MAX_ATTEMPTS,
+                 backoff=BACKOFF):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        self.path = os.path.join(directory, DATABASE)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path,
+                                           timeout=30,
+                                           check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(SCHEMA)
+            columns = [row[1] for row in self._connection.execute(
+                'PRAGMA table_info(jobs)')]
+            for column, definition in ADDED_COLUMNS:
+                if column not in columns:
+                    self._connection.execute(
+                        'ALTER TABLE jobs ADD COLUMN {} {}'.format(
+                            column, definition))
+
+    def _select(self, where='', parameters=()):
+        query = 'SELECT {} FROM jobs {} ORDER BY created'.format(COLUMNS,
+                                                                 where)
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [_row_to_job(row) for row in rows]
+
+    def put(self, uuid, request):
+        """
+        Queues a job for request, a dict of node() arguments plus endpoint
+        (a list), launch_profile, group and postlaunch.
+        """
+        now = time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO jobs ({}) VALUES '
+                '(?, ?, ?, NULL, NULL, NULL, ?, ?, 0, NULL)'.format(COLUMNS),
+                (uuid, QUEUED, json.dumps(request), now, now))
+
+    def get(self, uuid):
+        jobs = self._select('WHERE uuid = ?', (uuid,))
+        if len(jobs) == 0:
+            return None
+        return jobs[0]
+
+    def find(self, state=None):
+        """
+        Returns jobs in state, or all of them, oldest first.
+        """
+        if state is None:
+            return self._select()
+        return self._select('WHERE state = ?', (state,))
+
+    def claim(self):
+        """
+        Claims the oldest unfinished job no live process is working on, and
+        that isn't waiting to be retried, and returns it. Returns None if
+        there isn't one.
+        """
+        with self._lock:
+            candidates = self._connection.execute(
+                'SELECT uuid, worker FROM jobs WHERE state NOT IN (?, ?) '
+                'AND (retry_at IS NULL OR retry_at <= ?) ORDER BY created',
+                FINISHED + (time(),)).fetchall()
+        for uuid, worker in candidates:
+            if worker is not None and _alive(worker):
+                continue
+            with self._lock, self._connection:
+                cursor = self._connection.execute(
+                    'UPDATE jobs SET worker = ? WHERE uuid = ? AND '
+                    'worker IS ?', (self.pid, uuid, worker))
+            if cursor.rowcount == 1:
+                return self.get(uuid)
+        return None
+
+    def checkpoint(self, uuid, state, node=None, error=None):
+        """
+        Records that job uuid reached state, with node, a Node, if given.
+        Finished jobs are released. Its attempts start over.
+        """
+        assignments = ('state = ?, updated = ?, error = ?, attempts = 0, '
+                       'retry_at = NULL')
+        parameters = [state, time(), error]
+        if node is not None:
+            assignments += ', node = ?'
+            parameters.append(json.dumps(node.to_dict()))
+        if state in FINISHED:
+            assignments += ', worker = NULL'
+        parameters.append(uuid)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE jobs SET {} WHERE uuid = ?'.format(assignments),
+                parameters)
+
+    def defer(self, uuid, error):
+        """
+        Releases job uuid, with error, to be retried after backoff seconds,
+        doubled for each earlier attempt. Returns False, leaving the job
+        as it is, if it's had max_attempts.
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                'SELECT attempts FROM jobs WHERE uuid = ?', (uuid,)).fetchone()
+            attempts = row[0] + 1
+            if attempts >= self.max_attempts:
+                return False
+            now = time()
+            self._connection.execute(
+                'UPDATE jobs SET attempts = ?, retry_at = ?, error = ?, '
+                'updated = ?, worker = NULL WHERE uuid = ?',
+                (attempts,
+                 now + self.backoff * 2 ** (attempts - 1),
+                 error,
+                 now,
+                 uuid))
+        return True
+
+    def next_retry(self):
+        """
+        Returns when the next job waiting to be retried can be, or None.
+        """
+        with self._lock:
+            return self._connection.execute(
+                'SELECT MIN(retry_at) FROM jobs WHERE state NOT IN (?, ?) '
+                'AND retry_at > ?', FINISHED + (time(),)).fetchone()[0]
+
+    def release(self, uuid=None):
+        """
+        Gives up our claim on job uuid, or on all our jobs.
+        """
+        with self._lock, self._connection:
+            if uuid is None:
+                self._connection.execute(
+                    'UPDATE jobs SET worker = NULL WHERE worker = ?',
+                    (self.pid,))
+            else:
+                self._connection.execute(
+                    'UPDATE jobs SET worker = NULL WHERE uuid = ? AND '
+                    'worker = ?', (uuid, self.pid))
+
+    def counts(self):
+        """
+        Returns a dict of state: number of jobs.
+        """
+        with self._lock:
+            return dict(self._connection.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def node_state(node):
+    """
+    The job state a /node answer puts a job in, None once it's created.
+    """
+    if node.payment_status is False:
+        return PENDING_PAYMENT
+    if node.creation_status is not True:
+        return BUILDING
+    return None
+
+
+def process(job,
+            queue,
+            store,
+            client=None,
+            on_state=None,
+            port=22,
+            reachable_timeout=REACHABLE_TIMEOUT,
+            payment_timeout=PAYMENT_TIMEOUT):
+    """
+    Runs job from its last checkpoint until it's done or failed, saving its
+    node in store, a sporestack.store.NodeStore, once it's created.
+    on_state(job, state, node) is called at every checkpoint. Errors worth
+    retrying leave the job at its checkpoint, deferred, and are raised.
+    The job fails if its node isn't paid for and created within
+    payment_timeout seconds, or its port isn't open after
+    reachable_timeout seconds.
+    """
+    if client is None:
+        client = sporestack.default_client()
+    request = job['request']
+    uuid = job['uuid']
+    state = job['state']
+
+    def checkpoint(new_state, node=None, error=None):
+        queue.checkpoint(uuid, new_state, node, error)
+        if on_state is not None:
+            on_state(job, new_state, node)
+    try:
+        if state in (QUEUED, PENDING_PAYMENT, BUILDING):
+            arguments = dict([(key, request.get(key))
+                              for key in NODE_ARGUMENTS])
+            prepared = client.prepare_node(
+                endpoint=endpoints.endpoint_set(request.get('endpoint')),
+                **arguments)
+            poller = Poller(deadline=payment_timeout)
+            while True:
+                node = prepared.poll()
+                new_state = node_state(node)
+                if new_state is None:
+                    break
+                if new_state != state:
+                    state = new_state
+                    checkpoint(state, node)
+                try:
+                    poller.sleep(node_phase(node))
+                except PollTimeout:
+                    checkpoint(FAILED,
+                               node,
+                               error='still {} after {} seconds'.format(
+                                   state, payment_timeout))
+                    return
+            store.put(node_record(
+                uuid,
+                node,
+                launch_profile=request.get('launch_profile'),
+                group=request.get('group'),
+                days=request.get('days')))
+            if request.get('postlaunch') is None:
+                checkpoint(DONE, node)
+                return
+            try:
+                probe.wait_for_port(store.get(uuid),
+                                    port,
+                                    deadline=reachable_timeout)
+            except PollTimeout:
+                checkpoint(FAILED,
+                           error='port {} not open after {} seconds'.format(
+                               port, reachable_timeout))
+                return
+            state = REACHABLE
+            checkpoint(state, node)
+        if state == REACHABLE:
+            results = remote.execute([store.get(uuid)],
+                                     request['postlaunch'],
+                                     port=port)
+            return_code = results[0][1]
+            if return_code != 0:
+                checkpoint(FAILED,
+                           error='postlaunch exit code {}'.format(
+                               return_code))
+                return
+            checkpoint(DONE)
+    except Exception as error:
+        if _retryable(error) is False:
+            checkpoint(FAILED, error=str(error))
+        elif queue.defer(uuid, str(error)) is True:
+            raise
+        else:
+            checkpoint(FAILED, error='gave up after {} attempts: {}'.format(
+                queue.max_attempts, error))
+
+
+def run(queue,
+        store,
+        concurrency=CONCURRENCY,
+        client=None,
+        on_state=None,
+        on_error=None,
+        once=False,
+        idle=IDLE,
+        port=22,
+        reachable_timeout=REACHABLE_TIMEOUT,
+        payment_timeout=PAYMENT_TIMEOUT):
+    """
+    Works through jobs in queue, concurrency at a time. on_state, port,
+    reachable_timeout and payment_timeout are passed to process(), and
+    on_error(job, error) is called with errors it raises.
+    With once, returns when there are no jobs left to claim or waiting to
+    be retried, instead of waiting for more.
+    """
+    if client is None:
+        client = sporestack.Client(pool_size=concurrency)
+    stop = threading.Event()
+
+    def work():
+        while not stop.is_set():
+            job = queue.claim()
+            if job is None:
+                retry_at = queue.next_retry()
+                if retry_at is None:
+                    if once is True:
+                        return
+                    stop.wait(idle)
+                else:
+                    stop.wait(min(idle, max(0, retry_at - time())))
+                continue
+            try:
+                process(job,
+                        queue,
+                        store,
+                        client,
+                        on_state,
+                        port,
+                        reachable_timeout,
+                        payment_timeout)
+            except Exception as error:
+                if on_error is not None:
+                    on_error(job, error)
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in threads:
+            # A timeout, so ctrl+c gets through.
+            while thread.is_alive():
+                thread.join(1)
+    finally:
+        stop.set()
+        queue.release()
+        client.close()
@@ -0,0 +1,244 @@
+"""
+Instrumentation hooks, timers and metrics export.
+
+Hooks are called as hook(event, data) for every event emitted:
+
+request_start: method, path, endpoint, attempt
+request_end: method, path, endpoint, attempt, status, seconds, error
+    status is None if the request failed, error the exception text.
+node_status: unique, payment_status, creation_status
+    When a polled node's payment or creation status changes.
+probe_attempt: address, port, connected, seconds
+timer: name, seconds
+    A phase, like payment or building, finished.
+
+With no hooks added emitting costs a function call.
+"""
+
+from contextlib import contextmanager
+from time import time
+import json
+import os
+import threading
+
+_hooks = []
+_hooks_lock = threading.Lock()
+
+# Upper bounds, in seconds, of the request latency histogram buckets.
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def add_hook(hook):
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+def emit(event, **data):
+    """
+    Calls every hook with event and data.
+    """
+    if len(_hooks) == 0:
+        return
+    for hook in _hooks[:]:
+        hook(event, data)
+
+
+def record(name, seconds):
+    """
+    Emits a timer event for a phase that took seconds.
+    """
+    emit('timer', name=name, seconds=seconds)
+
+
+@contextmanager
+def timer(name):
+    """
+    Emits a timer event for how long the with block took.
+    """
+    start = time()
+    try:
+        yield
+    finally:
+        record(name, time() - start)
+
+
+class Timings(object):
+    """
+    Hook that keeps timers in the order they finished, and request counts
+    and seconds per path.
+    """
+    def __init__(self):
+        self.phases = []
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event, data):
+        with self._lock:
+            if event == 'timer':
+                self.phases.append((data['name'], data['seconds']))
+            elif event == 'request_end':
+                count, seconds = self.requests.get(data['path'], (0, 0))
+                self.requests[data['path']] = (count + 1,
+                                               seconds + data['seconds'])
+
+    def report(self):
+        """
+        Returns a phase by phase breakdown, as text.
+        """
+        lines = ['Timings:']
+        for name, seconds in self.phases:
+            lines.append('  {:<20} {:>9.2f}s'.format(name, seconds))
+        for path in sorted(self.requests):
+            count, seconds = self.requests[path]
+            lines.append('  {} requests to {}, {:.2f}s'.format(
+                count, path, seconds))
+        return '\n'.join(lines)
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(name, value)
+                           for name, value in labels]) + '}'
+
+
+class Metrics(object):
+    """
+    Hook that aggregates events into Prometheus style counters and
+    histograms.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # (name, labels): value
+        self.counters = {}
+        # (name, labels): [bucket counts, count, sum]
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, tuple(labels))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.buckets), 0, 0]
+            histogram = self.histograms[key]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def __call__(self, event, data):
+        if event == 'request_end':
+            labels = (('endpoint', data['endpoint']), ('path', data['path']))
+            self.increment('sporestack_requests_total',
+                           labels + (('status', data['status']),))
+            self.observe('sporestack_request_seconds',
+                         data['seconds'],
+                         labels)
+        elif event == 'node_status':
+            self.increment('sporestack_node_transitions_total',
+                           (('payment_status', data['payment_status']),
+                            ('creation_status', data['creation_status'])))
+        elif event == 'probe_attempt':
+            self.increment('sporestack_probe_attempts_total',
+                           (('connected', data['connected']),))
+        elif event == 'timer':
+            self.observe('sporestack_phase_seconds',
+                         data['seconds'],
+                         (('phase', data['name']),))
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE {} counter'.format(name))
+                    typed.add(name)
+                lines.append('{}{} {}'.format(name, _labels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    typed.add(name)
+                bucket_counts, count, total = histogram
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    bucket_labels = labels + (('le', bound),)
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(bucket_labels), bucket_count))
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels + (('le', '+Inf'),)), count))
+                lines.append('{}_count{} {}'.format(name,
+                                                    _labels(labels),
+                                                    count))
+                lines.append('{}_sum{} {}'.format(name,
+                                                  _labels(labels),
+                                                  total))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Writes prometheus() to path atomically, as the node_exporter
+        textfile collector wants.
+        """
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(self.prometheus())
+        os.rename(temporary_path, path)
+
+
+class JsonLines(object):
+    """
+    Hook that appends every event to a file as a line of JSON.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, event, data):
+        line = dict(data)
+        line['event'] = event
+        line['time'] = time()
+        line = json.dumps(line, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+@contextmanager
+def exporting(path, format='prometheus'):
+    """
+    Exports events in the with block to path, either as JSON lines as they
+    happen or as Prometheus text at the end.
+    """
+    if format == 'jsonl':
+        hook = JsonLines(path)
+    elif format == 'prometheus':
+        hook = Metrics()
+    else:
+        raise ValueError('Unknown metrics format: {}'.format(format))
+    add_hook(hook)
+    try:
+        yield hook
+    finally:
+        remove_hook(hook)
+        if format == 'jsonl':
+            hook.close()
+        else:
+            hook.write_prometheus(path)
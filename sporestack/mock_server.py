@@ -0,0 +1,416 @@
+"""
+Local stand-in for the SporeStack API, for tests and benchmarks.
+
+Implements /node, /node/options and /launch/<profile>.json. Nodes are paid
+after polls_to_pay polls and created polls_to_create polls after that.
+With renew_window, asking for a created node within renew_window seconds of
+its end of life renews it: it's unpaid for polls_to_pay polls, then its end
+of life moves out by the days asked for. Latency and errors can be injected.
+Responses of compression.MIN_SIZE bytes or more are gzipped for clients
+that ask, and compressed request bodies are taken, unless compress is
+False. bandwidth, in bytes a second, slows down sending and receiving
+bodies like a slow link would. Nodes are priced by their flavor's VCPUs
+and RAM. With certfile, it's served over HTTPS.
+
+python -m sporestack.mock_server --port 8080
+"""
+
+from __future__ import print_function
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from hashlib import sha1
+from time import sleep, time
+import argparse
+import json
+import random
+import ssl
+import sys
+import threading
+
+from sporestack import compression
+
+# A day of a node without a flavor, or of each of a flavor's VCPUs.
+SATOSHIS_PER_DAY = 100000
+# A day of each MB of a flavor's RAM.
+SATOSHIS_PER_MB_DAY = 50
+
+OPTIONS = {'osid': {'230': {'name': 'FreeBSD 11'},
+                    '241': {'name': 'Ubuntu 16.04 x64'},
+                    '193': {'name': 'Debian 8 x64'}},
+           'dcid': {'1': {'name': 'New Jersey'},
+                    '3': {'name': 'Dallas'},
+                    '7': {'name': 'Amsterdam'}},
+           'flavor': {'29': {'ram': 768, 'disk': 15, 'vcpu_count': 1},
+                      '93': {'ram': 1024, 'disk': 25, 'vcpu_count': 1},
+                      '94': {'ram': 2048, 'disk': 40, 'vcpu_count': 2},
+                      '95': {'ram': 4096, 'disk': 60, 'vcpu_count': 2}}}
+
+LAUNCH_PROFILES = {'tor_relay': {'name': 'tor_relay',
+                                 'human_name': 'Tor relay',
+                                 'description': 'Runs a Tor relay.',
+                                 'osid': 230,
+                                 'flavor': 29,
+                                 'days': 28,
+                                 'cloudinit': '#cloud-config\n',
+                                 'startupscript': None,
+                                 'postlaunch': None}}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Unbuffered writes send headers in many small packets, which with
+    # keep-alive runs into delayed ACKs.
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data)
+        etag = '"{}"'.format(sha1(body).hexdigest())
+        if self.command == 'GET' and \
+                self.headers.get('If-None-Match') == etag:
+            status = 304
+            body = ''
+        accepted = compression.parse_accept_encoding(
+            self.headers.get('Accept-Encoding', ''))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        if self.server.compress is True:
+            self.send_header('Accept-Encoding',
+                             ', '.join(compression.request_codings()))
+            if 'gzip' in accepted and len(body) >= compression.MIN_SIZE:
+                body = compression.compress(body, 'gzip')
+                self.send_header('Content-Encoding', 'gzip')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.server.transfer(sent=len(body))
+        self.wfile.write(body)
+
+    def injected_error(self):
+        """
+        Sends an injected error if there is one. Returns True if it did.
+        """
+        error = self.server.next_error()
+        if error is None:
+            return False
+        status, retry_after = error
+        headers = {}
+        if retry_after is not None:
+            headers['Retry-After'] = str(retry_after)
+        self.send_json({'error': 'Injected error.'}, status, headers)
+        return True
+
+    def do_GET(self):
+        self.server.record(self.path)
+        if self.injected_error():
+            return
+        if self.path == '/node/options':
+            self.send_json(self.server.options)
+        elif self.path == '/launch/index.json':
+            self.send_json(self.server.launch_index())
+        elif self.path.startswith('/launch/') and self.path.endswith('.json'):
+            name = self.path[len('/launch/'):-len('.json')]
+            if name in self.server.launch_profiles:
+                self.send_json(self.server.launch_profiles[name])
+            else:
+                self.send_json({'error': 'No such profile.'}, 404)
+        else:
+            self.send_json({'error': 'Not found.'}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.server.transfer(received=len(body))
+        self.server.record(self.path)
+        if self.injected_error():
+            return
+        if self.path != '/node':
+            self.send_json({'error': 'Not found.'}, 404)
+            return
+        coding = self.headers.get('Content-Encoding')
+        if coding is not None:
+            if self.server.compress is False or \
+                    coding not in compression.request_codings():
+                self.send_json({'error': 'Unsupported Content-Encoding.'},
+                               415)
+                return
+            body = compression.decompress(body, coding)
+        try:
+            data = json.loads(body)
+            days = int(data['days'])
+            unique = data['unique']
+        except (ValueError, KeyError, TypeError):
+            self.send_json({'error': 'Invalid request.'}, 400)
+            return
+        self.send_json(self.server.poll_node(unique, days, data))
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """
+    A mock SporeStack endpoint. start() serves in a background thread.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    # The default backlog of 5 drops connections when many clients start at
+    # once, which shows up as one second SYN retransmits.
+    request_queue_size = 128
+
+    def __init__(self,
+                 host='127.0.0.1',
+                 port=0,
+                 latency=0,
+                 polls_to_pay=1,
+                 polls_to_create=1,
+                 error_rate=0,
+                 renew_window=None,
+                 options=OPTIONS,
+                 launch_profiles=LAUNCH_PROFILES,
+                 compress=True,
+                 bandwidth=None,
+                 certfile=None):
+        HTTPServer.__init__(self, (host, port), MockHandler)
+        # With certfile, a PEM file with the key and certificate, it's
+        # served over HTTPS.
+        self.context = None
+        if certfile is not None:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.context.load_cert_chain(certfile)
+        self.latency = latency
+        self.polls_to_pay = polls_to_pay
+        self.polls_to_create = polls_to_create
+        self.error_rate = error_rate
+        self.renew_window = renew_window
+        self.options = options
+        self.launch_profiles = launch_profiles
+        self.compress = compress
+        self.bandwidth = bandwidth
+        # Body bytes, as sent over the wire.
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # unique: dict of polls, days, the first and last requests, and
+        # when it was paid.
+        self.nodes = {}
+        # path: number of requests
+        self.requests = {}
+        self._errors = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server_address
+        scheme = 'http' if self.context is None else 'https'
+        return '{}://{}:{}'.format(scheme, host, port)
+
+    def get_request(self):
+        connection, address = HTTPServer.get_request(self)
+        if self.context is not None:
+            # The handshake happens on the first read, in the request's
+            # thread, so a slow client doesn't hold up accepting others.
+            connection = self.context.wrap_socket(
+                connection,
+                server_side=True,
+                do_handshake_on_connect=False)
+        return connection, address
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], ssl.SSLError):
+            # Clients hang up on kept-alive connections without closing TLS.
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        # A short poll interval keeps stop() quick.
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def record(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+        if self.latency:
+            sleep(self.latency)
+
+    def transfer(self, received=0, sent=0):
+        """
+        Counts body bytes, and takes as long as bandwidth says they would.
+        """
+        with self._lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+        if self.bandwidth:
+            sleep(float(received + sent) / self.bandwidth)
+
+    def request_count(self, path=None):
+        with self._lock:
+            if path is None:
+                return sum(self.requests.values())
+            return self.requests.get(path, 0)
+
+    def fail_next(self, count=1, status=500, retry_after=None):
+        """
+        Makes the next count requests fail with status.
+        """
+        with self._lock:
+            self._errors.extend([(status, retry_after)] * count)
+
+    def next_error(self):
+        with self._lock:
+            if len(self._errors) != 0:
+                return self._errors.pop(0)
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, None
+        return None
+
+    def price(self, flavor, days):
+        """
+        Returns the satoshis for days of a node of flavor.
+        """
+        per_day = SATOSHIS_PER_DAY
+        if flavor is not None:
+            record = self.options['flavor'].get(str(flavor))
+            if record is not None:
+                per_day = SATOSHIS_PER_DAY * record['vcpu_count'] + \
+                    SATOSHIS_PER_MB_DAY * record['ram']
+        return per_day * days
+
+    def launch_index(self):
+        return [{'name': profile['name'],
+                 'human_name': profile['human_name'],
+                 'description': profile['description']}
+                for profile in self.launch_profiles.values()]
+
+    def pay(self, unique):
+        """
+        Marks a node, or its renewal if one is awaiting payment, as paid,
+        whatever its poll count.
+        """
+        with self._lock:
+            node = self.nodes[unique]
+            if node['renewal'] is not None:
+                node['renewal']['paid'] = True
+            else:
+                node['paid_at'] = node['polls']
+
+    def poll_node(self, unique, days, data):
+        with self._lock:
+            if unique not in self.nodes:
+                self.nodes[unique] = {'polls': 0,
+                                      'days': days,
+                                      'request': data,
+                                      'last_request': None,
+                                      'end_of_life': None,
+                                      'paid_at': None,
+                                      'renewal': None}
+            node = self.nodes[unique]
+            node['polls'] += 1
+            node['last_request'] = data
+            renewal = self._renewal(node, days)
+            if renewal is not None:
+                return renewal
+            if node['paid_at'] is None and \
+                    node['polls'] > self.polls_to_pay:
+                node['paid_at'] = node['polls']
+            paid = node['paid_at'] is not None
+            created = paid and \
+                node['polls'] - node['paid_at'] >= self.polls_to_create
+            if paid and node['end_of_life'] is None:
+                node['end_of_life'] = int(time()) + node['days'] * 86400
+            address = '1Mock{}'.format(sha1(unique).hexdigest()[:29])
+            return {'end_of_life': node['end_of_life'] or 0,
+                    'payment_status': paid,
+                    'creation_status': created,
+                    'address': address,
+                    'satoshis': self.price(data.get('flavor'), days),
+                    'ip4': '127.0.0.1',
+                    'ip6': '::1',
+                    'deprecated': False}
+
+    def _renewal(self, node, days):
+        """
+        Returns the response to a renewal request, if this is one.
+        """
+        if node['renewal'] is None:
+            if self.renew_window is None or node['end_of_life'] is None or \
+                    node['polls'] - node['paid_at'] <= self.polls_to_create:
+                return None
+            if node['end_of_life'] - time() > self.renew_window:
+                return None
+            node['renewal'] = {'polls': 0, 'days': days}
+        renewal = node['renewal']
+        renewal['polls'] += 1
+        paid = renewal['polls'] > self.polls_to_pay or \
+            renewal.get('paid') is True
+        if paid:
+            node['end_of_life'] += renewal['days'] * 86400
+            node['renewal'] = None
+        return {'end_of_life': node['end_of_life'],
+                'payment_status': paid,
+                'creation_status': True,
+                'address': '1Renew{}'.format(
+                    sha1(str(node['end_of_life'])).hexdigest()[:28]),
+                'satoshis': self.price(node['request'].get('flavor'),
+                                       renewal['days']),
+                'ip4': '127.0.0.1',
+                'ip6': '::1',
+                'deprecated': False}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock SporeStack endpoint.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency',
+                        help='Seconds added to every request.',
+                        type=float,
+                        default=0)
+    parser.add_argument('--polls-to-pay', type=int, default=1)
+    parser.add_argument('--polls-to-create', type=int, default=1)
+    parser.add_argument('--renew-window',
+                        help='Seconds before end of life that asking for a '
+                        'node renews it.',
+                        type=int,
+                        default=None)
+    parser.add_argument('--error-rate',
+                        help='Fraction of requests that get HTTP 500.',
+                        type=float,
+                        default=0)
+    parser.add_argument('--no-compress',
+                        help='Neither gzip responses nor take compressed '
+                        'requests.',
+                        action='store_true')
+    parser.add_argument('--bandwidth',
+                        help='Bytes a second to send and receive bodies at.',
+                        type=int,
+                        default=None)
+    parser.add_argument('--certfile',
+                        help='PEM file with a key and certificate to serve '
+                        'HTTPS with.',
+                        default=None)
+    args = parser.parse_args()
+    server = MockServer(host=args.host,
+                        port=args.port,
+                        latency=args.latency,
+                        polls_to_pay=args.polls_to_pay,
+                        polls_to_create=args.polls_to_create,
+                        error_rate=args.error_rate,
+                        renew_window=args.renew_window,
+                        compress=not args.no_compress,
+                        bandwidth=args.bandwidth,
+                        certfile=args.certfile)
+    print('Serving on {}'.format(server.endpoint))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Checking node settings against /node/options before asking for a node.
+
+The options payload maps osid, dcid and flavor (as strings) to records:
+names for osid and dcid, ram (MB), disk (GB) and vcpu_count for flavor.
+An osid record may list the dcids it's available in as dcid; if none do,
+every osid is taken to be available everywhere.
+"""
+
+from sporestack import cache
+
+
+class OptionsIndex(object):
+    """
+    /node/options, indexed by integer id. Validating and picking flavors
+    doesn't touch the network.
+    """
+    def __init__(self, options):
+        self.osids = self._by_id(options.get('osid', {}))
+        self.dcids = self._by_id(options.get('dcid', {}))
+        self.flavors = self._by_id(options.get('flavor', {}))
+        # osid: set of dcids, for osids that say.
+        self.dcids_for_osid = {}
+        for osid, record in self.osids.items():
+            if isinstance(record, dict) and record.get('dcid') is not None:
+                self.dcids_for_osid[osid] = set(
+                    [int(dcid) for dcid in record['dcid']])
+        # Smallest, so cheapest, first.
+        self.flavors_by_size = sorted(
+            [(self._size(record), flavor)
+             for flavor, record in self.flavors.items()])
+
+    @staticmethod
+    def _by_id(records):
+        return dict([(int(key), record) for key, record in records.items()])
+
+    @staticmethod
+    def _size(record):
+        # Some endpoints send these as strings.
+        return (int(record.get('ram') or 0),
+                int(record.get('vcpu_count') or 0),
+                int(record.get('disk') or 0))
+
+    def validate(self, osid, dcid, flavor):
+        """
+        Raises ValueError if osid, dcid and flavor aren't a combination the
+        endpoint offers. None is left to the endpoint.
+        """
+        if osid is not None and osid not in self.osids:
+            raise ValueError('Unknown osid {}, options are: {}'.format(
+                osid, _ids(self.osids)))
+        if dcid is not None:
+            if dcid not in self.dcids:
+                raise ValueError('Unknown dcid {}, options are: {}'.format(
+                    dcid, _ids(self.dcids)))
+            if osid in self.dcids_for_osid and \
+                    dcid not in self.dcids_for_osid[osid]:
+                raise ValueError('osid {} is not available in dcid {}, only '
+                                 'in: {}'.format(osid,
+                                                 dcid,
+                                                 _ids(self.dcids_for_osid[
+                                                     osid])))
+        if flavor is not None and flavor not in self.flavors:
+            raise ValueError('Unknown flavor {}, options are: {}'.format(
+                flavor, _ids(self.flavors)))
+
+    def flavor(self, min_ram=None, min_vcpu=None, min_disk=None):
+        """
+        Returns the smallest flavor with at least min_ram MB of RAM,
+        min_vcpu VCPUs and min_disk GB of disk. Raises ValueError if none
+        is big enough.
+        """
+        for (ram, vcpus, disk), flavor in self.flavors_by_size:
+            if min_ram is not None and ram < min_ram:
+                continue
+            if min_vcpu is not None and vcpus < min_vcpu:
+                continue
+            if min_disk is not None and disk < min_disk:
+                continue
+            return flavor
+        raise ValueError('No flavor has RAM >= {}, VCPUs >= {} and disk >= '
+                         '{}.'.format(min_ram, min_vcpu, min_disk))
+
+
+def _ids(ids):
+    return ', '.join([str(id) for id in sorted(ids)])
+
+
+def index(refresh=False, endpoint=None):
+    """
+    Returns an OptionsIndex of the (cached) node options at endpoint.
+    """
+    return OptionsIndex(cache.node_options(refresh=refresh,
+                                           endpoint=endpoint))
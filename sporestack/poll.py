@@ -0,0 +1,87 @@
+"""
+Polling schedule: exponential backoff with jitter, per phase.
+"""
+
+import random
+from time import sleep, time
+
+# (initial, maximum) seconds between polls for each phase. Payment can take
+# minutes, builds take seconds, and once a node is built we want to see
+# port 22 open as soon as it is.
+PHASES = {'payment': (2, 15),
+          'building': (1, 5),
+          'connecting': (0.5, 5)}
+FACTOR = 1.5
+# Fraction of each delay randomly added or removed, so many pollers don't
+# move in lockstep.
+JITTER = 0.1
+
+
+class PollTimeout(Exception):
+    """
+    Raised when a Poller runs past its deadline.
+    """
+    pass
+
+
+class Poller(object):
+    """
+    Sleeps between polls.
+
+    The delay starts at the phase's initial value and grows by factor after
+    every poll up to the phase's maximum. It starts over whenever the phase
+    changes. deadline is seconds from now after which sleep() raises
+    PollTimeout. callback(phase, attempt, delay), if given, is called before
+    each sleep.
+    """
+    def __init__(self,
+                 deadline=None,
+                 callback=None,
+                 phases=PHASES,
+                 factor=FACTOR,
+                 jitter=JITTER):
+        if deadline is not None:
+            deadline = time() + deadline
+        self.deadline = deadline
+        self.callback = callback
+        self.phases = phases
+        self.factor = factor
+        self.jitter = jitter
+        self.phase = None
+        self.attempt = 0
+
+    def delay(self, phase):
+        """
+        Returns the next delay for phase and advances the schedule.
+        """
+        if phase != self.phase:
+            self.phase = phase
+            self.attempt = 0
+        initial, maximum = self.phases[phase]
+        delay = min(maximum, initial * self.factor ** self.attempt)
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        self.attempt += 1
+        return delay
+
+    def sleep(self, phase):
+        """
+        Sleeps until the next poll in phase.
+        """
+        delay = self.delay(phase)
+        if self.deadline is not None:
+            remaining = self.deadline - time()
+            if remaining <= 0:
+                raise PollTimeout('Gave up while in {} phase.'.format(phase))
+            delay = min(delay, remaining)
+        if self.callback is not None:
+            self.callback(phase, self.attempt, delay)
+        sleep(delay)
+
+
+def node_phase(node):
+    """
+    Phase to poll a node returned by sporestack.node() in.
+    """
+    if node.payment_status is False:
+        return 'payment'
+    return 'building'
@@ -0,0 +1,141 @@
+"""
+Keep-alive HTTP(S) connection pool for one endpoint.
+"""
+
+import httplib
+import socket
+from Queue import LifoQueue, Empty, Full
+from urlparse import urlparse
+
+from sporestack import compression
+
+POOL_SIZE = 4
+TIMEOUT = 60
+
+
+class Response(object):
+    """
+    A finished HTTP response from endpoint. Header names are lower case.
+    """
+    def __init__(self, status, headers, body, endpoint=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.endpoint = endpoint
+
+
+class ConnectionPool(object):
+    """
+    Holds up to size idle keep-alive connections to endpoint.
+    Safe to share between threads.
+
+    Responses are asked for gzipped. Request bodies are compressed once the
+    endpoint says it takes a coding we have; see sporestack.compression.
+    """
+    def __init__(self, endpoint, size=POOL_SIZE, timeout=TIMEOUT):
+        parsed = urlparse(endpoint)
+        if parsed.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        elif parsed.scheme == 'http':
+            self._connection_class = httplib.HTTPConnection
+        else:
+            raise ValueError('Unsupported endpoint: {}'.format(endpoint))
+        self.endpoint = endpoint
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.prefix = parsed.path.rstrip('/')
+        self.timeout = timeout
+        # Codings the endpoint takes request bodies in, once it says.
+        self.accepted_codings = set()
+        self._idle = LifoQueue(size)
+
+    def _get_connection(self):
+        """
+        Returns (connection, reused)
+        """
+        try:
+            return self._idle.get_nowait(), True
+        except Empty:
+            connection = self._connection_class(self.host,
+                                                self.port,
+                                                timeout=self.timeout)
+            return connection, False
+
+    def _put_connection(self, connection):
+        try:
+            self._idle.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        """
+        Returns a Response. Raises socket.error or httplib.HTTPException
+        if the request could not be made.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        plain_body = body
+        plain_headers = headers
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', compression.ACCEPT_ENCODING)
+        coding = None
+        if body is not None and len(body) >= compression.MIN_SIZE:
+            coding = compression.choose(self.accepted_codings)
+        if coding is not None:
+            body = compression.compress(body, coding)
+            headers['Content-Encoding'] = coding
+        while True:
+            connection, reused = self._get_connection()
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request(method,
+                                   self.prefix + path,
+                                   body,
+                                   headers)
+                # Buffered, or httplib reads headers a byte per recv().
+                # Nothing follows the response until we ask again, so
+                # the buffer can't take the next one's bytes.
+                http_response = connection.getresponse(buffering=True)
+                response_body = compression.read(http_response)
+            except socket.timeout:
+                connection.close()
+                raise
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                # The server may have closed an idle keep-alive connection
+                # on us. Only a fresh connection failing is a real error.
+                if reused is True:
+                    continue
+                raise
+            if http_response.will_close:
+                connection.close()
+            else:
+                self._put_connection(connection)
+            accept_encoding = http_response.getheader('accept-encoding')
+            if accept_encoding is not None:
+                self.accepted_codings = compression.parse_accept_encoding(
+                    accept_encoding)
+            if http_response.status == 415 and coding is not None:
+                # It doesn't take coding after all.
+                self.accepted_codings.discard(coding)
+                return self.request(method,
+                                    path,
+                                    plain_body,
+                                    plain_headers,
+                                    timeout)
+            return Response(http_response.status,
+                            dict(http_response.getheaders()),
+                            response_body,
+                            self.endpoint)
+
+    def close(self):
+        """
+        Closes idle connections.
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
@@ -0,0 +1,113 @@
+"""
+Node reachability probes.
+
+Addresses are raced RFC 8305 (happy eyeballs) style: IPv6 first, the next
+address after ATTEMPT_DELAY or as soon as an attempt fails, first to
+connect wins. A node with broken IPv6 costs ATTEMPT_DELAY, not a timeout.
+"""
+
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+from time import time
+import socket
+import threading
+
+from sporestack import CONCURRENCY
+from sporestack import metrics
+from sporestack.poll import Poller
+
+CONNECT_TIMEOUT = 2
+# RFC 8305 recommends 250ms between connection attempts.
+ATTEMPT_DELAY = 0.25
+
+
+def addresses(node):
+    """
+    Returns a node's addresses, IPv6 first. node is a node file dict or a
+    node from sporestack.node().
+    """
+    if isinstance(node, dict):
+        ip6 = node.get('ip6')
+        ip4 = node.get('ip4')
+    else:
+        ip6 = node.ip6
+        ip4 = node.ip4
+    return [ip for ip in (ip6, ip4) if ip]
+
+
+def race(addresses, port, timeout=CONNECT_TIMEOUT,
+         attempt_delay=ATTEMPT_DELAY):
+    """
+    Returns the first of addresses to accept a connection on port, or None.
+    """
+    results = Queue()
+
+    def attempt(address):
+        start = time()
+        try:
+            connection = socket.create_connection((address, port),
+                                                  timeout=timeout)
+            connection.close()
+            result = address
+        except (socket.error, ValueError):
+            result = None
+        metrics.emit('probe_attempt',
+                     address=address,
+                     port=port,
+                     connected=result is not None,
+                     seconds=time() - start)
+        results.put(result)
+
+    started = 0
+    finished = 0
+    for address in addresses:
+        thread = threading.Thread(target=attempt, args=(address,))
+        thread.daemon = True
+        thread.start()
+        started += 1
+        try:
+            result = results.get(timeout=attempt_delay)
+        except Empty:
+            continue
+        finished += 1
+        if result is not None:
+            return result
+    while finished < started:
+        result = results.get()
+        finished += 1
+        if result is not None:
+            return result
+    return None
+
+
+def wait_for_port(node, port=22, deadline=None, poller=None):
+    """
+    Waits until one of node's addresses accepts connections on port and
+    returns that address.
+    Raises sporestack.poll.PollTimeout after deadline seconds.
+    """
+    if poller is None:
+        poller = Poller(deadline=deadline)
+    node_addresses = addresses(node)
+    while True:
+        address = race(node_addresses, port)
+        if address is not None:
+            return address
+        poller.sleep('connecting')
+
+
+def probe_many(nodes, port=22, concurrency=CONCURRENCY):
+    """
+    Races each node's addresses once, concurrency nodes at a time.
+    Yields (node, address) as each finishes, address being None for
+    unreachable nodes.
+    """
+    def probe(node):
+        return node, race(addresses(node), port)
+    pool = ThreadPool(concurrency)
+    try:
+        for result in pool.imap_unordered(probe, nodes):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
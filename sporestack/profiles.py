@@ -0,0 +1,173 @@
+"""
+Local launch profile registry.
+
+Profiles are fetched through sporestack.cache, so they are revalidated
+conditionally and served offline. Each version seen is validated, has its
+cloudinit encoded once, and is kept in REGISTRY_PATH as
+{name}@{hash}.json, hash being the SHA-256 of the profile as served.
+Launching the same profile again reads that file instead of validating
+and encoding it again.
+
+name@hash pins a version. It is only looked up in the registry, and any
+unambiguous prefix of the hash will do.
+"""
+
+from hashlib import sha256
+import glob
+import json
+import os
+
+import sporestack
+from sporestack import cache
+from sporestack import decode
+
+REGISTRY_PATH = os.path.join(sporestack.DOT_FILE_PATH, 'profiles')
+
+# Hash characters shown in pinned names.
+SHORT_HASH = 12
+
+SCRIPTS = ('cloudinit', 'startupscript', 'postlaunch')
+
+
+class Profile(object):
+    """
+    A validated launch profile. settings is the profile dict,
+    encoded_cloudinit its cloudinit from sporestack.encode_cloudinit().
+    """
+    def __init__(self, name, digest, settings, encoded_cloudinit=None):
+        self.name = name
+        self.digest = digest
+        self.settings = settings
+        self.encoded_cloudinit = encoded_cloudinit
+
+    @property
+    def pinned(self):
+        """
+        name@hash, for launching this version again.
+        """
+        return '{}@{}'.format(self.name, self.digest[:SHORT_HASH])
+
+    def to_dict(self):
+        return {'name': self.name,
+                'hash': self.digest,
+                'settings': self.settings,
+                'encoded_cloudinit': self.encoded_cloudinit}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'],
+                   data['hash'],
+                   data['settings'],
+                   data['encoded_cloudinit'])
+
+
+def validate(settings):
+    """
+    Raises ValueError if settings isn't a usable launch profile.
+    """
+    if not isinstance(settings, dict):
+        raise ValueError('Launch profile is not a dict.')
+    for key in ('osid', 'flavor'):
+        if not isinstance(settings.get(key), (int, long)):
+            raise ValueError('Launch profile {} must be an integer, not '
+                             '{!r}.'.format(key, settings.get(key)))
+    for key in SCRIPTS:
+        script = settings.get(key)
+        if script is not None and not isinstance(script, basestring):
+            raise ValueError('Launch profile {} must be a string.'.format(
+                key))
+
+
+def from_settings(name, settings, digest=None):
+    """
+    Returns a Profile for settings, validating and encoding it.
+    """
+    validate(settings)
+    if digest is None:
+        digest = sha256(json.dumps(settings, sort_keys=True)).hexdigest()
+    encoded_cloudinit = None
+    if settings.get('cloudinit') is not None:
+        encoded_cloudinit = sporestack.encode_cloudinit(settings['cloudinit'])
+    return Profile(name, digest, settings, encoded_cloudinit)
+
+
+def from_file(path):
+    """
+    Returns a Profile for a SporeStack file. These aren't registered.
+    """
+    return from_settings(path, decode.load_file(path))
+
+
+def _path(name, digest):
+    return os.path.join(REGISTRY_PATH, '{}@{}.json'.format(name, digest))
+
+
+def save(profile):
+    """
+    Atomically adds profile to the registry.
+    """
+    if not os.path.isdir(REGISTRY_PATH):
+        os.makedirs(REGISTRY_PATH, 0o700)
+    path = _path(profile.name, profile.digest)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as profile_file:
+        json.dump(profile.to_dict(), profile_file)
+    os.rename(temp_path, path)
+
+
+def load(name, digest):
+    """
+    Returns the registered Profile for name and a prefix of its hash.
+    Raises Exception if there isn't exactly one.
+    """
+    paths = glob.glob(_path(name, digest + '*'))
+    if len(paths) == 0:
+        raise Exception('No launch profile {}@{} in {}.'.format(
+            name, digest, REGISTRY_PATH))
+    if len(paths) > 1:
+        raise Exception('{}@{} is ambiguous.'.format(name, digest))
+    with open(paths[0]) as profile_file:
+        return Profile.from_dict(json.load(profile_file))
+
+
+def versions(name=None):
+    """
+    Returns a list of (added, pinned name) for registered profiles, newest
+    first. added is when the version was first seen.
+    """
+    pattern = _path(name or '*', '*')
+    registered = [(os.path.getmtime(path),
+                   os.path.basename(path)[:-len('.json')])
+                  for path in glob.glob(pattern)]
+    return sorted(registered, reverse=True)
+
+
+def get(spec, refresh=False, endpoint=None):
+    """
+    Returns the Profile for a launch profile name, or name@hash to pin a
+    version, from endpoint (see sporestack.cache.get()). Without a cached
+    copy or the endpoint, the newest registered version of name is used.
+    """
+    if '@' in spec:
+        name, digest = spec.split('@', 1)
+        return load(name, digest)
+    path = '/launch/{}.json'.format(spec)
+    try:
+        body = cache.get('launch_{}'.format(spec),
+                         path,
+                         refresh=refresh,
+                         endpoint=endpoint)
+    except Exception:
+        registered = versions(spec)
+        if len(registered) == 0:
+            raise
+        name, digest = registered[0][1].split('@', 1)
+        return load(name, digest)
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    digest = sha256(body).hexdigest()
+    if os.path.exists(_path(spec, digest)):
+        return load(spec, digest)
+    profile = from_settings(spec, decode.loads(body), digest)
+    save(profile)
+    return profile
@@ -0,0 +1,208 @@
+"""
+Profiling for the CLI's --profile and --trace-alloc, and for applications
+embedding sporestack.
+
+    with sporestack.profiling.profiling('spawn.pstats') as session:
+        ...
+    print(session.report())
+
+Every thread started in the with block is profiled too, and their stats
+merged, so work done on a Fleet's or an exec's pool shows up. Time is split
+into CPU, from getrusage(), and time blocked waiting on the network, locks,
+sleeps and subprocesses: the wall clock time of the calls in BLOCKING.
+
+Memory is traced with tracemalloc where it's available. Python 2 doesn't
+have it, so without the pytracemalloc backport allocations are traced by
+counting objects the garbage collector sees, by type, before and after.
+Peak memory is the process's maximum resident set size either way.
+"""
+
+from contextlib import contextmanager
+from time import time
+import gc
+import resource
+import sys
+import threading
+
+TOP = 15
+
+# Functions, as cProfile names built-ins, that wait rather than compute.
+BLOCKING = ('sleep', 'select', 'poll', 'epoll', 'recv', 'recv_into',
+            'recvfrom', 'send', 'sendall', 'connect', 'connect_ex',
+            'accept', 'getaddrinfo', 'gethostbyname', 'read', 'readline',
+            'write', 'flush', 'waitpid', 'wait', 'acquire', 'do_handshake')
+
+
+def _tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    return tracemalloc
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+def _type_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def _blocking(function):
+    filename, _, name = function
+    if filename != '~':
+        return False
+    # Reads and writes of in-memory files don't wait.
+    if 'StringIO' in name:
+        return False
+    # "<method 'recv' of '_socket.socket' objects>" or
+    # "<time.sleep>" or "<built-in method sleep>"
+    name = name.strip('<>').split(' of ')[0]
+    name = name.replace("'", '').split()[-1].split('.')[-1]
+    return name in BLOCKING
+
+
+def _function_name(function):
+    filename, line, name = function
+    if filename == '~':
+        return name
+    return '{}:{}({})'.format(filename, line, name)
+
+
+class Session(object):
+    """
+    What one profiling() block measured. stats is a pstats.Stats, or None
+    if it wasn't profiling. allocations is a list of (where, bytes or
+    count) growing the most, or None if it wasn't tracing allocations.
+    """
+    def __init__(self):
+        self.stats = None
+        self.wall = None
+        self.cpu = None
+        self.peak = None
+        self.allocations = None
+        self.allocation_unit = None
+
+    def report(self, top=TOP):
+        """
+        Returns the top functions by CPU and blocked time, and memory use,
+        as text.
+        """
+        lines = ['Profile: {:.3f}s wall, {:.3f}s CPU, {:.3f}s blocked or '
+                 'waiting, peak RSS {:.1f} MB'.format(
+                     self.wall,
+                     self.cpu,
+                     max(0, self.wall - self.cpu),
+                     self.peak / 1048576.0)]
+        if self.stats is not None:
+            computing = []
+            blocking = []
+            for function, (_, calls, own, cumulative, _) in \
+                    self.stats.stats.items():
+                if _blocking(function):
+                    blocking.append((own, calls, function))
+                else:
+                    computing.append((own, calls, function))
+            lines.append('Top CPU, by own time (seconds summed over '
+                         'threads):')
+            for own, calls, function in sorted(computing, reverse=True)[:top]:
+                lines.append('  {:>9.3f}s {:>8} {}'.format(
+                    own, calls, _function_name(function)))
+            lines.append('Top blocked on I/O, locks and sleeps:')
+            for own, calls, function in sorted(blocking, reverse=True)[:top]:
+                lines.append('  {:>9.3f}s {:>8} {}'.format(
+                    own, calls, _function_name(function)))
+        if self.allocations is not None:
+            lines.append('Top allocations, {}:'.format(self.allocation_unit))
+            for where, size in self.allocations[:top]:
+                lines.append('  {:>12} {}'.format(size, where))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profiling(path=None, trace_alloc=False, profile=True, top=TOP):
+    """
+    Profiles the with block, and threads started in it, with cProfile,
+    writing pstats to path if given. trace_alloc traces allocations too.
+    Yields a Session, filled in when the block exits.
+    """
+    session = Session()
+    profilers = []
+    profilers_lock = threading.Lock()
+    if profile is True:
+        import cProfile
+
+        def start_thread_profiler(*args):
+            # Replaces itself as the thread's profile function.
+            profiler = cProfile.Profile()
+            with profilers_lock:
+                profilers.append(profiler)
+            profiler.enable()
+        threading.setprofile(start_thread_profiler)
+    tracemalloc = None
+    before = None
+    if trace_alloc is True:
+        tracemalloc = _tracemalloc()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        else:
+            before = _type_counts()
+    if profile is True:
+        main_profiler = cProfile.Profile()
+        profilers.append(main_profiler)
+    started = time()
+    cpu_started = _cpu_seconds()
+    if profile is True:
+        main_profiler.enable()
+    try:
+        yield session
+    finally:
+        if profile is True:
+            main_profiler.disable()
+            threading.setprofile(None)
+        session.wall = time() - started
+        session.cpu = _cpu_seconds() - cpu_started
+        session.peak = _peak_bytes()
+        if trace_alloc is True:
+            if tracemalloc is not None:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                session.allocation_unit = 'bytes by line'
+                session.allocations = [
+                    (str(statistic.traceback), statistic.size)
+                    for statistic in snapshot.statistics('lineno')[:top]]
+            else:
+                after = _type_counts()
+                session.allocation_unit = 'objects by type, growth'
+                growth = [(after[name] - before.get(name, 0), name)
+                          for name in after]
+                session.allocations = [(name, count) for count, name
+                                       in sorted(growth, reverse=True)
+                                       if count > 0][:top]
+        if profile is True:
+            import pstats
+            profiled = []
+            with profilers_lock:
+                for profiler in profilers:
+                    profiler.create_stats()
+                    # pstats won't take a profiler that saw nothing.
+                    if len(profiler.stats) != 0:
+                        profiled.append(profiler)
+            if len(profiled) != 0:
+                session.stats = pstats.Stats(*profiled)
+                if path is not None:
+                    session.stats.dump_stats(path)
@@ -0,0 +1,257 @@
+"""
+Price quotes for many node configurations at once, for capacity planning.
+
+The API has no price list, so a quote is the satoshis /node asks for a node
+with a new, throwaway unique that's never paid for: nothing is spawned, but
+each quote registers a unique with the endpoint. matrix() prices every
+flavor in every dcid for each number of days, concurrency at a time and at
+most rate requests a second. Quotes are cached in quotes.json in the catalog
+cache for TTL seconds, keyed by osid, dcid, flavor and days.
+
+So as not to register a unique for every cell, prices are assumed to be
+proportional to days, which the API doesn't promise: one quote is fetched
+for each flavor and dcid, and the other days are worked out from it. With
+sweep, every number of days is quoted.
+"""
+
+from itertools import product
+from time import time
+import threading
+
+import sporestack
+from sporestack import CONCURRENCY
+from sporestack import cache
+from sporestack import options
+from sporestack.endpoints import EndpointSet
+from sporestack.fleet import Fleet
+
+# Requests a second.
+RATE = 10
+# Seconds a quote is good for.
+TTL = 3600
+CACHE_NAME = 'quotes'
+
+# Keys of a quote, in the order they're shown.
+FIELDS = ('flavor', 'dcid', 'days', 'satoshis', 'per_day', 'per_vcpu_day',
+          'per_gb_ram_day', 'source')
+SORT_KEYS = ('satoshis', 'per_day', 'per_vcpu_day', 'per_gb_ram_day')
+
+
+def _key(osid, dcid, flavor, days):
+    return '/'.join(['' if value is None else str(value)
+                     for value in (osid, dcid, flavor, days)])
+
+
+class QuoteCache(object):
+    """
+    Quotes from endpoint, a URL, loaded from and saved to the cache.
+    Safe to share between threads.
+    """
+    def __init__(self, endpoint, ttl=TTL):
+        self.ttl = ttl
+        self.url = endpoint
+        entry = cache.load(CACHE_NAME)
+        if entry is None or entry.get('url') != self.url:
+            # key: {'satoshis', 'fetched'}
+            self.quotes = {}
+        else:
+            self.quotes = entry['quotes']
+        self._lock = threading.Lock()
+
+    def _fresh(self, quote, now):
+        return now - quote['fetched'] < self.ttl
+
+    def get(self, osid, dcid, flavor, days):
+        """
+        Returns the satoshis of a fresh cached quote, or None.
+        """
+        now = time()
+        with self._lock:
+            quote = self.quotes.get(_key(osid, dcid, flavor, days))
+            if quote is None or not self._fresh(quote, now):
+                return None
+            return quote['satoshis']
+
+    def any_days(self, osid, dcid, flavor):
+        """
+        Returns (days, satoshis) of a fresh cached quote for any number of
+        days, shortest first, or None.
+        """
+        now = time()
+        prefix = _key(osid, dcid, flavor, '')
+        found = []
+        with self._lock:
+            for key, quote in self.quotes.items():
+                if key.startswith(prefix) and self._fresh(quote, now):
+                    found.append((int(key[len(prefix):]), quote['satoshis']))
+        if len(found) == 0:
+            return None
+        return min(found)
+
+    def put(self, osid, dcid, flavor, days, satoshis):
+        with self._lock:
+            self.quotes[_key(osid, dcid, flavor, days)] = {
+                'satoshis': satoshis,
+                'fetched': time()}
+
+    def save(self):
+        """
+        Writes fresh quotes back to the cache.
+        """
+        now = time()
+        with self._lock:
+            self.quotes = dict([(key, quote)
+                                for key, quote in self.quotes.items()
+                                if self._fresh(quote, now)])
+            cache.save(CACHE_NAME, {'url': self.url, 'quotes': self.quotes})
+
+
+def _interpolate(days, base_days, base_satoshis):
+    return int(round(base_satoshis * float(days) / base_days))
+
+
+def _row(flavor, dcid, days, satoshis, source, record):
+    per_day = satoshis / float(days)
+    per_vcpu_day = None
+    per_gb_ram_day = None
+    if isinstance(record, dict):
+        # Some endpoints send these as strings.
+        vcpu_count = int(record.get('vcpu_count') or 0)
+        ram = int(record.get('ram') or 0)
+        if vcpu_count != 0:
+            per_vcpu_day = per_day / vcpu_count
+        if ram != 0:
+            per_gb_ram_day = per_day / (ram / 1024.0)
+    return {'flavor': flavor,
+            'dcid': dcid,
+            'days': days,
+            'satoshis': satoshis,
+            'per_day': per_day,
+            'per_vcpu_day': per_vcpu_day,
+            'per_gb_ram_day': per_gb_ram_day,
+            'source': source}
+
+
+def matrix(days,
+           osid=None,
+           dcids=None,
+           flavors=None,
+           concurrency=CONCURRENCY,
+           rate=RATE,
+           refresh=False,
+           ttl=TTL,
+           client=None,
+           sweep=False,
+           endpoint=None,
+           refresh_options=False):
+    """
+    Returns a list of quotes, dicts of FIELDS, for each flavor in each dcid
+    for each of days, a list. dcids and flavors default to every one the
+    (cached) node options offer osid in. refresh ignores cached quotes,
+    refresh_options the cached node options. Prices are worked out from one
+    quote for each flavor and dcid unless sweep is True. source is fetched,
+    cached or interpolated. endpoint defaults to sporestack.ENDPOINT; of an
+    EndpointSet, the one it chooses is asked.
+
+    Raises ValueError if a dcid or flavor asked for isn't offered.
+    """
+    if endpoint is None:
+        endpoint = sporestack.ENDPOINT
+    if isinstance(endpoint, EndpointSet):
+        endpoint = endpoint.choose()
+    index = options.index(refresh=refresh_options, endpoint=endpoint)
+    if dcids is None:
+        dcids = [dcid for dcid in sorted(index.dcids)
+                 if osid not in index.dcids_for_osid or
+                 dcid in index.dcids_for_osid[osid]]
+    if flavors is None:
+        flavors = sorted(index.flavors)
+    for dcid in dcids:
+        for flavor in flavors:
+            index.validate(osid, dcid, flavor)
+    quotes = QuoteCache(endpoint, ttl)
+    # (flavor, dcid, days): (satoshis, source)
+    prices = {}
+    # (flavor, dcid): [days not cached]
+    missing = {}
+    for flavor, dcid, each_days in product(flavors, dcids, days):
+        satoshis = None
+        if refresh is False:
+            satoshis = quotes.get(osid, dcid, flavor, each_days)
+        if satoshis is None:
+            missing.setdefault((flavor, dcid), []).append(each_days)
+        else:
+            prices[(flavor, dcid, each_days)] = (satoshis, 'cached')
+    fetch_cells = []
+    # (flavor, dcid): days to work the others out from
+    bases = {}
+    for (flavor, dcid), wanted in sorted(missing.items()):
+        if sweep is True:
+            fetch_cells.extend([(flavor, dcid, each_days)
+                                for each_days in wanted])
+            continue
+        base = None
+        if refresh is False:
+            base = quotes.any_days(osid, dcid, flavor)
+        if base is None:
+            base_days = min(wanted)
+            fetch_cells.append((flavor, dcid, base_days))
+            bases[(flavor, dcid)] = base_days
+        else:
+            for each_days in wanted:
+                prices[(flavor, dcid, each_days)] = (
+                    _interpolate(each_days, base[0], base[1]),
+                    'interpolated')
+    if len(fetch_cells) != 0:
+        if client is None:
+            client = sporestack.Client(endpoint=endpoint,
+                                       pool_size=concurrency,
+                                       rate=rate)
+        fleet = Fleet(concurrency=concurrency, client=client)
+
+        def fetch(cell):
+            flavor, dcid, each_days = cell
+            return cell, client.node_quote(each_days,
+                                           osid=osid,
+                                           dcid=dcid,
+                                           flavor=flavor,
+                                           endpoint=endpoint)
+        try:
+            for cell, satoshis in fleet.imap(fetch, fetch_cells):
+                flavor, dcid, each_days = cell
+                quotes.put(osid, dcid, flavor, each_days, satoshis)
+                prices[cell] = (satoshis, 'fetched')
+        finally:
+            fleet.close()
+            quotes.save()
+    for (flavor, dcid), base_days in bases.items():
+        base_satoshis = prices[(flavor, dcid, base_days)][0]
+        for each_days in missing[(flavor, dcid)]:
+            if each_days != base_days:
+                prices[(flavor, dcid, each_days)] = (
+                    _interpolate(each_days, base_days, base_satoshis),
+                    'interpolated')
+    rows = []
+    for flavor, dcid, each_days in product(flavors, dcids, days):
+        satoshis, source = prices[(flavor, dcid, each_days)]
+        rows.append(_row(flavor,
+                         dcid,
+                         each_days,
+                         satoshis,
+                         source,
+                         index.flavors.get(flavor)))
+    return rows
+
+
+def sort(rows, by='per_day'):
+    """
+    Returns quotes sorted by one of SORT_KEYS, cheapest first. Quotes
+    without it, like per_vcpu_day for flavors that don't say, go last.
+    """
+    if by not in SORT_KEYS:
+        raise ValueError('Can only sort by: {}'.format(', '.join(SORT_KEYS)))
+    return sorted(rows, key=lambda row: (row[by] is None,
+                                         row[by],
+                                         row['flavor'],
+                                         row['dcid'],
+                                         row['days']))
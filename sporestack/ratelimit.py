@@ -0,0 +1,45 @@
+"""
+Rate limiting for API calls.
+"""
+
+from time import sleep, time
+import threading
+
+
+class TokenBucket(object):
+    """
+    Allows rate calls a second on average, in bursts of up to burst.
+    Safe to share between threads; callers are let through in the order
+    they asked.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1, rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token and returns how many seconds to wait before using it.
+        """
+        with self._lock:
+            now = time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) *
+                               self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Waits for a token.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            sleep(delay)
@@ -0,0 +1,334 @@
+"""
+Running commands on nodes over ssh.
+
+Connections go through an ssh ControlMaster socket per node, so repeated
+commands against the same node skip the SSH handshake.
+
+stdin is fed to ssh and its output read at the same time, BUFFER_SIZE bytes
+at a time, so memory use doesn't grow with how much a script reads or
+prints. Output is handed over a line at a time as it arrives; lines longer
+than BUFFER_SIZE come in BUFFER_SIZE pieces.
+"""
+
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE
+from time import time
+import errno
+import fcntl
+import os
+import select
+
+from sporestack import CONCURRENCY, DOT_FILE_PATH
+from sporestack import probe
+from sporestack.poll import PollTimeout
+
+SSH_OPTIONS = ['-oStrictHostKeyChecking=no',
+               '-oUserKnownHostsFile=/dev/null']
+CONTROL_PATH = os.path.join(DOT_FILE_PATH, 'ssh')
+# Seconds a master connection stays open after its last use.
+CONTROL_PERSIST = 60
+BUFFER_SIZE = 65536
+
+UNREACHABLE = 255
+
+
+def ssh_command(address, control_path=CONTROL_PATH, port=None):
+    """
+    Returns the ssh command line for running a command on address.
+    """
+    command = ['ssh', '-l', 'root', address] + SSH_OPTIONS
+    if port is not None:
+        command += ['-p', str(port)]
+    if control_path is not None:
+        if not os.path.isdir(control_path):
+            os.makedirs(control_path, 0o700)
+        command += ['-oControlMaster=auto',
+                    '-oControlPath={}/%C'.format(control_path),
+                    '-oControlPersist={}'.format(CONTROL_PERSIST)]
+    return command
+
+
+class Result(object):
+    """
+    How a command went. timed_out is None, or 'timeout' or 'idle' if it was
+    killed for running too long or for going quiet, in which case exit_code
+    is what killing it left. seconds is how long it ran, first_output how
+    long until it printed anything (None if it didn't).
+    """
+    __slots__ = ('exit_code',
+                 'timed_out',
+                 'seconds',
+                 'first_output',
+                 'stdout_bytes',
+                 'stderr_bytes')
+
+    def __init__(self,
+                 exit_code=None,
+                 timed_out=None,
+                 seconds=None,
+                 first_output=None,
+                 stdout_bytes=0,
+                 stderr_bytes=0):
+        self.exit_code = exit_code
+        self.timed_out = timed_out
+        self.seconds = seconds
+        self.first_output = first_output
+        self.stdout_bytes = stdout_bytes
+        self.stderr_bytes = stderr_bytes
+
+    def __repr__(self):
+        return 'Result(exit_code={!r}, timed_out={!r}, seconds={!r})'.format(
+            self.exit_code, self.timed_out, self.seconds)
+
+
+class Command(object):
+    """
+    A running command. Iterating over it feeds it stdin, a string or a file,
+    and yields (stream, line) for each line of output, stream being
+    'stdout' or 'stderr'. result is set once iterating is done.
+
+    It's killed after timeout seconds, or idle_timeout seconds without
+    output.
+    """
+    def __init__(self,
+                 command,
+                 stdin=None,
+                 timeout=None,
+                 idle_timeout=None,
+                 buffer_size=BUFFER_SIZE):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.buffer_size = buffer_size
+        self.result = None
+        self._stdin = stdin
+        # Files with a descriptor are read once select() says they can be,
+        # so a slow pipe or terminal doesn't hold up output and timeouts.
+        self._stdin_fd = None
+        if stdin is not None and not isinstance(stdin, basestring):
+            try:
+                self._stdin_fd = stdin.fileno()
+            except (AttributeError, IOError, ValueError):
+                pass
+        self._offset = 0
+        self._pending = ''
+        self.started = time()
+        self.process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        if stdin is None:
+            self.process.stdin.close()
+        else:
+            flags = fcntl.fcntl(self.process.stdin, fcntl.F_GETFL)
+            fcntl.fcntl(self.process.stdin,
+                        fcntl.F_SETFL,
+                        flags | os.O_NONBLOCK)
+
+    def _next_chunk(self):
+        if isinstance(self._stdin, basestring):
+            chunk = self._stdin[self._offset:self._offset + self.buffer_size]
+            self._offset += len(chunk)
+            return chunk
+        if self._stdin_fd is not None:
+            return os.read(self._stdin_fd, self.buffer_size)
+        return self._stdin.read(self.buffer_size)
+
+    def _write_stdin(self):
+        """
+        Writes what the pipe will take. Returns False once stdin is done.
+        """
+        if self._pending == '':
+            self._pending = self._next_chunk()
+            if self._pending == '':
+                self.process.stdin.close()
+                return False
+        try:
+            written = os.write(self.process.stdin.fileno(), self._pending)
+        except OSError as error:
+            if error.errno == errno.EAGAIN:
+                return True
+            # EPIPE: ssh exited without reading all of stdin.
+            self.process.stdin.close()
+            return False
+        self._pending = self._pending[written:]
+        return True
+
+    def _deadline(self, last_output):
+        deadlines = []
+        if self.timeout is not None:
+            deadlines.append((self.started + self.timeout, 'timeout'))
+        if self.idle_timeout is not None:
+            deadlines.append((last_output + self.idle_timeout, 'idle'))
+        if len(deadlines) == 0:
+            return None, None
+        return min(deadlines)
+
+    def __iter__(self):
+        result = Result()
+        streams = {self.process.stdout.fileno(): 'stdout',
+                   self.process.stderr.fileno(): 'stderr'}
+        partial = {'stdout': '', 'stderr': ''}
+        writing = self._stdin is not None
+        last_output = self.started
+        try:
+            while len(streams) != 0:
+                deadline, kind = self._deadline(last_output)
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time()
+                    if wait <= 0:
+                        result.timed_out = kind
+                        self.process.kill()
+                        break
+                readers = streams.keys()
+                writers = []
+                if writing is True:
+                    if self._pending == '' and self._stdin_fd is not None:
+                        readers.append(self._stdin_fd)
+                    else:
+                        writers = [self.process.stdin.fileno()]
+                try:
+                    readable, writable, _ = select.select(readers,
+                                                          writers,
+                                                          [],
+                                                          wait)
+                except select.error as error:
+                    if error.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if len(writable) != 0 or self._stdin_fd in readable:
+                    writing = self._write_stdin()
+                for fd in readable:
+                    if fd not in streams:
+                        continue
+                    name = streams[fd]
+                    data = os.read(fd, self.buffer_size)
+                    if data == '':
+                        del streams[fd]
+                        if partial[name] != '':
+                            yield name, partial[name]
+                        continue
+                    last_output = time()
+                    if result.first_output is None:
+                        result.first_output = last_output - self.started
+                    setattr(result,
+                            name + '_bytes',
+                            getattr(result, name + '_bytes') + len(data))
+                    lines = (partial[name] + data).split('\n')
+                    rest = lines.pop()
+                    for line in lines:
+                        line += '\n'
+                        # Long lines come in buffer_size pieces.
+                        while len(line) > self.buffer_size:
+                            yield name, line[:self.buffer_size]
+                            line = line[self.buffer_size:]
+                        yield name, line
+                    while len(rest) >= self.buffer_size:
+                        yield name, rest[:self.buffer_size]
+                        rest = rest[self.buffer_size:]
+                    partial[name] = rest
+        finally:
+            if self.process.returncode is None and result.timed_out is None \
+                    and len(streams) != 0:
+                # Abandoned midway.
+                self.process.kill()
+            for pipe in (self.process.stdin,
+                         self.process.stdout,
+                         self.process.stderr):
+                if not pipe.closed:
+                    pipe.close()
+            result.exit_code = self.process.wait()
+            result.seconds = time() - self.started
+            self.result = result
+
+    def wait(self, on_line=None):
+        """
+        Runs the command to the end, calling on_line(stream, line) with
+        each line. Returns the Result.
+        """
+        for stream, line in self:
+            if on_line is not None:
+                on_line(stream, line)
+        return self.result
+
+
+def start(address,
+          stdin=None,
+          timeout=None,
+          idle_timeout=None,
+          control_path=CONTROL_PATH,
+          port=None):
+    """
+    Starts ssh against address, returning a Command to iterate over.
+    """
+    return Command(ssh_command(address, control_path, port),
+                   stdin=stdin,
+                   timeout=timeout,
+                   idle_timeout=idle_timeout)
+
+
+def run(address,
+        stdin=None,
+        on_line=None,
+        control_path=CONTROL_PATH,
+        timeout=None,
+        idle_timeout=None,
+        port=None):
+    """
+    Runs ssh against address, feeding it stdin. on_line(stream, line) is
+    called for every line of output as it arrives, stream being 'stdout'
+    or 'stderr'. Returns a Result.
+    """
+    return start(address,
+                 stdin=stdin,
+                 timeout=timeout,
+                 idle_timeout=idle_timeout,
+                 control_path=control_path,
+                 port=port).wait(on_line)
+
+
+def execute(nodes,
+            stdin,
+            on_line=None,
+            concurrency=CONCURRENCY,
+            port=22,
+            control_path=CONTROL_PATH,
+            timeout=None,
+            idle_timeout=None,
+            reachable_timeout=None):
+    """
+    Runs stdin through ssh on every node, concurrency nodes at a time.
+    on_line(node, stream, line) is called for every line of output.
+    Returns a list of (node, exit code). Nodes that don't answer on port
+    get UNREACHABLE: straight away, or with reachable_timeout, if they're
+    still not answering after that many seconds, for nodes that may still
+    be booting. timeout and idle_timeout are as for Command.
+    """
+    def run_node(node):
+        if reachable_timeout is None:
+            address = probe.race(probe.addresses(node), port)
+        else:
+            try:
+                address = probe.wait_for_port(node,
+                                              port,
+                                              deadline=reachable_timeout)
+            except PollTimeout:
+                address = None
+        if address is None:
+            return node, UNREACHABLE
+        if on_line is None:
+            node_on_line = None
+        else:
+            def node_on_line(stream, line):
+                on_line(node, stream, line)
+        result = run(address,
+                     stdin=stdin,
+                     on_line=node_on_line,
+                     control_path=control_path,
+                     timeout=timeout,
+                     idle_timeout=idle_timeout,
+                     port=port)
+        return node, result.exit_code
+    pool = ThreadPool(concurrency)
+    try:
+        return pool.map(run_node, nodes)
+    finally:
+        pool.close()
+        pool.join()
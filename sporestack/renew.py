@@ -0,0 +1,210 @@
+"""
+Renewing nodes before their end of life.
+
+A node is renewed by asking for it again, with the days to add. Nodes are
+kept in a heap on when they're due for renewal, so the daemon sleeps until
+the next one is due rather than checking every node each cycle. The heap
+is only rebuilt from the node store when another process has changed it.
+Nodes due within BATCH_WINDOW of each other are renewed together, so their
+payments can be made at once. A renewal awaiting payment goes back in the
+heap, due at its next poll, so it doesn't hold up the nodes behind it.
+"""
+
+from time import sleep, time
+import heapq
+
+from sporestack import CONCURRENCY
+from sporestack.fleet import Fleet
+from sporestack.poll import Poller, PollTimeout
+
+# Seconds before its end of life that a node is renewed.
+WINDOW = 86400
+# Nodes due this many seconds after the first are renewed with it.
+BATCH_WINDOW = 3600
+DAYS = 7
+# Seconds between checks for nodes added by other processes, and before
+# nodes whose renewal failed are tried again.
+RESCAN = 300
+# Seconds to wait for a renewal to be paid.
+PAYMENT_DEADLINE = 6 * 3600
+
+
+class RenewalQueue(object):
+    """
+    Node dicts, from sporestack.store, by when they're due for renewal.
+    """
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._heap = []
+        # uuid: (due, node). Heap entries that don't match are stale.
+        self._nodes = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, uuid):
+        return uuid in self._nodes
+
+    def load(self, nodes):
+        """
+        Replaces the queue with nodes.
+        """
+        self._nodes = {}
+        for node in nodes:
+            self._nodes[node['uuid']] = (node['end_of_life'] - self.window,
+                                         node)
+        self._heap = [(due, uuid) for uuid, (due, _) in self._nodes.items()]
+        heapq.heapify(self._heap)
+
+    def push(self, node, due=None):
+        """
+        Adds or updates node, due at its renewal window unless due is given.
+        """
+        if due is None:
+            due = node['end_of_life'] - self.window
+        self._nodes[node['uuid']] = (due, node)
+        heapq.heappush(self._heap, (due, node['uuid']))
+
+    def _drop_stale(self):
+        while len(self._heap) != 0:
+            due, uuid = self._heap[0]
+            if uuid in self._nodes and self._nodes[uuid][0] == due:
+                return
+            heapq.heappop(self._heap)
+
+    def next_due(self):
+        """
+        Returns when the next node is due, or None if the queue is empty.
+        """
+        self._drop_stale()
+        if len(self._heap) == 0:
+            return None
+        return self._heap[0][0]
+
+    def pop_due(self, now, batch_window=BATCH_WINDOW):
+        """
+        Removes and returns nodes due at now, along with those due within
+        batch_window after them.
+        """
+        due_nodes = []
+        first_due = self.next_due()
+        if first_due is None or first_due > now:
+            return due_nodes
+        while True:
+            due = self.next_due()
+            if due is None or due > max(now, first_due) + batch_window:
+                return due_nodes
+            _, uuid = heapq.heappop(self._heap)
+            due_nodes.append(self._nodes.pop(uuid)[1])
+
+
+def renew(nodes, days=DAYS, fleet=None):
+    """
+    Asks for each node dict once more, for days, concurrently through
+    fleet. Yields (node dict, Node, None) as each answers, or
+    (node dict, None, error) if asking failed. A node is renewed once its
+    end of life moves, which may take a few asks while its renewal awaits
+    payment.
+    """
+    if fleet is None:
+        fleet = Fleet()
+
+    def call(node):
+        try:
+            return node, fleet.client.node(days=days, unique=node['uuid']), \
+                None
+        except Exception as error:
+            return node, None, error
+    return fleet.imap(call, nodes)
+
+
+def run(store,
+        days=DAYS,
+        window=WINDOW,
+        batch_window=BATCH_WINDOW,
+        concurrency=CONCURRENCY,
+        group=None,
+        client=None,
+        on_unpaid=None,
+        on_renewed=None,
+        on_failed=None,
+        payment_deadline=PAYMENT_DEADLINE,
+        once=False):
+    """
+    Renews nodes in store, a sporestack.store.NodeStore, as they come due.
+
+    Renewals awaiting payment don't hold up other nodes: they go back in
+    the queue, due again at their next poll, for up to payment_deadline
+    seconds. on_unpaid(unpaid), with a list of (node dict, Node), is called
+    with the nodes of each batch that need paying for. on_renewed(node) is
+    called with each renewed node dict, after it's saved, and
+    on_failed(nodes, error) with nodes whose renewal failed or wasn't paid
+    in time, which are tried again later. With once, returns when nothing
+    due now is left to renew instead of running forever.
+    """
+    queue = RenewalQueue(window)
+    version = None
+    # uuid: {'node', 'deadline', 'poller'} for renewals awaiting payment.
+    pending = {}
+    fleet = Fleet(concurrency=concurrency, client=client)
+    try:
+        while True:
+            current_version = store.data_version()
+            if current_version != version:
+                version = current_version
+                queue.load(store.find(group=group, alive_at=int(time())))
+                for uuid, renewal in pending.items():
+                    if uuid in queue:
+                        queue.push(renewal['node'], due=renewal['due'])
+                    else:
+                        del pending[uuid]
+            now = time()
+            due = queue.pop_due(now, batch_window)
+            unpaid = []
+            failed = []
+            failed_error = None
+            for node, renewal, error in renew(due, days=days, fleet=fleet):
+                uuid = node['uuid']
+                if error is None and \
+                        renewal.end_of_life > node['end_of_life']:
+                    pending.pop(uuid, None)
+                    node = dict(node, end_of_life=renewal.end_of_life)
+                    store.put(node)
+                    queue.push(node)
+                    if on_renewed is not None:
+                        on_renewed(node)
+                    continue
+                if error is None:
+                    if uuid not in pending:
+                        pending[uuid] = {'node': node,
+                                         'deadline': now + payment_deadline,
+                                         'poller': Poller()}
+                        if renewal.payment_status is False:
+                            unpaid.append((node, renewal))
+                    if now < pending[uuid]['deadline']:
+                        phase = 'building'
+                        if renewal.payment_status is False:
+                            phase = 'payment'
+                        pending[uuid]['due'] = \
+                            time() + pending[uuid]['poller'].delay(phase)
+                        queue.push(node, due=pending[uuid]['due'])
+                        continue
+                    error = PollTimeout('Not renewed in time.')
+                pending.pop(uuid, None)
+                queue.push(node, due=time() + RESCAN)
+                failed.append(node)
+                if failed_error is None:
+                    failed_error = error
+            if len(unpaid) != 0 and on_unpaid is not None:
+                on_unpaid(unpaid)
+            if len(failed) != 0 and on_failed is not None:
+                on_failed(failed, failed_error)
+            if once is True and len(pending) == 0:
+                return
+            next_due = queue.next_due()
+            if next_due is None:
+                sleep(RESCAN)
+            else:
+                sleep(min(RESCAN, max(0, next_due - time())))
+    finally:
+        fleet.close()
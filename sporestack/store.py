@@ -0,0 +1,247 @@
+"""
+Local node store.
+
+Nodes used to be kept as one {uuid}.json file each in ~/.sporestack, which
+meant reading and parsing every file to list them. They now live in one
+SQLite database, indexed by group, launch profile and end of life. Existing
+node files are imported the first time the store is opened and left in
+place; ones that can't be read are skipped.
+"""
+
+from time import time
+import json
+import os
+import sqlite3
+import threading
+
+from sporestack import DOT_FILE_PATH
+
+DATABASE = 'nodes.sqlite'
+
+# Columns of the nodes table. Anything else in a node dict is kept in
+# the extra column as JSON.
+FIELDS = ('uuid', 'ip4', 'ip6', 'end_of_life', 'launch_profile', 'group')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (
+    uuid TEXT PRIMARY KEY,
+    ip4 TEXT,
+    ip6 TEXT,
+    end_of_life INTEGER NOT NULL,
+    launch_profile TEXT,
+    "group" TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS nodes_group ON nodes ("group");
+CREATE INDEX IF NOT EXISTS nodes_launch_profile ON nodes (launch_profile);
+CREATE INDEX IF NOT EXISTS nodes_end_of_life ON nodes (end_of_life);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+COLUMNS = 'uuid, ip4, ip6, end_of_life, launch_profile, "group", extra'
+
+# Rows read at a time by NodeStore.iterate().
+PAGE_SIZE = 500
+
+
+def _row_to_node(row):
+    node = dict(zip(FIELDS, row[:len(FIELDS)]))
+    if row[-1] is not None:
+        node.update(json.loads(row[-1]))
+    return node
+
+
+def _node_to_row(node):
+    extra = dict([(key, value) for key, value in node.items()
+                  if key not in FIELDS])
+    if len(extra) == 0:
+        extra = None
+    else:
+        extra = json.dumps(extra)
+    return tuple([node.get(field) for field in FIELDS]) + (extra,)
+
+
+def node_record(uuid, node, launch_profile=None, group=None, days=None):
+    """
+    Returns the node dict to store for a created node, a sporestack.Node.
+    """
+    return {'ip4': node.ip4,
+            'ip6': node.ip6,
+            'end_of_life': node.end_of_life,
+            'uuid': uuid,
+            'launch_profile': launch_profile,
+            'group': group,
+            'days': days}
+
+
+class NodeStore(object):
+    """
+    Nodes you've launched, as dicts like the old node files.
+    Safe to share between threads.
+    """
+    def __init__(self, directory=DOT_FILE_PATH):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        self.directory = directory
+        self.path = os.path.join(directory, DATABASE)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path,
+                                           timeout=30,
+                                           check_same_thread=False)
+        with self._lock:
+            self._connection.executescript(SCHEMA)
+        if self._meta('migrated') is None:
+            self.migrate()
+
+    def _meta(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _select(self, where='', parameters=()):
+        query = 'SELECT {} FROM nodes {} ORDER BY end_of_life'.format(COLUMNS,
+                                                                      where)
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [_row_to_node(row) for row in rows]
+
+    def migrate(self):
+        """
+        Imports {uuid}.json node files from the store's directory. Files
+        that aren't a node, or nodes already in the store, are skipped, so
+        it's safe to run again. Returns how many nodes were imported.
+        """
+        nodes = []
+        for node_file in sorted(os.listdir(self.directory)):
+            if not node_file.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory,
+                                       node_file)) as node_json:
+                    node = json.load(node_json)
+            except (IOError, ValueError):
+                continue
+            if not isinstance(node, dict) or \
+                    not isinstance(node.get('end_of_life'), int):
+                continue
+            node.setdefault('uuid', node_file[:-len('.json')])
+            nodes.append(node)
+        with self._lock, self._connection:
+            before = self._connection.total_changes
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [_node_to_row(each) for each in nodes])
+            imported = self._connection.total_changes - before
+            self._connection.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                ('migrated', str(int(time()))))
+        return imported
+
+    def put(self, node):
+        """
+        Adds or replaces node, a dict with at least uuid and end_of_life.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                _node_to_row(node))
+
+    def get(self, uuid):
+        """
+        Returns the node with uuid, or None.
+        """
+        nodes = self._select('WHERE uuid = ?', (uuid,))
+        if len(nodes) == 0:
+            return None
+        return nodes[0]
+
+    def find(self, group=None, launch_profile=None, alive_at=None):
+        """
+        Returns nodes matching all of the given filters, soonest to expire
+        first. alive_at returns nodes whose end of life is after it.
+        """
+        conditions = []
+        parameters = []
+        if group is not None:
+            conditions.append('"group" = ?')
+            parameters.append(group)
+        if launch_profile is not None:
+            conditions.append('launch_profile = ?')
+            parameters.append(launch_profile)
+        if alive_at is not None:
+            conditions.append('end_of_life > ?')
+            parameters.append(alive_at)
+        where = ''
+        if len(conditions) != 0:
+            where = 'WHERE ' + ' AND '.join(conditions)
+        return self._select(where, tuple(parameters))
+
+    def iterate(self, alive_at=None, page_size=PAGE_SIZE):
+        """
+        Yields nodes whose end of life is after alive_at (all nodes if it's
+        None) in UUID order, reading page_size at a time. Nodes may be put
+        while iterating.
+        """
+        last_uuid = ''
+        while True:
+            query = 'SELECT {} FROM nodes WHERE uuid > ?'.format(COLUMNS)
+            parameters = [last_uuid]
+            if alive_at is not None:
+                query += ' AND end_of_life > ?'
+                parameters.append(alive_at)
+            query += ' ORDER BY uuid LIMIT ?'
+            parameters.append(page_size)
+            with self._lock:
+                rows = self._connection.execute(query,
+                                                parameters).fetchall()
+            for row in rows:
+                yield _row_to_node(row)
+            if len(rows) < page_size:
+                return
+            last_uuid = rows[-1][0]
+
+    def active(self, now=None):
+        """
+        Returns nodes that haven't reached their end of life.
+        """
+        if now is None:
+            now = int(time())
+        return self.find(alive_at=now)
+
+    def data_version(self):
+        """
+        Returns a number that changes when another connection, in this
+        process or another, changes the database.
+        """
+        with self._lock:
+            return self._connection.execute(
+                'PRAGMA data_version').fetchone()[0]
+
+    def count(self):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM nodes').fetchone()[0]
+
+    def prune(self, now=None):
+        """
+        Removes nodes past their end of life and compacts the database.
+        Returns how many were removed.
+        """
+        if now is None:
+            now = int(time())
+        with self._lock:
+            with self._connection:
+                cursor = self._connection.execute(
+                    'DELETE FROM nodes WHERE end_of_life <= ?', (now,))
+            self._connection.execute('VACUUM')
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,36 +1,1635 @@
 """
-Just some basic tests.
+Tests against sporestack.mock_server. No network or payment needed.
 
-Kinda broken.
-
-Very broken.
+python -m pytest test.py
 """
 
-from uuid import uuid4 as random_uuid
+from contextlib import contextmanager
+from hashlib import sha1
+from time import sleep, time
+import csv
+import fcntl
+import json
 import os
+import pstats
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+
+import pytest
 
 import sporestack
+import sporestack.cache
+import sporestack.decode
+import sporestack.endpoints
+import sporestack.fleet
+import sporestack.jobs
+import sporestack.metrics
+import sporestack.options
+import sporestack.poll
+import sporestack.probe
+import sporestack.profiling
+import sporestack.profiles
+import sporestack.quote
+import sporestack.ratelimit
+import sporestack.remote
+import sporestack.renew
+import sporestack.store
+from sporestack import cli
+from sporestack.mock_server import MockServer, LAUNCH_PROFILES, OPTIONS
+
+SSHKEY = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC comment@host\n'
+
+NODE_RESPONSE = {'end_of_life': 1500000000,
+                 'payment_status': True,
+                 'creation_status': True,
+                 'address': '1BitcoinEaterAddressDontSendf59kuE',
+                 'satoshis': 100000,
+                 'ip4': '127.0.0.1',
+                 'ip6': '::1',
+                 'deprecated': False}
+
+# Stands in for ssh: echoes the script back.
+FAKE_SSH = """#!/bin/sh
+cat
+"""
+
+# Nodes in the store `sporestack list` reads. How long it takes is up to
+# bench.py, which isn't at the mercy of a busy CI machine.
+STARTUP_NODES = 200
+# Modules `sporestack list` has no business importing.
+STARTUP_FORBIDDEN = ['pyqrcode',
+                     'yaml',
+                     'httplib',
+                     'ssl',
+                     'subprocess',
+                     'multiprocessing',
+                     'uuid']
+STARTUP_SCRIPT = """
+import sys
+sys.argv = ['sporestack', 'list']
+from sporestack import cli
+try:
+    cli.main()
+except SystemExit:
+    pass
+sys.stderr.write(' '.join(sys.modules))
+"""
+
+FAST_PHASES = {'payment': (0.01, 0.01),
+               'building': (0.01, 0.01),
+               'connecting': (0.05, 0.05)}
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = MockServer().start()
+    monkeypatch.setattr(sporestack, 'ENDPOINT', server.endpoint)
+    for phase, delays in FAST_PHASES.items():
+        monkeypatch.setitem(sporestack.poll.PHASES, phase, delays)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def dot_file_path(monkeypatch, tmpdir):
+    path = str(tmpdir.join('.sporestack'))
+    monkeypatch.setattr(cli, 'DOT_FILE_PATH', path)
+    monkeypatch.setattr(cli, '_node_store', None)
+    monkeypatch.setattr(cli, '_job_queue', None)
+    monkeypatch.setattr(sporestack.cache,
+                        'CACHE_PATH',
+                        os.path.join(path, 'cache'))
+    monkeypatch.setattr(sporestack.profiles,
+                        'REGISTRY_PATH',
+                        os.path.join(path, 'profiles'))
+    yield path
+    if cli._node_store is not None:
+        cli._node_store.close()
+    if cli._job_queue is not None:
+        cli._job_queue.close()
+
+
+@pytest.fixture
+def sshkey(tmpdir):
+    path = tmpdir.join('id_rsa.pub')
+    path.write(SSHKEY)
+    return str(path)
+
+
+def test_node_transitions(server):
+    states = []
+    for _ in range(3):
+        node = sporestack.node(days=1, unique='transitions', sshkey=SSHKEY)
+        states.append((node.payment_status, node.creation_status))
+    assert states == [(False, False), (True, False), (True, True)]
+    assert node.ip4 == '127.0.0.1'
+    assert node.end_of_life > time()
+    assert server.request_count('/node') == 3
+    assert server.nodes['transitions']['request']['sshkey'] == \
+        'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC'
+
+
+def test_node_status_only_polls(server):
+    prepared = sporestack.Client().prepare_node(days=1,
+                                                unique='status',
+                                                sshkey=SSHKEY,
+                                                cloudinit='#cloud-config\n',
+                                                endpoint=server.endpoint)
+    prepared.poll()
+    prepared.poll()
+    assert 'cloudinit' in server.nodes['status']['request']
+    assert server.nodes['status']['last_request'] == {'days': 1,
+                                                      'unique': 'status'}
+
+
+def test_prepared_node_too_big(server):
+    client = sporestack.Client()
+    startupscript = 'x' * sporestack.MAX_BODY_SIZE
+    with pytest.raises(ValueError):
+        client.prepare_node(days=1,
+                            unique='huge',
+                            startupscript=startupscript,
+                            endpoint=server.endpoint)
+    # Turned away before anything is sent.
+    assert server.request_count('/node') == 0
+    prepared = client.prepare_node(days=1,
+                                   unique='huge',
+                                   startupscript=startupscript[:-1024],
+                                   endpoint=server.endpoint)
+    prepared.poll()
+    assert server.request_count('/node') == 1
+
+
+def test_poller_backoff():
+    poller = sporestack.poll.Poller(phases={'payment': (1, 5),
+                                            'building': (0.5, 5)},
+                                    factor=2,
+                                    jitter=0)
+    assert [poller.delay('payment') for _ in range(5)] == [1, 2, 4, 5, 5]
+    # A new phase starts over, and so does going back.
+    assert poller.delay('building') == 0.5
+    assert poller.delay('building') == 1
+    assert poller.delay('payment') == 1
+
+
+def test_poller_jitter():
+    poller = sporestack.poll.Poller(phases={'payment': (1, 1)}, jitter=0.1)
+    delays = [poller.delay('payment') for _ in range(1000)]
+    assert all([0.9 <= delay <= 1.1 for delay in delays])
+    assert len(set(delays)) > 1
+
+
+def test_poller_deadline():
+    delays = []
+    poller = sporestack.poll.Poller(
+        deadline=0.3,
+        callback=lambda phase, attempt, delay: delays.append(delay),
+        phases={'payment': (0.2, 0.2)},
+        jitter=0)
+    start = time()
+    with pytest.raises(sporestack.poll.PollTimeout):
+        while True:
+            poller.sleep('payment')
+    # The last sleep is cut short at the deadline.
+    assert delays[0] == 0.2
+    assert delays[1] < 0.2
+    assert 0.3 <= time() - start < 0.5
+
+
+def test_node_extras():
+    data = dict(NODE_RESPONSE, region='eu', tor=True)
+    node = sporestack.Node.from_response(data)
+    assert node.extras == {'region': 'eu', 'tor': True}
+    assert node.ip6 == '::1'
+    with pytest.raises(AttributeError):
+        node.region
+    assert sporestack.Node.from_response(NODE_RESPONSE).extras is None
+
+
+def test_node_missing_fields():
+    node = sporestack.Node.from_response({'satoshis': 100000,
+                                          'payment_status': False})
+    assert node.satoshis == 100000
+    assert node.end_of_life is None
+    assert node.ip4 is None
+    assert node.deprecated is False
+    assert node.extras is None
+
+
+def test_node_round_trip():
+    data = dict(NODE_RESPONSE, region='eu')
+    node = sporestack.Node.from_response(data)
+    assert node.to_dict() == data
+    assert sporestack.Node.from_response(node.to_dict()) == node
+    assert sporestack.Node.from_response(NODE_RESPONSE) != node
+    # Missing fields come back as their defaults.
+    assert sporestack.Node.from_response({}).to_dict() == \
+        dict([(field, None) for field in sporestack.Node.FIELDS],
+             deprecated=False)
+
+
+def test_decode_loads():
+    assert sporestack.decode.loads('{"a": [1, 2]}') == {'a': [1, 2]}
+    assert sporestack.decode.loads('{"a": 1}',
+                                   'application/json; charset=utf-8') == \
+        {'a': 1}
+    assert sporestack.decode.loads('a: 1', 'application/x-yaml') == {'a': 1}
+    # Not JSON, and nothing says it should be.
+    assert sporestack.decode.loads('a: 1') == {'a': 1}
+    with pytest.raises(ValueError):
+        sporestack.decode.loads('a: 1', 'application/json')
+
+
+def test_decode_load_file(tmpdir):
+    path = tmpdir.join('tor_relay.yaml')
+    path.write('osid: 230\ncloudinit: |\n  #cloud-config\n')
+    assert sporestack.decode.load_file(str(path)) == {
+        'osid': 230, 'cloudinit': '#cloud-config\n'}
+    path = tmpdir.join('tor_relay.json')
+    path.write('osid: 230\n')
+    with pytest.raises(ValueError):
+        sporestack.decode.load_file(str(path))
+    path.write('{"osid": 230}')
+    assert sporestack.decode.load_file(str(path)) == {'osid': 230}
+
+
+def test_node_retries_server_errors(server):
+    server.fail_next(2)
+    client = sporestack.Client(backoff=0)
+    node = client.node(days=1, unique='retries')
+    assert node.payment_status is False
+    assert server.request_count('/node') == 3
+
+
+def test_node_error_is_raised(server):
+    server.fail_next(3, status=500)
+    client = sporestack.Client(backoff=0)
+    with pytest.raises(Exception):
+        client.node(days=1, unique='fails')
+
+
+def test_node_honors_retry_after(server):
+    server.fail_next(1, status=429, retry_after=0.2)
+    client = sporestack.Client(backoff=0)
+    start = time()
+    client.node(days=1, unique='limited')
+    assert time() - start >= 0.2
+    assert server.request_count('/node') == 2
+
+
+def test_node_typed_errors(server):
+    server.fail_next(1, status=429, retry_after=3600)
+    with pytest.raises(sporestack.RateLimited) as error:
+        sporestack.Client().node(days=1, unique='limited')
+    assert error.value.retryable is True
+    assert error.value.retry_after == 3600
+    assert error.value.status == 429
+    server.fail_next(1, status=400)
+    with pytest.raises(sporestack.SporeStackError) as error:
+        sporestack.Client().node(days=1, unique='bad')
+    assert error.value.retryable is False
+
+
+def test_node_single_flight(server):
+    server.latency = 0.2
+    client = sporestack.Client()
+    nodes = []
+
+    def poll():
+        nodes.append(client.node(days=1, unique='shared'))
+    threads = [threading.Thread(target=poll) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(nodes) == 8
+    assert server.request_count('/node') == 1
+
+
+def test_options_and_launch_profiles(server):
+    assert '230' in sporestack.node_options()['osid']
+    index = sporestack.node_get_launch_profile('index')
+    assert [profile['name'] for profile in index] == ['tor_relay']
+    profile = sporestack.node_get_launch_profile('tor_relay')
+    assert profile['osid'] == 230
+
+
+@pytest.fixture
+def servers(server):
+    servers = [server, MockServer().start(), MockServer().start()]
+    yield servers
+    for extra in servers[1:]:
+        extra.stop()
+
+
+def test_endpoints_fail_over(servers):
+    servers[0].fail_next(1, status=503)
+    endpoints = sporestack.endpoints.EndpointSet(
+        [servers[0].endpoint, servers[1].endpoint])
+    client = sporestack.Client(endpoint=endpoints, backoff=0)
+    node = client.node(days=1, unique='failover')
+    assert node.payment_status is False
+    assert servers[0].request_count('/node') == 1
+    assert servers[1].request_count('/node') == 1
+    assert not endpoints.healthy(servers[0].endpoint)
+    servers[1].fail_next(1, status=500)
+    # Both down now: goes to whichever comes back first.
+    client.node(days=1, unique='failover')
+    assert servers[0].request_count('/node') == 2
+    assert servers[1].request_count('/node') == 2
+
+
+def test_endpoints_prefer_fastest(servers):
+    servers[0].latency = 0.1
+    servers[2].latency = 0.05
+    endpoints = sporestack.endpoints.EndpointSet(
+        [mock.endpoint for mock in servers])
+    client = sporestack.Client(endpoint=endpoints)
+    for _ in range(3):
+        client.node_options()
+    for index in range(6):
+        client.node(days=1, unique='fast{}'.format(index))
+    assert servers[1].request_count('/node') == 6
+    assert endpoints.latency[servers[1].endpoint] < \
+        endpoints.latency[servers[2].endpoint] < \
+        endpoints.latency[servers[0].endpoint]
+
+
+def test_endpoints_sticky(servers):
+    endpoints = sporestack.endpoints.EndpointSet(
+        [mock.endpoint for mock in servers])
+    client = sporestack.Client(endpoint=endpoints)
+    client.node(days=1, unique='sticky')
+    first = endpoints.choose('sticky')
+    for mock in servers:
+        mock.latency = 0 if mock.endpoint != first else 0.05
+    for _ in range(4):
+        client.node_options()
+        client.node(days=1, unique='sticky')
+    assert [mock.request_count('/node') for mock in servers
+            if mock.endpoint == first] == [5]
+    assert endpoints.choose() != first
+
+
+def test_endpoint_option(server, dot_file_path):
+    extra = MockServer().start()
+    try:
+        extra.fail_next(100, status=500)
+        endpoint = cli.endpoint_option([extra.endpoint, server.endpoint])
+        assert isinstance(endpoint, sporestack.endpoints.EndpointSet)
+        # The default is left alone.
+        assert sporestack.ENDPOINT == server.endpoint
+        assert cli.endpoint_option([server.endpoint]) == server.endpoint
+        assert cli.endpoint_option(None) is None
+        profile = cli.launch_settings('tor_relay', endpoint=endpoint)
+        assert profile.settings['osid'] == 230
+        assert server.request_count('/launch/tor_relay.json') == 1
+        # Cached under the endpoint that answered.
+        entry = sporestack.cache.load('launch_tor_relay')
+        assert entry['url'] == server.endpoint + '/launch/tor_relay.json'
+    finally:
+        extra.stop()
+
+
+def test_compressed_transport(server):
+    cloudinit = '#cloud-config\nruncmd:\n' + '  - echo provisioning\n' * 2000
+    server.launch_profiles = {'big': dict(LAUNCH_PROFILES['tor_relay'],
+                                          name='big',
+                                          cloudinit=cloudinit)}
+    client = sporestack.Client()
+    assert client.node_get_launch_profile('big')['cloudinit'] == cloudinit
+    assert server.bytes_sent < len(cloudinit) / 10
+    body = sporestack.node_body(days=1, unique='big', cloudinit=cloudinit)
+    client.node(days=1, unique='big', cloudinit=cloudinit)
+    assert server.bytes_received < len(body) / 2
+    assert server.nodes['big']['request']['cloudinit'] == \
+        sporestack.encode_cloudinit(cloudinit)
+    # Small bodies go as they are, both ways.
+    small = json.dumps({'days': 1, 'unique': 'small'})
+    response = client.request('POST', '/node', body=small)
+    assert 'content-encoding' not in response.headers
+    assert server.nodes['small']['request'] == json.loads(small)
+
+
+def test_compression_refused(server):
+    server.compress = False
+    client = sporestack.Client()
+    pool = client.pool()
+    pool.accepted_codings = set(['gzip'])
+    node = client.node(days=1, unique='plain', cloudinit='x' * 4096)
+    assert node.payment_status is False
+    assert server.request_count('/node') == 2
+    assert pool.accepted_codings == set()
+    assert client.node_options()['osid'] == OPTIONS['osid']
+
+
+def test_list_startup(tmpdir):
+    """
+    `sporestack list` over a stored fleet, without STARTUP_FORBIDDEN.
+    """
+    home = tmpdir.mkdir('home')
+    store = sporestack.store.NodeStore(str(home.join('.sporestack')))
+    for number in range(STARTUP_NODES):
+        store.put({'uuid': 'startup-{}'.format(number),
+                   'ip4': '127.0.0.1',
+                   'ip6': '::1',
+                   'end_of_life': int(time()) + 86400})
+    store.close()
+    environment = dict(os.environ)
+    environment['HOME'] = str(home)
+    environment['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               env=environment)
+    output, modules = process.communicate()
+    # The real list path, not "Run spawn, first."
+    assert output.count('UUID: startup-') == STARTUP_NODES
+    imported = [module for module in STARTUP_FORBIDDEN
+                if module in modules.split()]
+    assert imported == []
+
+
+def test_spawn_and_list(server, dot_file_path, sshkey, capsys):
+    cli.spawn(uuid='spawned',
+              days=1,
+              sshkey=sshkey,
+              launch='tor_relay',
+              group='relays')
+    assert server.nodes['spawned']['polls'] == 3
+    assert server.nodes['spawned']['request']['cloudinit'] == \
+        sporestack.encode_cloudinit('#cloud-config\n')
+    node = cli.node_info('spawned')
+    assert node['ip4'] == '127.0.0.1'
+    assert node['launch_profile'] == 'tor_relay'
+    assert node['group'] == 'relays'
+    capsys.readouterr()
+    cli.list()
+    output = capsys.readouterr()[0]
+    assert 'UUID: spawned' in output
+    assert 'Group: relays' in output
+
+
+def test_spawn_timings(server, dot_file_path, sshkey):
+    timings = sporestack.metrics.Timings()
+    sporestack.metrics.add_hook(timings)
+    try:
+        cli.spawn(uuid='timed', days=1, sshkey=sshkey, launch='tor_relay')
+    finally:
+        sporestack.metrics.remove_hook(timings)
+    phases = [name for name, _ in timings.phases]
+    assert phases == ['launch profile', 'payment', 'building']
+    assert timings.requests['/node'][0] == 3
+    assert 'payment' in timings.report()
+
+
+def test_metrics_export(server, tmpdir):
+    prometheus_path = str(tmpdir.join('sporestack.prom'))
+    jsonl_path = str(tmpdir.join('sporestack.jsonl'))
+    with sporestack.metrics.exporting(prometheus_path), \
+            sporestack.metrics.exporting(jsonl_path, 'jsonl'):
+        sporestack.node(days=1, unique='exported')
+        sporestack.node(days=1, unique='exported')
+    with open(prometheus_path) as prometheus_file:
+        prometheus = prometheus_file.read()
+    labels = 'endpoint="{}",path="/node"'.format(server.endpoint)
+    assert 'sporestack_requests_total{{{},status="200"}} 2'.format(labels) \
+        in prometheus
+    assert 'sporestack_request_seconds_count{{{}}} 2'.format(labels) \
+        in prometheus
+    with open(jsonl_path) as jsonl_file:
+        events = [json.loads(line)['event'] for line in jsonl_file]
+    assert events == ['request_start',
+                      'request_end',
+                      'node_status',
+                      'request_start',
+                      'request_end',
+                      'node_status']
+
+
+def cached_options(server, body, age, etag=None, url=None):
+    sporestack.cache.save('options', {
+        'url': url or server.endpoint + '/node/options',
+        'fetched': time() - age,
+        'etag': etag,
+        'last_modified': None,
+        'body': body})
+
+
+def test_cache_fresh(server, dot_file_path):
+    assert sporestack.cache.node_options() == OPTIONS
+    assert sporestack.cache.node_options() == OPTIONS
+    assert server.request_count('/node/options') == 1
+
+
+def test_cache_stale(server, dot_file_path):
+    cached_options(server, 'stale', sporestack.cache.TTL + 10)
+    server.latency = 1
+    before = set(threading.enumerate())
+    start = time()
+    assert sporestack.cache.get('options', '/node/options') == 'stale'
+    assert time() - start < 0.5
+    revalidating = set(threading.enumerate()) - before
+    assert len(revalidating) != 0
+    # A daemon, so exiting doesn't wait for it.
+    assert all([thread.daemon for thread in revalidating])
+    for thread in revalidating:
+        thread.join()
+    assert sporestack.cache.load('options')['body'] != 'stale'
+
+
+def test_cache_stale_revalidates_once(server, dot_file_path, monkeypatch):
+    monkeypatch.setattr(sporestack.cache, 'BACKGROUND_TIMEOUT', 0.2)
+    cached_options(server, 'stale', sporestack.cache.TTL + 10)
+    server.fail_next(5, status=503)
+    before = set(threading.enumerate())
+    assert sporestack.cache.get('options', '/node/options') == 'stale'
+    for thread in set(threading.enumerate()) - before:
+        thread.join()
+    assert server.request_count('/node/options') == 1
+    assert sporestack.cache.load('options')['body'] == 'stale'
+
+
+def test_cache_expired(server, dot_file_path):
+    cached_options(server,
+                   'expired',
+                   sporestack.cache.TTL + sporestack.cache.STALE_TTL + 10)
+    assert sporestack.cache.node_options() == OPTIONS
+    assert server.request_count('/node/options') == 1
+
+
+def test_cache_etag_304(server, dot_file_path):
+    body = json.dumps(OPTIONS)
+    etag = '"{}"'.format(sha1(body).hexdigest())
+    cached_options(server,
+                   'unchanged',
+                   sporestack.cache.TTL + sporestack.cache.STALE_TTL + 10,
+                   etag=etag)
+    # A 304 keeps what we have.
+    assert sporestack.cache.get('options', '/node/options') == 'unchanged'
+    assert server.request_count('/node/options') == 1
+    entry = sporestack.cache.load('options')
+    assert time() - entry['fetched'] < 5
+    # refresh revalidates even a fresh entry.
+    assert sporestack.cache.get('options',
+                                '/node/options',
+                                refresh=True) == 'unchanged'
+    assert server.request_count('/node/options') == 2
+
+
+def test_cache_url_mismatch(server, dot_file_path):
+    cached_options(server, 'elsewhere', 0, url='http://elsewhere/options')
+    assert sporestack.cache.node_options() == OPTIONS
+    assert server.request_count('/node/options') == 1
+
+
+def test_cache_endpoint(server, dot_file_path):
+    other = MockServer().start()
+    try:
+        cached_options(server, 'elsewhere', 0)
+        # Another endpoint's copy isn't used.
+        assert sporestack.cache.node_options(endpoint=other.endpoint) == \
+            OPTIONS
+        assert other.request_count('/node/options') == 1
+        # Any endpoint of a set will do, and the default is unchanged.
+        endpoints = sporestack.endpoints.EndpointSet([server.endpoint,
+                                                      other.endpoint])
+        assert sporestack.cache.node_options(endpoint=endpoints) == OPTIONS
+        assert other.request_count('/node/options') == 1
+        assert sporestack.cache.get('options', '/node/options') != \
+            'elsewhere'
+        assert server.request_count('/node/options') == 1
+    finally:
+        other.stop()
+
+
+def test_refresh_options_after_subcommand(server, dot_file_path,
+                                          monkeypatch):
+    called = []
+    monkeypatch.setattr(cli, 'spawn_wrapper', called.append)
+    monkeypatch.setattr(cli,
+                        'spawn_help',
+                        lambda refresh: called.append(refresh))
+    for argv in (['spawn', '--refresh-options'],
+                 ['--refresh-options', 'spawn'],
+                 ['spawn']):
+        monkeypatch.setattr('sys.argv', ['sporestack'] + argv)
+        cli.main()
+    # Left to spawn, which refreshes as it checks its settings.
+    assert [args.refresh_options for args in called] == [True, True, False]
+
+
+def test_refresh_options_only_for_catalog(server, dot_file_path,
+                                          monkeypatch):
+    monkeypatch.setattr('sys.argv',
+                        ['sporestack', '--refresh-options', 'list'])
+    with pytest.raises(SystemExit):
+        # No nodes yet.
+        cli.main()
+    assert server.request_count('/node/options') == 0
+    cli.quote(days=[1], flavors=[94], dcids=[3])
+    cli.quote(days=[1], flavors=[94], dcids=[3], refresh_options=True)
+    assert server.request_count('/node/options') == 2
+
+
+def test_options_index():
+    options = dict(OPTIONS)
+    options['osid'] = dict(options['osid'],
+                           **{'241': {'name': 'Ubuntu 16.04 x64',
+                                      'dcid': ['1', '7']}})
+    index = sporestack.options.OptionsIndex(options)
+    index.validate(230, 3, 29)
+    index.validate(241, 7, 94)
+    index.validate(230, None, None)
+    for osid, dcid, flavor in ((999, 3, 29), (230, 99, 29), (241, 3, 29),
+                               (230, 3, 1)):
+        with pytest.raises(ValueError):
+            index.validate(osid, dcid, flavor)
+    assert index.flavor() == 29
+    assert index.flavor(min_ram=1000) == 93
+    assert index.flavor(min_vcpu=2) == 94
+    assert index.flavor(min_ram=3000, min_vcpu=2) == 95
+    with pytest.raises(ValueError):
+        index.flavor(min_vcpu=8)
+
+
+def test_options_string_sizes():
+    options = dict(OPTIONS)
+    options['flavor'] = dict([
+        (flavor, dict([(key, str(value)) for key, value in record.items()]))
+        for flavor, record in OPTIONS['flavor'].items()])
+    index = sporestack.options.OptionsIndex(options)
+    assert index.flavor(min_ram=1000) == 93
+    assert index.flavor(min_ram=3000, min_vcpu=2) == 95
+    row = sporestack.quote._row(94, 3, 7, 7 * 302400, 'fetched',
+                                options['flavor']['94'])
+    assert row['per_vcpu_day'] == 151200
+    assert row['per_gb_ram_day'] == 151200
+
+
+def test_spawn_checks_options(server, dot_file_path, sshkey):
+    with pytest.raises(SystemExit):
+        cli.spawn(uuid='badosid',
+                  days=1,
+                  sshkey=sshkey,
+                  osid=999,
+                  dcid=3,
+                  flavor=29,
+                  connectafter=False)
+    assert server.request_count('/node') == 0
+    cli.spawn(uuid='bigger',
+              days=1,
+              sshkey=sshkey,
+              osid=230,
+              dcid=3,
+              flavor=29,
+              flavor_min_ram=2048,
+              connectafter=False)
+    assert server.nodes['bigger']['request']['flavor'] == 94
+
+
+def test_profile_registry(server, dot_file_path, monkeypatch):
+    profile = sporestack.profiles.get('tor_relay')
+    assert sporestack.profiles.get('tor_relay').digest == profile.digest
+    assert server.request_count('/launch/tor_relay.json') == 1
+    assert profile.encoded_cloudinit == \
+        sporestack.encode_cloudinit('#cloud-config\n')
 
-script = """#!/bin/sh
-            date > /date
-         """
-new_uuid = str(random_uuid())
+    changed = dict(server.launch_profiles['tor_relay'], flavor=93)
+    monkeypatch.setitem(server.launch_profiles, 'tor_relay', changed)
+    latest = sporestack.profiles.get('tor_relay', refresh=True)
+    assert latest.settings['flavor'] == 93
+    pinned = sporestack.profiles.get(profile.pinned)
+    assert pinned.settings['flavor'] == 29
+    assert len(sporestack.profiles.versions('tor_relay')) == 2
 
-ssh_key_path = '{}/.ssh/id_rsa.pub'.format(os.getenv('HOME'))
 
-with open(ssh_key_path) as ssh_key_file:
-    sshkey = ssh_key_file.read()
+def test_profile_offline(server, dot_file_path):
+    sporestack.profiles.get('tor_relay')
+    os.remove(os.path.join(sporestack.cache.CACHE_PATH,
+                           'launch_tor_relay.json'))
+    server.fail_next(10)
+    client = sporestack.default_client()
+    backoff = client.backoff
+    client.backoff = 0
+    try:
+        assert sporestack.profiles.get('tor_relay').settings['osid'] == 230
+    finally:
+        client.backoff = backoff
 
-for unique in ['3b69d7c9-ad4d-4d31-b04e-b224f02de4d4',
-               new_uuid]:
-    node = sporestack.node(days=1,
+
+def test_profile_validation():
+    with pytest.raises(ValueError):
+        sporestack.profiles.from_settings('bad', {'osid': 'x', 'flavor': 29})
+    with pytest.raises(ValueError):
+        sporestack.profiles.from_settings('bad', {'osid': 230,
+                                                  'flavor': 29,
+                                                  'cloudinit': 5})
+
+
+def test_renewal_queue():
+    queue = sporestack.renew.RenewalQueue(window=100)
+    queue.load([{'uuid': 'late', 'end_of_life': 1000},
+                {'uuid': 'soon', 'end_of_life': 200},
+                {'uuid': 'sooner', 'end_of_life': 150}])
+    assert queue.next_due() == 50
+    assert queue.pop_due(now=0) == []
+    due = queue.pop_due(now=60, batch_window=60)
+    assert [node['uuid'] for node in due] == ['sooner', 'soon']
+    queue.push({'uuid': 'late', 'end_of_life': 2000})
+    assert queue.next_due() == 1900
+    assert len(queue) == 1
+
+
+def test_renew_daemon(server, dot_file_path):
+    server.renew_window = 30 * 86400
+    uuids = ['renew-{}'.format(number) for number in range(3)]
+    store = cli.node_store()
+    for uuid in uuids:
+        created = sporestack.fleet.wait_until_created(days=1, unique=uuid)
+        cli.save_node(uuid, created, group='renewed')
+    before = dict([(uuid, store.get(uuid)['end_of_life']) for uuid in uuids])
+    summaries = []
+    renewed = []
+    sporestack.renew.run(store,
+                         days=7,
+                         group='renewed',
+                         client=sporestack.Client(backoff=0),
+                         on_unpaid=summaries.append,
+                         on_renewed=renewed.append,
+                         once=True)
+    assert len(summaries) == 1
+    assert sorted([node['uuid'] for node, _ in summaries[0]]) == uuids
+    assert sorted([node['uuid'] for node in renewed]) == uuids
+    for uuid in uuids:
+        assert store.get(uuid)['end_of_life'] == before[uuid] + 7 * 86400
+
+
+def test_renew_daemon_unpaid(server, dot_file_path):
+    server.renew_window = 30 * 86400
+    store = cli.node_store()
+    for uuid in ('stuck', 'prompt'):
+        created = sporestack.fleet.wait_until_created(days=1, unique=uuid)
+        cli.save_node(uuid, created)
+    # Renewals are only paid for when we say.
+    server.polls_to_pay = 1000000
+    end_of_life = store.get('stuck')['end_of_life']
+    store.put(dict(store.get('prompt'), end_of_life=end_of_life + 1))
+    renewed = []
+    failed = []
+    start = time()
+    thread = threading.Thread(
+        target=sporestack.renew.run,
+        args=(store,),
+        kwargs={'window': end_of_life - start,
+                'batch_window': 0,
+                'client': sporestack.Client(backoff=0),
+                'on_renewed': lambda node: renewed.append((node, time())),
+                'on_failed': lambda nodes, error: failed.append(
+                    ([node['uuid'] for node in nodes], error, time())),
+                'payment_deadline': 2,
+                'once': True})
+    thread.start()
+    while server.nodes['prompt']['renewal'] is None:
+        sleep(0.01)
+    server.pay('prompt')
+    thread.join()
+    # Due a second after stuck, and renewed while stuck awaited payment.
+    assert [node['uuid'] for node, _ in renewed] == ['prompt']
+    assert 1 <= renewed[0][1] - start < 1.5
+    assert [uuids for uuids, _, _ in failed] == [['stuck']]
+    assert isinstance(failed[0][1], sporestack.poll.PollTimeout)
+    assert failed[0][2] - start >= 2
+    assert store.get('prompt')['end_of_life'] == end_of_life + 7 * 86400
+    assert store.get('stuck')['end_of_life'] == end_of_life
+
+
+def test_list_formats(server, dot_file_path, capsys):
+    store = cli.node_store()
+    for number in range(20):
+        uuid = 'listed-{:02}'.format(number)
+        created = sporestack.fleet.wait_until_created(days=1, unique=uuid)
+        cli.save_node(uuid, created, days=1)
+    store.put(dict(store.get('listed-19'), end_of_life=1))
+    requests = server.request_count()
+    capsys.readouterr()
+    cli.list(output_format='json')
+    lines = capsys.readouterr()[0].splitlines()
+    assert len(lines) == 19
+    assert set([json.loads(line)['ip4'] for line in lines]) == \
+        set(['127.0.0.1'])
+    cli.list(output_format='csv')
+    lines = capsys.readouterr()[0].splitlines()
+    assert lines[0] == 'uuid,ip4,ip6,end_of_life,launch_profile,group'
+    assert lines[1].startswith('listed-00,127.0.0.1,::1,')
+    assert len(lines) == 20
+    # Listing never asks /node, which could renew nodes.
+    assert server.request_count() == requests
+
+
+def test_list_refresh(server, dot_file_path, capsys):
+    store = cli.node_store()
+    for number in range(20):
+        uuid = 'refresh-{:02}'.format(number)
+        created = sporestack.fleet.wait_until_created(days=1, unique=uuid)
+        cli.save_node(uuid, created, days=1)
+        store.put(dict(store.get(uuid), ip4='10.0.0.1', end_of_life=1))
+    # Asked about, but never paid for.
+    server.polls_to_pay = 1000000
+    sporestack.node(days=1, unique='unpaid')
+    store.put({'uuid': 'unpaid', 'ip4': '10.0.0.2', 'end_of_life': 1})
+    end_of_life = server.nodes['refresh-07']['end_of_life']
+    capsys.readouterr()
+    cli.list(refresh=True, output_format='json', concurrency=4, rate=1000)
+    output = capsys.readouterr()
+    lines = output.out.splitlines()
+    assert len(lines) == 21
+    assert set([json.loads(line)['ip4'] for line in lines]) == \
+        set(['127.0.0.1', '10.0.0.2'])
+    assert store.get('refresh-07')['ip4'] == '127.0.0.1'
+    assert store.get('refresh-07')['end_of_life'] == end_of_life
+    assert store.get('refresh-07')['days'] == 1
+    # Status asks only, and the unpaid node is left as it was.
+    assert server.nodes['refresh-07']['last_request'] == \
+        {'days': 1, 'unique': 'refresh-07'}
+    assert server.nodes['unpaid']['paid_at'] is None
+    assert store.get('unpaid')['ip4'] == '10.0.0.2'
+    assert 'unpaid: not paid for and created' in output.err
+
+
+def legacy_dot_files(directory):
+    """
+    A ~/.sporestack from before the node store: two node files, one of them
+    without its uuid, and some that aren't nodes at all.
+    """
+    now = int(time())
+    directory.join('old-1.json').write(json.dumps(
+        {'uuid': 'old-1',
+         'ip4': '127.0.0.1',
+         'ip6': '::1',
+         'end_of_life': now + 86400,
+         'launch_profile': 'tor_relay',
+         'group': 'relays',
+         'days': 1}))
+    directory.join('old-2.json').write(json.dumps(
+        {'ip4': '127.0.0.2',
+         'ip6': None,
+         'end_of_life': now + 7 * 86400}))
+    directory.join('truncated.json').write('{"uuid": "truncated", "ip4"')
+    directory.join('list.json').write('[]')
+    directory.join('no-end.json').write(json.dumps({'uuid': 'no-end'}))
+    directory.join('id_rsa.pub').write(SSHKEY)
+
+
+def test_store_migrates_node_files(tmpdir):
+    directory = tmpdir.mkdir('.sporestack')
+    legacy_dot_files(directory)
+    store = sporestack.store.NodeStore(str(directory))
+    assert [node['uuid'] for node in store.active()] == ['old-1', 'old-2']
+    old = store.get('old-1')
+    assert old['launch_profile'] == 'tor_relay'
+    assert old['group'] == 'relays'
+    # Keys without a column of their own come back from extra.
+    assert old['days'] == 1
+    assert store.get('old-2')['ip4'] == '127.0.0.2'
+    # Node files are left in place.
+    assert directory.join('old-1.json').check()
+    store.close()
+
+
+def test_store_migration_idempotent(tmpdir):
+    directory = tmpdir.mkdir('.sporestack')
+    legacy_dot_files(directory)
+    store = sporestack.store.NodeStore(str(directory))
+    renewed = store.get('old-1')['end_of_life'] + 86400
+    store.put(dict(store.get('old-1'), end_of_life=renewed))
+    # Running it again imports nothing and doesn't undo the renewal.
+    assert store.migrate() == 0
+    assert store.count() == 2
+    assert store.get('old-1')['end_of_life'] == renewed
+    store.close()
+    # Nor does opening the store again.
+    directory.join('old-3.json').write(json.dumps(
+        {'uuid': 'old-3', 'end_of_life': int(time()) + 86400}))
+    store = sporestack.store.NodeStore(str(directory))
+    assert store.count() == 2
+    assert store.get('old-1')['end_of_life'] == renewed
+    store.close()
+
+
+def test_store_prune(tmpdir):
+    store = sporestack.store.NodeStore(str(tmpdir))
+    now = int(time())
+    for number, end_of_life in enumerate([now - 86400, now, now + 1,
+                                          now + 86400]):
+        store.put({'uuid': 'pruned-{}'.format(number),
+                   'end_of_life': end_of_life})
+    assert store.prune(now=now) == 2
+    assert [node['uuid'] for node in store.find()] == ['pruned-2',
+                                                       'pruned-3']
+    assert store.prune(now=now) == 0
+    store.close()
+
+
+def test_token_bucket():
+    bucket = sporestack.ratelimit.TokenBucket(rate=100, burst=5)
+    delays = [bucket.reserve() for _ in range(10)]
+    assert delays[:5] == [0] * 5
+    assert 0.04 < delays[-1] <= 0.05
+
+
+def test_list_before_spawn(dot_file_path, capsys):
+    with pytest.raises(SystemExit):
+        cli.list()
+    assert capsys.readouterr()[0] == 'Run spawn, first.\n'
+
+
+def test_ssh_waits_for_port(server, dot_file_path, tmpdir, monkeypatch,
+                            capsys):
+    fake_ssh = tmpdir.join('ssh')
+    fake_ssh.write(FAKE_SSH)
+    fake_ssh.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+    cli.node_store().put({'uuid': 'late',
+                          'ip4': '127.0.0.1',
+                          'ip6': None,
+                          'end_of_life': int(time()) + 86400,
+                          'launch_profile': None,
+                          'group': None})
+    # Bound but not listening yet, so connections are refused until the
+    # node "comes online".
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+
+    def come_online():
+        sleep(0.3)
+        listener.listen(1)
+    thread = threading.Thread(target=come_online)
+    thread.start()
+    try:
+        start = time()
+        result = cli.ssh('late', stdin='uptime\n', port=port)
+        assert time() - start >= 0.3
+        assert result.exit_code == 0
+        assert capsys.readouterr().out == 'uptime\n'
+        fake_ssh.write('#!/bin/sh\necho failed >&2\nexit 3\n')
+        with pytest.raises(SystemExit) as exit_info:
+            cli.ssh('late', stdin='uptime\n', port=port)
+        assert exit_info.value.code == 3
+        assert 'failed\n' in capsys.readouterr().err
+    finally:
+        thread.join()
+        listener.close()
+
+
+# TEST-NET-1: never answers, so connections to it time out.
+BLACKHOLE = '192.0.2.1'
+
+
+@pytest.fixture
+def listening(monkeypatch):
+    """
+    A port listening on 127.0.0.1 but not on 127.0.0.2, where connections
+    are refused. Connections to BLACKHOLE hang until their timeout.
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    create_connection = socket.create_connection
+
+    def blackholed(address, timeout=None, *args, **kwargs):
+        if address[0] == BLACKHOLE:
+            sleep(timeout)
+            raise socket.timeout('timed out')
+        return create_connection(address, timeout, *args, **kwargs)
+    monkeypatch.setattr(socket, 'create_connection', blackholed)
+    yield listener.getsockname()[1]
+    listener.close()
+
+
+def test_race_blackholed_first(listening):
+    start = time()
+    winner = sporestack.probe.race([BLACKHOLE, '127.0.0.1'],
+                                   listening,
+                                   timeout=2,
+                                   attempt_delay=0.1)
+    elapsed = time() - start
+    assert winner == '127.0.0.1'
+    # Costs the attempt delay, not the blackholed address's timeout.
+    assert 0.1 <= elapsed < 1
+
+
+def test_race_refused_first(listening):
+    start = time()
+    winner = sporestack.probe.race(['127.0.0.2', '127.0.0.1'],
+                                   listening,
+                                   attempt_delay=1)
+    # A refused attempt starts the next one without waiting.
+    assert winner == '127.0.0.1'
+    assert time() - start < 0.5
+
+
+def test_race_unreachable(listening):
+    start = time()
+    assert sporestack.probe.race([BLACKHOLE, '127.0.0.2'],
+                                 listening,
+                                 timeout=0.3,
+                                 attempt_delay=0.05) is None
+    # Waits for the blackholed attempt to time out.
+    assert 0.3 <= time() - start < 1
+
+
+def test_wait_for_port_deadline(listening, monkeypatch):
+    for phase, delays in FAST_PHASES.items():
+        monkeypatch.setitem(sporestack.poll.PHASES, phase, delays)
+    assert sporestack.probe.wait_for_port({'ip6': None, 'ip4': '127.0.0.1'},
+                                          port=listening,
+                                          deadline=1) == '127.0.0.1'
+    start = time()
+    with pytest.raises(sporestack.poll.PollTimeout):
+        sporestack.probe.wait_for_port({'ip6': None, 'ip4': '127.0.0.2'},
+                                       port=listening,
+                                       deadline=0.3)
+    assert 0.3 <= time() - start < 1
+
+
+def test_queue_and_worker(server, dot_file_path, sshkey, capsys):
+    uuids = cli.spawn_many(count=3,
+                           days=1,
+                           sshkey=sshkey,
+                           osid=230,
+                           dcid=3,
+                           flavor=29,
+                           group='queued',
+                           queue=True)
+    assert server.request_count('/node') == 0
+    assert cli.job_queue().counts() == {'queued': 3}
+    cli.worker(concurrency=2, once=True)
+    assert cli.job_queue().counts() == {'done': 3}
+    stored = cli.node_store().find(group='queued')
+    assert sorted([node['uuid'] for node in stored]) == sorted(uuids)
+    states = [line.split()[1] for line in
+              capsys.readouterr().err.splitlines() if line.startswith(
+                  uuids[0])]
+    assert states == ['pending_payment', 'building', 'done']
+
+
+def test_worker_resumes(server, dot_file_path):
+    queue = cli.job_queue()
+    request = {'days': 1, 'unique': 'resumed', 'osid': 230}
+    queue.put('resumed', request)
+    queue.put('elsewhere', dict(request, unique='elsewhere'))
+    # A worker got as far as the payment phase, then died.
+    node = sporestack.node(**request)
+    queue.checkpoint('resumed', 'pending_payment', node)
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    queue._connection.execute(
+        'UPDATE jobs SET worker = ? WHERE uuid = ?', (dead.pid, 'resumed'))
+    # Another worker is alive and busy with this one.
+    queue._connection.execute(
+        'UPDATE jobs SET worker = ? WHERE uuid = ?',
+        (os.getppid(), 'elsewhere'))
+    queue._connection.commit()
+    job = queue.claim()
+    assert job['uuid'] == 'resumed'
+    assert job['state'] == 'pending_payment'
+    assert job['node']['payment_status'] is False
+    assert queue.claim() is None
+    sporestack.jobs.process(job, queue, cli.node_store())
+    assert queue.get('resumed')['state'] == 'done'
+    assert queue.get('resumed')['worker'] is None
+    assert server.nodes['resumed']['polls'] == 3
+    assert cli.node_store().get('resumed') is not None
+
+
+def test_worker_postlaunch(server, dot_file_path, tmpdir, monkeypatch):
+    fake_ssh = tmpdir.join('ssh')
+    fake_ssh.write('#!/bin/sh\ncat > /dev/null\nexit 3\n')
+    fake_ssh.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    states = []
+    try:
+        queue = cli.job_queue()
+        queue.put('post', {'days': 1,
+                           'unique': 'post',
+                           'postlaunch': 'echo hi\n'})
+        sporestack.jobs.run(queue,
+                            cli.node_store(),
+                            concurrency=1,
+                            on_state=lambda job, state, node: states.append(
+                                state),
+                            once=True,
+                            port=listener.getsockname()[1])
+    finally:
+        listener.close()
+    assert states == ['pending_payment', 'building', 'reachable', 'failed']
+    assert queue.get('post')['error'] == 'postlaunch exit code 3'
+
+
+def test_worker_retries(server, dot_file_path, tmpdir, monkeypatch):
+    queue = sporestack.jobs.JobQueue(str(tmpdir), max_attempts=3,
+                                     backoff=0.05)
+    queue.put('flaky', {'days': 1, 'unique': 'flaky'})
+    server.fail_next(100, status=503)
+    errors = []
+    start = time()
+    sporestack.jobs.run(queue,
+                        cli.node_store(),
+                        concurrency=2,
+                        client=sporestack.Client(retries=0),
+                        on_error=lambda job, error: errors.append(error),
+                        once=True)
+    # Retried after 0.05 and 0.1 seconds, then failed.
+    assert time() - start >= 0.15
+    assert server.request_count('/node') == 3
+    assert len(errors) == 2
+    job = queue.get('flaky')
+    assert job['state'] == 'failed'
+    assert job['error'].startswith('gave up after 3 attempts')
+    assert job['worker'] is None
+    queue.close()
+
+
+def test_worker_fails_without_ssh(server, dot_file_path, tmpdir,
+                                  monkeypatch):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    empty = tmpdir.mkdir('empty')
+    monkeypatch.setenv('PATH', str(empty))
+    try:
+        queue = cli.job_queue()
+        queue.put('nossh', {'days': 1,
+                            'unique': 'nossh',
+                            'postlaunch': 'echo hi\n'})
+        sporestack.jobs.run(queue,
+                            cli.node_store(),
+                            concurrency=1,
+                            once=True,
+                            port=listener.getsockname()[1])
+    finally:
+        listener.close()
+    job = queue.get('nossh')
+    assert job['state'] == 'failed'
+    assert 'No such file' in job['error']
+    assert job['attempts'] == 0
+
+
+def test_worker_port_deadline(server, dot_file_path):
+    unused = socket.socket()
+    unused.bind(('127.0.0.1', 0))
+    port = unused.getsockname()[1]
+    unused.close()
+    queue = cli.job_queue()
+    queue.put('closed', {'days': 1,
+                         'unique': 'closed',
+                         'postlaunch': 'echo hi\n'})
+    start = time()
+    sporestack.jobs.process(queue.claim(),
+                            queue,
+                            cli.node_store(),
+                            port=port,
+                            reachable_timeout=0.3)
+    assert time() - start < 3
+    job = queue.get('closed')
+    assert job['state'] == 'failed'
+    assert job['error'] == 'port {} not open after 0.3 seconds'.format(port)
+
+
+def test_worker_payment_timeout(server, dot_file_path):
+    # Never paid for.
+    server.polls_to_pay = 1000000
+    queue = cli.job_queue()
+    for uuid in ('unpaid-1', 'unpaid-2'):
+        queue.put(uuid, {'days': 1, 'unique': uuid})
+    start = time()
+    sporestack.jobs.run(queue,
+                        cli.node_store(),
+                        concurrency=1,
+                        once=True,
+                        payment_timeout=0.3)
+    # Neither job holds the only worker thread for more than its timeout.
+    assert time() - start < 3
+    for uuid in ('unpaid-1', 'unpaid-2'):
+        job = queue.get(uuid)
+        assert job['state'] == 'failed'
+        assert job['error'] == 'still pending_payment after 0.3 seconds'
+        assert job['node']['payment_status'] is False
+
+
+def test_job_queue_adds_columns(tmpdir):
+    connection = sqlite3.connect(str(tmpdir.join('jobs.sqlite')))
+    connection.executescript('''
+        CREATE TABLE jobs (uuid TEXT PRIMARY KEY, state TEXT NOT NULL,
+                           request TEXT NOT NULL, node TEXT, worker INTEGER,
+                           error TEXT, created REAL NOT NULL,
+                           updated REAL NOT NULL);
+        INSERT INTO jobs VALUES ('old', 'queued', '{}', NULL, NULL, NULL,
+                                 0, 0);
+    ''')
+    connection.close()
+    queue = sporestack.jobs.JobQueue(str(tmpdir))
+    assert queue.claim()['attempts'] == 0
+    queue.close()
+
+
+def test_spawn_many_count(server, dot_file_path, sshkey, monkeypatch,
+                          capsys):
+    monkeypatch.setattr('sys.argv', ['sporestack', 'spawn-many', '--count',
+                                     '0', '--ssh_key', sshkey])
+    with pytest.raises(SystemExit) as exit_info:
+        cli.main()
+    assert exit_info.value.code == 1
+    assert '--count must be at least 1.' in capsys.readouterr().err
+    assert server.request_count('/node') == 0
+    assert cli.spawn_many(count=0, days=1, sshkey=sshkey) == []
+
+
+class CountingClient(sporestack.Client):
+    """
+    A Client that records the most requests it had in flight at once.
+    """
+    def __init__(self, *args, **kwargs):
+        sporestack.Client.__init__(self, *args, **kwargs)
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self._count_lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        with self._count_lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            return sporestack.Client.request(self, *args, **kwargs)
+        finally:
+            with self._count_lock:
+                self.in_flight -= 1
+
+
+def test_fleet_concurrency(server):
+    server.latency = 0.05
+    client = CountingClient(pool_size=4)
+    fleet = sporestack.fleet.Fleet(concurrency=4, client=client)
+    results = [fleet.node(days=1, unique='fleet{}'.format(number))
+               for number in range(16)]
+    try:
+        assert all([result.get(5).satoshis > 0 for result in results])
+    finally:
+        fleet.close()
+    assert client.most_in_flight == 4
+
+
+def test_fleet_close(server):
+    server.latency = 0.1
+    fleet = sporestack.fleet.Fleet(concurrency=2)
+    results = [fleet.node(days=1, unique='closing{}'.format(number))
+               for number in range(4)]
+    fleet.close()
+    # Outstanding calls are waited for, then the threads are gone.
+    assert all([result.ready() for result in results])
+    assert all([result.successful() for result in results])
+    assert not any([thread.is_alive() for thread in fleet._pool._pool])
+
+
+def test_fleet_call_fails(server):
+    server.fail_next(1, status=400)
+    fleet = sporestack.fleet.Fleet(concurrency=2)
+    try:
+        result = fleet.node(days=1, unique='refused')
+        # The caller gets the exception the call raised.
+        with pytest.raises(sporestack.SporeStackError):
+            result.get(5)
+        # And the fleet carries on.
+        assert fleet.node(days=1, unique='accepted').get(5).satoshis > 0
+    finally:
+        fleet.close()
+
+
+def test_spawn_many_closes_fleet(server, dot_file_path, sshkey,
+                                 monkeypatch):
+    closed = []
+    close = sporestack.fleet.Fleet.close
+    monkeypatch.setattr(sporestack.fleet.Fleet,
+                        'close',
+                        lambda fleet: closed.append(close(fleet)))
+    server.fail_next(100, status=400)
+    with pytest.raises(sporestack.SporeStackError):
+        cli.spawn_many(count=3, days=1, sshkey=sshkey, concurrency=2)
+    assert len(closed) == 1
+
+
+def test_spawn_many_postlaunch(server, dot_file_path, sshkey, tmpdir,
+                               monkeypatch, capsys):
+    fake_ssh = tmpdir.join('ssh')
+    fake_ssh.write(FAKE_SSH)
+    fake_ssh.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+    # sshd isn't up until a little after the nodes are created.
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+
+    def come_online():
+        sleep(0.3)
+        listener.listen(8)
+    thread = threading.Thread(target=come_online)
+    thread.start()
+    try:
+        uuids = cli.spawn_many(count=2,
+                               days=1,
+                               sshkey=sshkey,
+                               postlaunch='uptime\n',
+                               port=port)
+        output = capsys.readouterr()
+        assert sorted(output.out.splitlines()) == \
+            sorted(['{} uptime'.format(uuid) for uuid in uuids])
+        for uuid in uuids:
+            assert '{}: exit code 0'.format(uuid) in output.err
+        fake_ssh.write('#!/bin/sh\ncat > /dev/null\nexit 3\n')
+        with pytest.raises(SystemExit) as exit_info:
+            cli.spawn_many(count=2,
+                           days=1,
                            sshkey=sshkey,
-                           unique=unique,
-                           cloudinit=script,
-                           startupscript=script)
-    print('Payment status: ' + str(node.payment_status))
-    print('Creation status: ' + str(node.creation_status))
-    print(node.address)
-    print(node.satoshis)
-    print(node.ip6)
-    print(node.ip4)
+                           postlaunch='uptime\n',
+                           port=port)
+        assert exit_info.value.code == 1
+        assert capsys.readouterr().err.count(': exit code 3') == 2
+    finally:
+        thread.join()
+        listener.close()
+
+
+def test_profiling(server, dot_file_path, sshkey, tmpdir):
+    server.latency = 0.01
+    path = str(tmpdir.join('spawn.pstats'))
+    with sporestack.profiling.profiling(path, trace_alloc=True) as session:
+        cli.spawn_many(count=4, days=1, sshkey=sshkey, osid=230, dcid=3,
+                       flavor=29, concurrency=4)
+    names = [function[2] for function in pstats.Stats(path).stats]
+    # Polls run on the fleet's threads.
+    assert '_post_node' in names
+    report = session.report()
+    assert 'Top blocked on I/O' in report
+    blocked = report.split('Top blocked')[1].split('Top allocations')[0]
+    assert "<method 'recv' of '_socket.socket' objects>" in blocked
+    assert session.wall >= session.cpu
+    assert len(session.allocations) != 0
+
+
+def test_profile_option(dot_file_path, tmpdir, monkeypatch, capsys):
+    path = str(tmpdir.join('list.pstats'))
+    monkeypatch.setattr('sys.argv', ['sporestack', '--profile', path,
+                                     '--trace-alloc', 'list'])
+    with pytest.raises(SystemExit):
+        cli.main()
+    assert 'Profile: ' in capsys.readouterr().err
+    assert os.path.exists(path)
+
+
+def test_profile_option_fails_to_start(dot_file_path, monkeypatch, capsys):
+    @contextmanager
+    def broken(**kwargs):
+        raise RuntimeError('no profiler')
+        yield
+    monkeypatch.setattr(sporestack.profiling, 'profiling', broken)
+    monkeypatch.setattr('sys.argv', ['sporestack', '--trace-alloc', 'list'])
+    # The error, not an UnboundLocalError from reporting on no session.
+    with pytest.raises(RuntimeError):
+        cli.main()
+    assert 'Profile: ' not in capsys.readouterr().err
+
+
+def test_execute(tmpdir, monkeypatch):
+    log = tmpdir.join('ssh.log')
+    fake_ssh = tmpdir.join('ssh')
+    fake_ssh.write('#!/bin/sh\n'
+                   'echo "$@" >> {}\n'
+                   'cat\n'
+                   'case "$*" in *127.0.0.2*) exit 4;; esac\n'.format(log))
+    fake_ssh.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+    listener = socket.socket()
+    listener.bind(('', 0))
+    listener.listen(8)
+    port = listener.getsockname()[1]
+    nodes = [{'uuid': 'ok', 'ip4': '127.0.0.1', 'ip6': None},
+             {'uuid': 'failing', 'ip4': '127.0.0.2', 'ip6': None},
+             {'uuid': 'unreachable', 'ip4': None, 'ip6': None}]
+    lines = []
+    try:
+        results = sporestack.remote.execute(
+            nodes,
+            'uptime\n',
+            on_line=lambda node, stream, line: lines.append(
+                (node['uuid'], line)),
+            port=port,
+            control_path=str(tmpdir.join('control')))
+    finally:
+        listener.close()
+    assert [(node['uuid'], code) for node, code in results] == \
+        [('ok', 0),
+         ('failing', 4),
+         ('unreachable', sporestack.remote.UNREACHABLE)]
+    assert sorted(lines) == [('failing', 'uptime\n'), ('ok', 'uptime\n')]
+    calls = log.read().splitlines()
+    assert len(calls) == 2
+    for call in calls:
+        assert '-p {}'.format(port) in call
+
+
+def test_execute_waits_for_port(tmpdir, monkeypatch):
+    fake_ssh = tmpdir.join('ssh')
+    fake_ssh.write(FAKE_SSH)
+    fake_ssh.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+    for phase, delays in FAST_PHASES.items():
+        monkeypatch.setitem(sporestack.poll.PHASES, phase, delays)
+    # Bound but not listening yet, like a node whose sshd is still starting.
+    # Nothing ever listens on 127.0.0.2.
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    nodes = [{'uuid': 'late', 'ip4': '127.0.0.1', 'ip6': None},
+             {'uuid': 'down', 'ip4': '127.0.0.2', 'ip6': None}]
+
+    def come_online():
+        sleep(0.3)
+        listener.listen(8)
+    thread = threading.Thread(target=come_online)
+    try:
+        results = sporestack.remote.execute(
+            nodes,
+            'uptime\n',
+            port=port,
+            control_path=str(tmpdir.join('control')))
+        # Without reachable_timeout, each node gets one try.
+        assert [code for _, code in results] == \
+            [sporestack.remote.UNREACHABLE] * 2
+        thread.start()
+        start = time()
+        results = sporestack.remote.execute(
+            nodes,
+            'uptime\n',
+            port=port,
+            control_path=str(tmpdir.join('control')),
+            reachable_timeout=1)
+        assert time() - start >= 1
+    finally:
+        thread.join()
+        listener.close()
+    assert [(node['uuid'], code) for node, code in results] == \
+        [('late', 0), ('down', sporestack.remote.UNREACHABLE)]
+
+
+def test_command_streams():
+    command = sporestack.remote.Command(
+        ['sh', '-c', 'echo first; sleep 0.5; echo second >&2'])
+    start = time()
+    arrived = []
+    for stream, line in command:
+        arrived.append((stream, line, time() - start))
+    assert [(stream, line) for stream, line, _ in arrived] == \
+        [('stdout', 'first\n'), ('stderr', 'second\n')]
+    assert arrived[0][2] < 0.4
+    assert command.result.exit_code == 0
+    assert command.result.first_output < 0.4
+    assert command.result.seconds >= 0.5
+
+
+def test_command_bounded_buffers():
+    # Much more than a pipe holds each way, so this deadlocks unless stdin
+    # and output are pumped together.
+    stdin = ('x' * 3000 + '\n') * 1000
+    command = sporestack.remote.Command(['cat'], stdin=stdin,
+                                        buffer_size=1024)
+    pieces = [line for _, line in command]
+    assert ''.join(pieces) == stdin
+    assert max([len(piece) for piece in pieces]) == 1024
+    assert command.result.stdout_bytes == len(stdin)
+
+
+def stdin_pipe():
+    """
+    Returns a file to feed to a Command and the descriptor writing to it,
+    which the command doesn't inherit.
+    """
+    read_fd, write_fd = os.pipe()
+    fcntl.fcntl(write_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    return os.fdopen(read_fd), write_fd
+
+
+def test_command_slow_stdin():
+    stdin, write_fd = stdin_pipe()
+
+    def dribble():
+        os.write(write_fd, 'first\n')
+        sleep(0.5)
+        os.write(write_fd, 'second\n')
+        os.close(write_fd)
+    thread = threading.Thread(target=dribble)
+    thread.start()
+    start = time()
+    arrived = []
+    try:
+        for _, line in sporestack.remote.Command(['cat'], stdin=stdin):
+            arrived.append((line, time() - start))
+    finally:
+        thread.join()
+        stdin.close()
+    assert [line for line, _ in arrived] == ['first\n', 'second\n']
+    # Not held up waiting for a whole buffer of stdin.
+    assert arrived[0][1] < 0.4
+    # Nor is the timeout, with stdin that never comes.
+    stdin, write_fd = stdin_pipe()
+    try:
+        result = sporestack.remote.Command(['sleep', '5'],
+                                           stdin=stdin,
+                                           timeout=0.2).wait()
+    finally:
+        os.close(write_fd)
+        stdin.close()
+    assert result.timed_out == 'timeout'
+    assert result.seconds < 1
+
+
+def test_command_timeouts():
+    result = sporestack.remote.Command(['sleep', '5'], timeout=0.2).wait()
+    assert result.timed_out == 'timeout'
+    assert result.seconds < 1
+    lines = []
+    result = sporestack.remote.Command(['sh', '-c', 'echo a; sleep 5'],
+                                       idle_timeout=0.2).wait(
+        lambda stream, line: lines.append(line))
+    assert result.timed_out == 'idle'
+    assert lines == ['a\n']
+
+
+def test_quote_matrix(server, dot_file_path):
+    rows = sporestack.quote.matrix([1, 7], sweep=True)
+    assert len(rows) == 4 * 3 * 2
+    assert server.request_count('/node') == 24
+    # Nothing gets paid for, so nothing is spawned.
+    assert all([node['paid_at'] is None for node in server.nodes.values()])
+    assert set([row['source'] for row in rows]) == set(['fetched'])
+    quote = [row for row in rows
+             if row['flavor'] == 94 and row['days'] == 7][0]
+    assert quote['satoshis'] == 7 * (2 * 100000 + 50 * 2048)
+    assert quote['per_day'] == 302400
+    assert quote['per_vcpu_day'] == 151200
+    assert quote['per_gb_ram_day'] == 151200
+    rows = sporestack.quote.matrix([1, 7], dcids=[3])
+    assert server.request_count('/node') == 24
+    assert set([row['source'] for row in rows]) == set(['cached'])
+    sporestack.quote.matrix([1, 7], dcids=[3], refresh=True, sweep=True)
+    assert server.request_count('/node') == 32
+    sporestack.quote.matrix([1], dcids=[3], ttl=0)
+    assert server.request_count('/node') == 36
+    with pytest.raises(ValueError):
+        sporestack.quote.matrix([1], dcids=[99])
+
+
+def test_quote_linear(server, dot_file_path):
+    # One throwaway node for each flavor and dcid, not each days.
+    rows = sporestack.quote.matrix([1, 7, 28], dcids=[3])
+    assert server.request_count('/node') == 4
+    assert [row['source'] for row in rows] == \
+        ['fetched', 'interpolated', 'interpolated'] * 4
+    for row in rows:
+        assert row['satoshis'] == server.price(row['flavor'], row['days'])
+    rows = sporestack.quote.matrix([14], dcids=[3])
+    assert server.request_count('/node') == 4
+    assert set([row['source'] for row in rows]) == set(['interpolated'])
+    rows = sporestack.quote.matrix([14], dcids=[3], sweep=True)
+    assert server.request_count('/node') == 8
+    assert set([row['source'] for row in rows]) == set(['fetched'])
+
+
+def test_quote_command(server, dot_file_path, capsys):
+    cli.quote(days=[7], dcids=[1], sort='per_vcpu_day', output_format='csv')
+    rows = [row for row in
+            csv.DictReader(capsys.readouterr().out.splitlines())]
+    assert len(rows) == 4
+    per_vcpu_day = [float(row['per_vcpu_day']) for row in rows]
+    assert per_vcpu_day == sorted(per_vcpu_day)
+    cli.quote(days=[7], dcids=[1])
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split()[:3] == ['flavor', 'dcid', 'days']
+    assert lines[1].split()[0] == '29'
+    assert lines[1].split()[-1] == 'cached'
+    with pytest.raises(SystemExit):
+        cli.quote(days=[7], dcids=[99])
+    assert 'Unknown dcid 99' in capsys.readouterr().err
+    requests = server.request_count('/node')
+    with pytest.raises(SystemExit):
+        cli.quote(days=[7], sort='cheapest')
+    assert '--sort must be one of: satoshis, per_day' in \
+        capsys.readouterr().err
+    assert server.request_count('/node') == requests